@@ -64,34 +64,27 @@ gettext.install('gmail-backup', MESSAGES_DIR, unicode=1)
 (UpdateLogEvent, EVT_UPDATE_LOG) = wx.lib.newevent.NewEvent()
 
 class GUINotifier(gmail_backup.ConsoleNotifier):
+    # The speed is rendered by the RateMeter at most once per second
+    RENDER_INTERVAL = 1
+
     def __init__(self, mainwindow):
         super(GUINotifier, self).__init__()
         self.mw = mainwindow
-        self.last_update_time = 0
 
-    def createEvent(self, msg, force=False):
-        now = time.time()
-        if now - self.last_update_time < 1 and not force:
-            return
-        else:
-            if not force:
-                self.last_update_time = now
-            evt = UpdateLogEvent(msg = msg, speed=self.getSpeed(),
-                    total=self.getTotal(), percentage=self.getPercentage())
-            return evt
+    def createEvent(self, msg):
+        evt = UpdateLogEvent(msg = msg, speed=self.getSpeed(),
+                total=self.getTotal(), percentage=self.getPercentage(),
+                eta=self.getETA())
+        return evt
 
     def uprint(self, msg):
-        evt = self.createEvent(msg, force=True)
-        if evt is not None:
-            wx.PostEvent(self.mw, evt)
+        wx.PostEvent(self.mw, self.createEvent(msg))
 
     def uprint2(self, msg):
         pass
 
     def updateSpeed(self):
-        evt = self.createEvent(None)
-        if evt is not None:
-            wx.PostEvent(self.mw, evt)
+        wx.PostEvent(self.mw, self.createEvent(None))
 
 class InterruptableThread(threading.Thread):
     @classmethod
@@ -126,6 +119,8 @@ class ThreadedGMailBackup(gmail_backup.GMailBackup):
         try:
             method(self, *args, **kwargs)
         except:
+            # The interrupted connection can't be reused
+            self.connection.drop()
             type, error, tb = sys.exc_info()
             self.notifier.nException(type, error, tb)
 
@@ -280,6 +275,7 @@ You can write them either as $YEAR or ${YEAR}.'''))
         self._clearLocale()
 
         self.currentThread = None
+        self.currentBackup = None
         self.notifier = GUINotifier(self)
 
         self.timer = wx.Timer(self)
@@ -296,6 +292,19 @@ You can write them either as $YEAR or ${YEAR}.'''))
     def _restoreLocale(self):
         locale.setlocale(locale.LC_TIME, self._prevLocale)
 
+    def getBackup(self, username, password):
+        '''Returns ThreadedGMailBackup of the account, the object stays
+        logged in and it is reused by the next backup or restore of the
+        same account'''
+        b = self.currentBackup
+        if b is None or (b.username, b.password) != (username, password):
+            if b is not None:
+                b.connection.drop()
+            b = ThreadedGMailBackup(username, password, self.notifier)
+            b.connection.persistent = True
+            self.currentBackup = b
+        return b
+
     def disableCntrls(self):
         self.login.Disable()
         self.password.Disable()
@@ -410,6 +419,8 @@ You can write them either as $YEAR or ${YEAR}.'''))
         else:
             self.progress.SetValue(0)
         label = _('Processed %.2fMB, speed %.1fKB/s') % (event.total, event.speed)
+        if event.eta is not None:
+            label += _(', remaining %s') % event.eta
         self.message.SetLabel(label)
         if event.percentage is not None:
             self.SetLabel(TITLE_WORKING % (event.percentage,))
@@ -460,7 +471,7 @@ You can write them either as $YEAR or ${YEAR}.'''))
                 where.append('BEFORE')
                 where.append(before)
 
-        b = ThreadedGMailBackup(username, password, self.notifier)
+        b = self.getBackup(username, password)
         self.currentThread = b.backup(dirname, where, stamp=stamp)
 
         # desable all necessary controls
@@ -501,7 +512,7 @@ You can write them either as $YEAR or ${YEAR}.'''))
         username = self.login.GetValue()
         password = self.password.GetValue()
         dirname = self.folder.GetValue()
-        b = ThreadedGMailBackup(username, password, self.notifier)
+        b = self.getBackup(username, password)
         self.currentThread = b.restore(dirname, since, before)
         
         # desable all necessary controls
@@ -537,6 +548,8 @@ You can write them either as $YEAR or ${YEAR}.'''))
     def OnExit(self, event):
         self.OnStop(event)
         self.saveSettings()
+        if self.currentBackup is not None:
+            self.currentBackup.connection.drop()
         
         self.GetParent().Close()
         
@@ -23,8 +23,9 @@
 #   See LICENSE file for license details
 
 from svc.scripting import *
-from gmb import ConsoleNotifier, _convertTime, GMailBackup, GMB_REVISION, GMB_DATE, imap_decode, imap_encode
+from gmb import ConsoleNotifier, _convertTime, GMailBackup, BatchBackup, BATCH_JOBS, VERIFY_JOBS, DAEMON_RECONCILE, GMB_REVISION, GMB_DATE, imap_decode, imap_encode
 import sys
+import traceback
 
 GMB_CMD_REVISION = u'$Revision$'
 GMB_CMD_DATE = u'$Date$'
@@ -35,12 +36,6 @@ GMB_CMD_DATE = GMB_CMD_DATE[7:-2].split()[0]
 MAX_REVISION = str(max(int(GMB_CMD_REVISION), int(GMB_REVISION)))
 MAX_DATE = max(GMB_CMD_DATE, GMB_DATE)
 
-
-try:
-    from hashlib import md5
-except ImportError:
-    from md5 import md5
-
 class GMailBackupScript(ExScript):
     USAGE = \
 '''Description
@@ -89,6 +84,120 @@ gmail-backup.exe clear user@gmail.com password
 The program will ask you to repeat the username, so you have the chance to
 cancel your mistake.
 
+To backup many accounts at once, write them into the manifest file, one
+account per line in the format:
+
+dirname user@gmail.com password [since [before]]
+
+and use the batch command:
+
+gmail-backup.exe batch manifest.txt --jobs=8 --timeout=3600 --retries=2
+
+The accounts are backed up concurrently, at most --jobs accounts at once.
+Account which takes longer than --timeout seconds is interrupted and the failed
+accounts are retried --retries times. The summary is printed at the end.
+
+To check that the backup in the directory dir is complete and not damaged,
+use the verify command:
+
+gmail-backup.exe verify dir
+
+The messages are compared with the catalog (ids.txt and labels.txt) and with
+the SHA-256 checksums recorded during the backup in the file sums.txt. The
+messages are hashed by --jobs processes. If you add your username and password,
+the backup is also compared with the list of messages in your GMail account:
+
+gmail-backup.exe verify dir user@gmail.com password
+
+The stored messages are indexed for the full-text search in the file
+index.sqlite. To find the messages in the backup, use the search command with
+the query in the SQLite full-text query syntax, the columns subject, sender,
+recipients, date, labels and body can be used:
+
+gmail-backup.exe search dir "invoice sender:amazon" --limit=20
+
+The paths of the matching messages are printed, the newest first. Messages
+stored by the older versions are indexed on the first search.
+
+Volumes:
+========
+
+The backup into the ZIP file can be split into volumes, so every run appends
+only to one smaller file and a damaged file doesn't put the whole backup at
+risk. Use --volumes=month to store the messages into backup-YYYY-MM.zip
+according to their date or for example --volumes=500M to start a new volume
+backup-NNNN.zip after the current one reaches 500MB:
+
+gmail-backup.exe backup backup.zip user@gmail.com password --volumes=month
+
+The volumes are listed in the file backup.volumes.txt, the next backups and
+restores use them automatically.
+
+Compression:
+============
+
+The messages are stored compressed according to the --codec option. The
+codecs are none (the default for directories), deflate (the default for ZIP
+files), bz2, lzma (needs the Python lzma module) and fast (quick deflate),
+the level can follow the name, e.g. --codec=bz2:9 or --codec=deflate:1:
+
+gmail-backup.exe backup dir user@gmail.com password --codec=deflate
+
+The compressed messages are stored with the extension of the codec (.eml.gz,
+.eml.bz2, .eml.xz), so the backups made with different codecs can be mixed
+and restored together.
+
+External filters:
+=================
+
+The messages stored into a directory can be passed through external programs,
+for example to encrypt them. The --filter option gives the commands separated
+by '|', the filtered messages are stored with the extension --filter-ext
+(.filtered by default). The extensions used are recorded in the file
+filters.txt of the backup, other files are not taken as the stored messages.
+The command reverting the filter is given to the restore and search commands
+by the --unfilter option. The filters are supported only on POSIX systems
+(Linux, Mac OS X), not on Windows:
+
+gmail-backup.sh backup dir user@gmail.com password --filter="gpg --batch -e -r me@example.com" --filter-ext=.gpg
+gmail-backup.sh restore dir user@gmail.com password --unfilter="gpg --batch -d"
+
+The filters are started for every message. Filters written for GMail Backup
+can run as long-lived processes with the --filter-framed flag, then every
+message is written to the filter as a frame (the length in decimal digits, a
+newline and the data) and the filter answers with the frame of the filtered
+data.
+
+Daemon:
+=======
+
+The daemon command keeps the backup up to date until it is stopped by Ctrl+C.
+It stays connected, waits for the new messages by IMAP IDLE and stores them
+within seconds after they arrive. The labels are reconciled every --reconcile
+seconds (an hour by default) if the mailbox changed. The state of the daemon
+is stored in the file "daemon.txt" in the backup directory, so the restarted
+daemon continues where it stopped:
+
+gmail-backup.exe daemon dir user@gmail.com password --reconcile=1800
+
+Catalog:
+========
+
+The stored messages are listed in the file "ids.txt" and looked up in its hash
+index "ids.idx", which is rebuilt automatically if it is missing. The --bloom
+flag creates the Bloom filter "ids.bloom", which is small enough to stay in the
+memory and tells which messages in GMail are certainly new without touching the
+index. It is kept up to date by all the next backups:
+
+gmail-backup.exe backup dir user@gmail.com password --stamp --bloom
+
+The filter makes the lookups of the stored messages slower. It pays off only
+for the archives whose index doesn't fit into the memory or if most of the
+examined messages are new, the script catalog-benchmark.py measures it for the
+catalog of the backup:
+
+catalog-benchmark.py dir
+
 Backups with timestamp:
 =======================
 
@@ -131,21 +240,57 @@ Thanks.
         'backup.before': (String),
         'backup.since': (String),
         'backup.stamp': Flag,
+        'backup.volumes': String,
+        'backup.codec': String,
+        'backup.filter': String,
+        'backup.filter_ext': String,
+        'backup.filter_framed': Flag,
+        'backup.bloom': Flag,
         'restore.dirname': OptionAlias,
         'restore.username': OptionAlias,
         'restore.password': OptionAlias,
         'restore.before': OptionAlias,
         'restore.since': OptionAlias,
+        'restore.unfilter': String,
+        'restore.filter_framed': OptionAlias,
         'clear.username': OptionAlias,
         'clear.password': OptionAlias,
         'list.username': OptionAlias,
         'list.password': OptionAlias,
+        'batch.manifest': (Required, String),
+        'batch.jobs': Integer,
+        'batch.timeout': Integer,
+        'batch.retries': Integer,
+        'batch.stamp': OptionAlias,
+        'verify.dirname': OptionAlias,
+        'verify.account': String,
+        'verify.passwd': String,
+        'verify.jobs': OptionAlias,
+        'search.dirname': OptionAlias,
+        'search.query': (Required, String),
+        'search.limit': Integer,
+        'search.unfilter': OptionAlias,
+        'search.filter_framed': OptionAlias,
+        'daemon.dirname': OptionAlias,
+        'daemon.username': OptionAlias,
+        'daemon.password': OptionAlias,
+        'daemon.volumes': OptionAlias,
+        'daemon.codec': OptionAlias,
+        'daemon.filter': OptionAlias,
+        'daemon.filter_ext': OptionAlias,
+        'daemon.filter_framed': OptionAlias,
+        'daemon.bloom': OptionAlias,
+        'daemon.reconcile': Integer,
     }
 
     posOpts = ['command', {'backup': ['dirname', 'username', 'password', 'since', 'before'],
                            'restore': ['dirname', 'username', 'password', 'since', 'before'],
                            'clear': ['username', 'password'],
                            'list': ['username', 'password'],
+                           'batch': ['manifest'],
+                           'verify': ['dirname', 'account', 'passwd'],
+                           'search': ['dirname', 'query'],
+                           'daemon': ['dirname', 'username', 'password'],
                            'version': [],
                           }]
 
@@ -157,6 +302,29 @@ Thanks.
         'password': '''Your GMail password''',
         'since': '''Only e-mails since this date are backed up, date in format YYYYMMDD''',
         'before': '''Only e-mails before this date are backed up, date in format YYYYMMDD''',
+        'volumes': '''Split the ZIP backup into volumes by 'month' or by size
+                    (e.g. 500M)''',
+        'codec': '''Compression of the stored messages - none, deflate, bz2,
+                    lzma or fast, optionally with the level (e.g. deflate:9)''',
+        'filter': '''External commands filtering the stored messages (e.g.
+                    encryption), separated by '|', not supported on Windows''',
+        'filter_ext': '''Extension of the filtered messages (e.g. .gpg)''',
+        'filter_framed': '''The filters are long-lived processes reading and
+                    writing the messages as frames''',
+        'unfilter': '''External commands reverting the filter''',
+        'bloom': '''Create the Bloom filter of the stored messages, the
+                    incremental backups test the messages by it first''',
+        'manifest': '''File with the list of accounts for the batch command''',
+        'jobs': '''Number of accounts backed up concurrently (batch) or number
+                    of hashing processes (verify)''',
+        'timeout': '''Timeout for the backup of one account in seconds''',
+        'retries': '''Number of retries of the failed account''',
+        'query': '''Full-text query for the search command''',
+        'limit': '''Maximal number of messages returned by the search command''',
+        'account': '''GMail account used to cross-check the verified backup''',
+        'passwd': '''Password of the account used to cross-check the verified backup''',
+        'reconcile': '''Interval of the label reconciliation of the daemon in
+                    seconds''',
     }
 
     debugMain = False
@@ -165,7 +333,8 @@ Thanks.
         print self.USAGE
 
     @ExScript.command
-    def backup(self, dirname, username, password, since=None, before=None, stamp=False):
+    def backup(self, dirname, username, password, since=None, before=None, stamp=False, volumes=None, codec=None,
+               filter=None, filter_ext=None, filter_framed=False, bloom=False):
         '''Performs backup of your GMail mailbox'''
         self.notifier = ConsoleNotifier()
 
@@ -179,15 +348,77 @@ Thanks.
             where.append('BEFORE')
             where.append(before)
 
+        options = {}
+        if volumes is not None:
+            options['volumes'] = volumes
+        if codec is not None:
+            options['codec'] = codec
+        if filter is not None:
+            options['filter'] = filter
+            options['filter_ext'] = filter_ext
+            options['filter_framed'] = filter_framed
+        if bloom:
+            options['bloom'] = True
+        b = GMailBackup(username, password, self.notifier)
+        b.backup(dirname, where, stamp=stamp, options=options)
+
+    @ExScript.command
+    def daemon(self, dirname, username, password, volumes=None, codec=None, filter=None, filter_ext=None,
+               filter_framed=False, bloom=False, reconcile=DAEMON_RECONCILE):
+        '''Keeps the backup of your GMail mailbox up to date until it is
+        interrupted'''
+        self.notifier = ConsoleNotifier()
+
+        options = {}
+        if volumes is not None:
+            options['volumes'] = volumes
+        if codec is not None:
+            options['codec'] = codec
+        if filter is not None:
+            options['filter'] = filter
+            options['filter_ext'] = filter_ext
+            options['filter_framed'] = filter_framed
+        if bloom:
+            options['bloom'] = True
         b = GMailBackup(username, password, self.notifier)
-        b.backup(dirname, where, stamp=stamp)
+        b.daemon(dirname, options=options, reconcile=reconcile)
+
+    @ExScript.command
+    def batch(self, manifest, jobs=BATCH_JOBS, timeout=None, retries=0, stamp=False):
+        '''Performs backup of all GMail mailboxes listed in the manifest file'''
+        self.notifier = ConsoleNotifier()
+        accounts = BatchBackup.readManifest(manifest)
+        b = BatchBackup(self.notifier, jobs, timeout, retries)
+        results = b.run(accounts, stamp=stamp)
+        if not all(r.ok for r in results):
+            sys.exit(1)
+
+    @ExScript.command
+    def verify(self, dirname, account=None, passwd=None, jobs=VERIFY_JOBS):
+        '''Verifies the integrity and completeness of the backup'''
+        self.notifier = ConsoleNotifier()
+        b = GMailBackup(account, passwd, self.notifier)
+        result = b.verify(dirname, jobs, server=account is not None)
+        if result is None or not result.ok:
+            sys.exit(1)
+
+    @ExScript.command
+    def search(self, dirname, query, limit=None, unfilter=None, filter_framed=False):
+        '''Searches the backup for messages matching the full-text query'''
+        self.notifier = ConsoleNotifier()
+        b = GMailBackup(None, None, self.notifier)
+        paths = b.search(dirname, query, limit, {'unfilter': unfilter, 'filter_framed': filter_framed})
+        if paths is None:
+            sys.exit(1)
+        for path in paths:
+            print path
 
     @ExScript.command
-    def restore(self, dirname, username, password, since=None, before=None):
+    def restore(self, dirname, username, password, since=None, before=None, unfilter=None, filter_framed=False):
         '''Performs restore of your previously backed up GMail mailbox'''
         self.notifier = ConsoleNotifier()
         b = GMailBackup(username, password, self.notifier)
-        b.restore(dirname, since, before)
+        b.restore(dirname, since, before, {'unfilter': unfilter, 'filter_framed': filter_framed})
 
     @ExScript.command
     def clear(self, username, password):
@@ -225,7 +456,10 @@ Thanks.
         b.reportNewVersion()
 
     def _mainError(self, value):
-        if isinstance(value, OptionError):
+        if isinstance(value, SystemExit):
+            # Exit status of the command
+            raise
+        elif isinstance(value, OptionError):
             return super(GMailBackupScript, self)._mainError(value)
         elif not hasattr(self, 'notifier'):
             return super(GMailBackupScript, self)._mainError(value)
@@ -244,5 +478,10 @@ Thanks.
 
 
 if __name__ == '__main__':
+    if getattr(sys, 'frozen', False):
+        # Needed by the frozen Windows executable for the verify command,
+        # multiprocessing is not imported at the startup otherwise
+        import multiprocessing
+        multiprocessing.freeze_support()
     s = GMailBackupScript()
     s.run()
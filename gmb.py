@@ -26,40 +26,91 @@ import os
 import sys
 import imaplib
 import socket
-import zipfile
+import zlib
 import email
-import email.Utils
-import email.Header
-import email.Iterators
-import email.Header
-import email.Generator
-import email.Errors
-import sys
-if sys.version_info[:2] >= (2, 5):
-    import email.utils
-    import email.header
-    import email.iterators
-    import email.header
-    import email.generator
-    import email.errors
+if sys.version_info[:2] < (2, 5):
+    # Python 2.5 and newer import the submodules of email on the first use
+    import email.Utils
+    import email.Header
 
 import time
-import datetime
+import random
+import itertools
+from array import array
 import re
 import codecs
-import socket
 import traceback
-import shutil
-import urllib
-import zipfile
 import string
+import struct
+import mmap
+import errno
+from cStringIO import StringIO
 import unicodedata
 import gettext
+import threading
+import Queue
+from select import select
+from imapparse import imap_decode, imap_encode, imap_unescape, imap_escape, parseList, parseFetch, parseEsearch, messageSet, SYSTEM_MAILBOX, MESSAGE_ID_HEADER, EMAIL_ADDRESS
 
 try:
-    from hashlib import md5
+    from hashlib import md5, sha256
 except ImportError:
     from md5 import md5
+    sha256 = None
+
+class _LazyModule(object):
+    '''Module imported on the first access to its attributes
+
+    The modules needed only by some commands are not imported at the
+    startup. The truth value of the lazy module tells whether the module is
+    installed, the optional modules are tested by `if not sqlite3`.
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._missing = False
+
+    def _load(self):
+        if self._module is None and not self._missing:
+            try:
+                __import__(self._name)
+                self._module = sys.modules[self._name]
+            except ImportError:
+                self._missing = True
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        if module is None:
+            raise ImportError("No module named %s" % self._name)
+        return getattr(module, attr)
+
+    def __nonzero__(self):
+        return self._load() is not None
+
+zipfile = _LazyModule('zipfile')
+gzip = _LazyModule('gzip')
+shutil = _LazyModule('shutil')
+urllib = _LazyModule('urllib')
+multiprocessing = _LazyModule('multiprocessing')
+sqlite3 = _LazyModule('sqlite3')
+bz2 = _LazyModule('bz2')
+lzma = _LazyModule('lzma')
+shlex = _LazyModule('shlex')
+externals = _LazyModule('svc.scripting.externals')
+
+def _cpuCount():
+    '''Returns the number of processors, the same way as
+    multiprocessing.cpu_count() but without importing multiprocessing
+    '''
+    try:
+        return max(int(os.sysconf('SC_NPROCESSORS_ONLN')), 1)
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        return max(int(os.environ['NUMBER_OF_PROCESSORS']), 1)
+    except (KeyError, ValueError):
+        return 1
 
 GMB_REVISION = u'$Revision$'
 GMB_DATE = u'$Date$'
@@ -68,14 +119,56 @@ GMB_REVISION = GMB_REVISION[11:-2]
 GMB_DATE = GMB_DATE[7:-2].split()[0]
 
 SPEED_AVERAGE_TIME = 21 # speed average over the last x seconds
+RENDER_INTERVAL = 0.5 # minimal interval between two updates of the speed line
 SOCKET_TIMEOUT = 60 # timeout for socket operations
 
 MAX_LABEL_RETRIES = 5
 
+PIPELINE_DEPTH = 8 # Initial number of IMAP commands in flight on one connection
+MAX_PIPELINE_DEPTH = 32 # Maximum number of IMAP commands in flight on one connection
+INFO_CHUNK = 500 # Number of messages in one FETCH of the sizes, dates and Message-IDs
+FETCH_BATCH_SIZE = 1024 * 1024 # Maximal total size of the messages downloaded by one FETCH
+FETCH_BATCH_COUNT = 50 # Maximal number of messages downloaded by one FETCH
+PIPELINE_RECV = 1024 * 64 # Size of one read from the pipelined connection
+
+READ_CHUNK_MIN = 1024 * 16 # Initial size of one socket read
+READ_CHUNK_MAX = 1024 * 1024 # Maximum size of one socket read
+SEND_CHUNK = 1024 * 32 # Size of one socket write
+
 VERSION_URL = 'http://code.google.com/p/gmail-backup-com/source/list'
 
 SLEEP_FOR = 20 # After network error sleep for X seconds
 MAX_TRY = 5 # Maximum number of reconnects
+KEEPALIVE = 5*60 # The connection idle for X seconds is checked by NOOP before it is used again
+RECONNECT_JITTER = 0.5 # The sleeps between reconnects vary randomly by +-X of their length
+
+QUOTA_PAUSE = 60*60 # After exceeding the Gmail bandwidth quota pause for X seconds
+IDLE_TIMEOUT = 9*60 # Reissue IDLE after X seconds, before the server drops the idle connection
+DAEMON_RECONCILE = 60*60 # Reconcile the labels in the daemon mode every X seconds
+MAX_QUOTA_PAUSES = 24 # Maximum number of pauses caused by the quota
+
+# Substrings of the IMAP errors signalling that Gmail limits the account
+QUOTA_ERRORS = ['OVERQUOTA', 'exceeded command or bandwidth limits']
+THROTTLE_ERRORS = ['THROTTLED', 'Too many simultaneous connections', 'UNAVAILABLE', 'Server Unavailable']
+
+BATCH_JOBS = 4 # Number of accounts backed up concurrently in the batch mode
+BATCH_RETRY_SLEEP = 30 # Sleep for X seconds before retrying the failed account
+
+HASH_BLOCK = 1024 * 1024 # Size of one read while computing the checksum of a file
+VERIFY_CHUNK = 64 # Number of messages hashed by one task of the verification
+VERIFY_JOBS = _cpuCount() # Number of hashing processes
+
+COMPRESS_THREADS = VERIFY_JOBS # Number of threads compressing the stored messages
+COMPRESS_QUEUE = 16 # Maximal number of messages waiting for the compression
+FILTER_PROCESSES = COMPRESS_THREADS # Number of long-lived processes of a framed filter
+FILTER_EXTENSION = '.filtered' # Default extension of the messages stored by a filter
+STAGE_QUEUE = 16 # Maximal number of messages waiting between two stages of the backup
+STAGE_POLL = 0.5 # Interval of checking the stopped pipeline while waiting for a queue
+
+VOLUME_UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3} # Suffixes of the volume size
+
+INDEX_BODY_LIMIT = 1024 * 64 # Maximum number of characters of the body in the full-text index
+INDEX_MODULES = ['fts5', 'fts4', 'fts3'] # Preferred sqlite full-text modules
 
 MESSAGES_DIR = os.path.join(os.path.dirname(sys.argv[0]), 'messages')
 gettext.install('gmail-backup', MESSAGES_DIR, unicode=1)
@@ -107,11 +200,6 @@ def _getMailDate(mail):
     msg = email.message_from_string(mail)
     return _parseMsgDate(msg)
 
-def _getMailIMAPDate(mail):
-    msg = email.message_from_string(mail)
-    d = imaplib.Time2Internaldate(_parseMsgDate(msg))
-    return d
-
 def _convertTime(t):
     t = time.mktime(time.strptime(t, '%Y%m%d'))
     return imaplib.Time2Internaldate(t)
@@ -139,7 +227,7 @@ def _getMsgInitials(msg):
     '''Returns from_address and subject for parsed `email` message
     '''
     from_address = _unicodeHeader(msg['From'])
-    match = re.match(r"^.*<(.*@.*\..*)>.*$", from_address)
+    match = EMAIL_ADDRESS.match(from_address)
     if match:
         from_address = match.group(1)
     subject = _unicodeHeader(msg['Subject'])
@@ -184,8 +272,193 @@ def _parseMsgDate(msg):
     d = _trimDate(d)
     return d
 
-def _revertDict(d):
-    return dict((v, k) for (k, v) in d.iteritems())
+def _classifyError(e):
+    '''Returns the kind of the error `e` used by the AdaptiveLimit, one of
+    'quota', 'throttle', 'timeout', 'abort', 'network' or None
+    '''
+    if isinstance(e, socket.timeout):
+        return 'timeout'
+    str_e = str(e).lower()
+    if isinstance(e, imaplib.IMAP4.error):
+        for sign in QUOTA_ERRORS:
+            if sign.lower() in str_e:
+                return 'quota'
+        for sign in THROTTLE_ERRORS:
+            if sign.lower() in str_e:
+                return 'throttle'
+    if isinstance(e, imaplib.IMAP4.abort):
+        return 'abort'
+    if isinstance(e, socket.error):
+        return 'network'
+    return None
+
+def _isConnectionLimit(e):
+    '''Returns True if the error `e` says that Gmail doesn't accept more
+    connections (throttling, refused connection)
+
+    Only these errors shrink the number of accounts backed up concurrently,
+    the quota is per account and it is handled by GMailConnection.
+    '''
+    if _classifyError(e) == 'throttle':
+        return True
+    return isinstance(e, socket.error) and e.args[:1] == (errno.ECONNREFUSED,)
+
+def _dataSize(data):
+    '''Returns the size of literals in the response `data` of imaplib'''
+    return sum(len(i[1]) for i in data if isinstance(i, tuple))
+
+_DIGITS = re.compile(r'\d+')
+
+def _jittered(t):
+    '''Returns the sleep time `t` varied randomly by RECONNECT_JITTER, so
+    the connections dropped together don't reconnect at the same time'''
+    return t * random.uniform(1 - RECONNECT_JITTER, 1 + RECONNECT_JITTER)
+
+def _formatElapsed(t):
+    t = int(t)
+    return '%d:%02d:%02d' % (t // 3600, t // 60 % 60, t % 60)
+
+def _checksum(data):
+    '''Returns the hex SHA-256 digest of `data` or None if hashlib is not
+    available'''
+    if sha256 is None:
+        return None
+    return sha256(data).hexdigest()
+
+def _readKeyValues(fn):
+    '''Returns the dictionary stored in the file `fn` as lines key<TAB>value
+    or None if the file doesn't exist'''
+    if not os.path.isfile(fn):
+        return None
+    ret = {}
+    fr = file(fn, 'r')
+    try:
+        for line in fr:
+            items = line.strip().split('\t', 1)
+            if len(items) == 2:
+                ret[items[0]] = items[1]
+    finally:
+        fr.close()
+    return ret
+
+def _writeKeyValues(fn, values):
+    '''Stores the dictionary `values` into the file `fn` as lines
+    key<TAB>value, the items with None value are skipped and the file is
+    replaced atomically'''
+    tmp_fn = fn + '.tmp'
+    fw = file(tmp_fn, 'w')
+    try:
+        for key, value in sorted(values.items()):
+            if value is not None:
+                print >> fw, '%s\t%s' % (key, value)
+    finally:
+        fw.close()
+    if os.path.exists(fn):
+        os.remove(fn)
+    os.rename(tmp_fn, fn)
+
+def _walkBackups(top, filters=()):
+    '''Walks trough the top and returns paths originating in top and ending with '.eml'
+    (optionally followed by the extension of the compression codec and one of
+    the extensions of the external filters `filters`)
+    '''
+    for dn, sub_dns, fns in os.walk(top):
+        rel_dn = dn[len(top):].lstrip(os.path.sep)
+        for fn in fns:
+            if not Codec.isMessage(fn, filters):
+                continue
+            yield os.path.join(rel_dn, fn)
+
+def _hashFiles(args):
+    '''Returns the list of (filename, digest) for files `names` in the
+    directory `top`, the digest is None for unreadable files, `filters` are
+    the extensions of the external filters used in the directory
+
+    Called in the worker processes of the verification.
+    '''
+    (top, filters), names = args
+    ret = []
+    for name in names:
+        try:
+            h = sha256()
+            fr = file(os.path.join(top, name), 'rb')
+            try:
+                if Codec.isCompressed(name) and not Codec.isFiltered(name, filters):
+                    h.update(Codec.decode(name, fr.read()))
+                else:
+                    while True:
+                        data = fr.read(HASH_BLOCK)
+                        if not data:
+                            break
+                        h.update(data)
+            finally:
+                fr.close()
+            ret.append((name, h.hexdigest()))
+        except Exception:
+            ret.append((name, None))
+    return ret
+
+def _hashZipMembers(args):
+    '''Returns the list of (member, digest) for members `names` of the zip
+    file `zip_fn`, the digest is None for unreadable members (including CRC
+    errors)
+
+    Called in the worker processes of the verification.
+    '''
+    zip_fn, names = args
+    ret = []
+    zip = zipfile.ZipFile(zip_fn, 'r')
+    try:
+        for name in names:
+            try:
+                ret.append((name, sha256(Codec.decode(name, zip.read(name))).hexdigest()))
+            except Exception:
+                ret.append((name, None))
+    finally:
+        zip.close()
+    return ret
+
+def _mapChunks(function, groups, jobs):
+    '''Applies `function` to chunks of names from `groups` of pairs (source,
+    names) using the pool of `jobs` processes and yields the items of the
+    results in arbitrary order
+    '''
+    chunks = []
+    for source, names in groups:
+        chunks.extend((source, names[i:i+VERIFY_CHUNK]) for i in xrange(0, len(names), VERIFY_CHUNK))
+    if not multiprocessing or jobs <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            for item in function(chunk):
+                yield item
+        return
+    pool = multiprocessing.Pool(min(jobs, len(chunks)))
+    try:
+        for ret in pool.imap_unordered(function, chunks):
+            for item in ret:
+                yield item
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _parseVolumes(spec):
+    '''Parses the volume specification of ZipStorage, returns None, 'month'
+    or the maximal size of the volume in bytes
+
+    The size is given in bytes or with the suffix K, M or G.
+    '''
+    if spec is None or spec == 'month':
+        return spec
+    spec = str(spec).strip().upper()
+    try:
+        if spec[-1:] in VOLUME_UNITS:
+            size = int(spec[:-1]) * VOLUME_UNITS[spec[-1]]
+        else:
+            size = int(spec)
+    except ValueError:
+        size = 0
+    if size <= 0:
+        raise ValueError(_("Bad volume specification: %s, use 'month' or size (e.g. 500M)") % spec)
+    return size
 
 def _shiftDates(min_date, max_date):
     min_date = _trimDate(min_date)
@@ -203,45 +476,161 @@ def _shiftDates(min_date, max_date):
     max_t = _trimDate(max_t)
     return min_t, max_t
 
-def imap_decode(s):
-    def sub(m):
-        ss = m.groups(1)[0]
-        if not ss:
-            return '&'
-        else:
-            ss = ('+'+ss+'-').replace(',', '/')
-            return ss.decode('utf-7')
-    return re.sub('&(.*?)-', sub, s)
-
-def imap_encode(s):
-    def sub(m):
-        ss = m.groups(1)[0]
-        if ss == '&':
-            return '&-'
+class _CombiningTable(dict):
+    '''Translation table for unicode.translate() deleting the combining
+    characters, the table is filled lazily as new characters appear
+    '''
+    def __missing__(self, char):
+        if unicodedata.combining(unichr(char)):
+            value = None
         else:
-            return ss.encode('utf-7').replace('+', '&').replace('/', ',')
-    return re.sub('([^\x20-\x25\x27-\x7e]+|&)', sub, s).encode('ascii', 'replace')
+            value = char
+        self[char] = value
+        return value
 
-def imap_unescape(s):
-    ret = re.sub(r'\\([\\"])', r'\1', s)
-    return ret
+class FilenameSanitizer(object):
+    '''Converts strings into safe filenames
 
-def imap_escape(s):
-    ret = re.sub(r'([\\"])', r'\\\1', s)
-    return ret
+    The string is normalized (NFKD by default) and the diacritics are
+    removed. The UTF-8 encoded result is then translated using the table
+    replacing the characters which are not allowed by the filesystem with
+    '_'. The tables and regular expressions are built only once.
+    '''
+    GOOD_CHARS = {
+        'posix': '!"#\'()+-0123456789:;<=>@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]_abcdefghijklmnopqrstuvwxyz{}/\\',
+        'nt': "!#'()+-0123456789;=@ABCDEFGHIJKLMNOPQRSTUVWXYZ[]_abcdefghijklmnopqrstuvwxyz{}/\\",
+        None: "+-0123456789=@ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz/\\",
+    }
+    MAX_LENGTH = 240
+
+    _combining = _CombiningTable()
+    _underscores = re.compile('_+')
+
+    def __init__(self, osname=os.name, form='NFKD'):
+        good_chars = self.GOOD_CHARS.get(osname, self.GOOD_CHARS[None])
+        self.form = form
+        self._table = ''.join((c in good_chars and c or '_') for c in map(chr, range(256)))
+
+    def removeDiacritics(self, string):
+        if not isinstance(string, unicode):
+            string = unicode(string)
+        if self.form is not None:
+            string = unicodedata.normalize(self.form, string)
+        return string.translate(self._combining)
+
+    def __call__(self, fn):
+        fn = self.removeDiacritics(fn)
+        fn = fn.encode('utf-8', 'replace')
+        fn = fn.translate(self._table)
+        fn = self._underscores.sub('_', fn)
+        return fn[:self.MAX_LENGTH]
+
+_SANITIZER = FilenameSanitizer()
+
+
+def _parseInternalDate(internaldate):
+    '''Returns the local time tuple of the INTERNALDATE string (without
+    quotes) or None if it is None or unparseable
+    '''
+    if not internaldate:
+        return None
+    return imaplib.Internaldate2tuple('INTERNALDATE "%s"' % internaldate)
+
+def _internalDay(internaldate):
+    '''Returns (year, month, day) of the INTERNALDATE string in the time
+    zone of the server or None if it is unparseable
+    '''
+    try:
+        day, month, year = internaldate.strip().split()[0].split('-')
+        return int(year), imaplib.Mon2num[month], int(day)
+    except (AttributeError, ValueError, KeyError, IndexError):
+        return None
+
+_MONTH_NAMES = dict((num, name) for (name, num) in imaplib.Mon2num.iteritems())
+
+def _imapDate(day, shift=0):
+    '''Formats (year, month, day) shifted by `shift` days as the date of
+    the IMAP SEARCH command
+    '''
+    year, month, mday = day
+    t = time.localtime(time.mktime((year, month, mday+shift, 12, 0, 0, 0, 0, -1)))
+    return '%02d-%s-%04d' % (t.tm_mday, _MONTH_NAMES[t.tm_mon], t.tm_year)
 
 def _removeDiacritics(string):
     '''Removes any diacritics from `string`
     '''
-    if not isinstance(string, unicode):
-        string = unicode(string)
-    string = unicodedata.normalize('NFKD', string)
+    return _SANITIZER.removeDiacritics(string)
 
-    output = ''
-    for c in string:
-        if not unicodedata.combining(c):
-            output += c
-    return output
+class RateMeter(object):
+    '''Rolling transfer rate over the last `window` seconds
+
+    The transferred amounts are accumulated in a ring buffer of one-second
+    buckets together with their running sum, so both update() and rate()
+    take constant time. The meter also limits how often the rate is
+    rendered, see shouldRender().
+    '''
+    def __init__(self, window=SPEED_AVERAGE_TIME, interval=RENDER_INTERVAL):
+        self.window = int(window)
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self._buckets = [0] * self.window
+        self._second = None
+        self._sum = 0
+        self._start = None
+        self._lastRender = None
+        self.total = 0
+
+    def _advance(self, now):
+        second = int(now)
+        if self._second is None:
+            self._second = second
+            return
+        gap = second - self._second
+        if gap <= 0:
+            return
+        if gap >= self.window:
+            self._buckets = [0] * self.window
+            self._sum = 0
+        else:
+            for i in xrange(self._second+1, second+1):
+                idx = i % self.window
+                self._sum -= self._buckets[idx]
+                self._buckets[idx] = 0
+        self._second = second
+
+    def update(self, amount, now=None):
+        if now is None:
+            now = time.time()
+        if self._start is None:
+            self._start = now
+        self._advance(now)
+        self._buckets[self._second % self.window] += amount
+        self._sum += amount
+        self.total += amount
+
+    def rate(self, now=None):
+        '''Returns the rate in units per second'''
+        if self._start is None:
+            return 0.
+        if now is None:
+            now = time.time()
+        self._advance(now)
+        elapsed = min(now - self._start, self.window)
+        if elapsed <= 0:
+            return 0.
+        return self._sum / elapsed
+
+    def shouldRender(self, now=None):
+        '''Returns True if at least `interval` seconds elapsed since the last
+        rendering'''
+        if now is None:
+            now = time.time()
+        if self._lastRender is None or now - self._lastRender >= self.interval:
+            self._lastRender = now
+            return True
+        return False
 
 class GBNotifier(object):
     def nVersion(self):
@@ -253,13 +642,31 @@ class GBNotifier(object):
     def nBackup(self, end, mailbox, directory):
         pass
 
+    def nDaemon(self, end, mailbox, directory):
+        pass
+
     def nRestore(self, end, mailbox, directory):
         pass
 
     def nClear(self, end, mailbox):
         pass
 
-    def nEmailBackup(self, from_address, subject, num, total):
+    def nVerify(self, end, mailbox, directory):
+        pass
+
+    def nVerifyProgress(self, num, total):
+        pass
+
+    def nVerifyProblem(self, kind, name):
+        pass
+
+    def nVerifySummary(self, result):
+        pass
+
+    def nBackupPlan(self, count, size, examined, total):
+        pass
+
+    def nEmailBackup(self, from_address, subject, num, total, size=0):
         pass
 
     def nEmailBackupSkip(self, num, total, skipped, total_to_skip):
@@ -301,20 +708,26 @@ class GBNotifier(object):
     def getPercentage(self):
         pass
 
+    def getETA(self):
+        pass
+
     def updateSpeed(self):
         pass
 
 class ConsoleNotifier(GBNotifier):
     FATAL_ERRORS = [socket.error, imaplib.IMAP4.abort, imaplib.IMAP4.error, KeyboardInterrupt]
+    RENDER_INTERVAL = RENDER_INTERVAL
 
     def __init__(self, *args, **kwargs):
         super(ConsoleNotifier, self).__init__(*args, **kwargs)
         self._resetCounters()
 
     def _resetCounters(self):
-        self._speed = []
-        self._total = 0
+        self._meter = RateMeter(SPEED_AVERAGE_TIME, self.RENDER_INTERVAL)
         self._percentage = None
+        self._planSize = None
+        self._planDone = 0
+        self._planStart = None
 
     def uprint(self, msg):
         try:
@@ -336,35 +749,33 @@ class ConsoleNotifier(GBNotifier):
         self.nLog(_("GMail Backup revision %s (%s)") % (GMB_REVISION, GMB_DATE))
 
     def nSpeed(self, amount, d):
-        self._total += amount
-        self._speed.insert(0, (amount, d))
-        d_sum = 0
-        for idx, (a, d) in enumerate(self._speed):
-            d_sum += d
-            if d_sum > SPEED_AVERAGE_TIME:
-                break
-        del self._speed[idx+1:]
-        self.updateSpeed()
+        self._meter.update(amount)
+        if self._meter.shouldRender():
+            self.updateSpeed()
 
     def getSpeed(self):
-        a_sum = 0
-        d_sum = 0
-        for a, d in self._speed:
-            d_sum += d
-            a_sum += a
-        if d_sum == 0:
-            return 0
-        else:
-            return (a_sum/d_sum)/1024.
+        return self._meter.rate()/1024.
 
     def getTotal(self):
-        return self._total/1024./1024.
+        return self._meter.total/1024./1024.
 
     def getPercentage(self):
         return self._percentage
 
+    def getETA(self):
+        '''Returns the estimated remaining time of the download as h:mm:ss
+        or None if it is not known'''
+        if not self._planSize or not self._planDone:
+            return None
+        elapsed = time.time() - self._planStart
+        return _formatElapsed(elapsed * (self._planSize - self._planDone) / self._planDone)
+
     def updateSpeed(self):
-        self.uprint2(_("%1.fKB/s (total: %.2fMB)") % (self.getSpeed(), self.getTotal()))
+        eta = self.getETA()
+        if eta is None:
+            self.uprint2(_("%1.fKB/s (total: %.2fMB)") % (self.getSpeed(), self.getTotal()))
+        else:
+            self.uprint2(_("%1.fKB/s (total: %.2fMB, remaining %s)") % (self.getSpeed(), self.getTotal(), eta))
 
     def nBackup(self, end, mailbox, directory):
         if not end:
@@ -374,6 +785,13 @@ class ConsoleNotifier(GBNotifier):
         else:
             self.uprint(_("Ending backup of account %s") % (mailbox, ))
 
+    def nDaemon(self, end, mailbox, directory):
+        if not end:
+            self._resetCounters()
+            self.uprint(_("Watching account %s for new messages, storing them into %s") % (mailbox, directory))
+        else:
+            self.uprint(_("Stopped watching account %s") % (mailbox, ))
+
     def nRestore(self, end, mailbox, directory):
         if not end:
             self._resetCounters()
@@ -388,8 +806,53 @@ class ConsoleNotifier(GBNotifier):
         else:
             self.uprint(_("End of clearing of account %s") % (mailbox, ))
 
-    def nEmailBackup(self, from_address, subject, num, total):
+    def nVerify(self, end, mailbox, directory):
+        if not end:
+            self._resetCounters()
+            self.uprint(_("Verifying the backup in %s") % (directory, ))
+        else:
+            self.uprint(_("End of verifying of the backup in %s") % (directory, ))
+
+    def nVerifyProgress(self, num, total):
         self._percentage = float(num)/total*100
+        if self._meter.shouldRender() or num == total:
+            self.uprint2(_("Verified %4.1f%% (%d of %d)") % (self._percentage, num, total))
+
+    def nVerifyProblem(self, kind, name):
+        messages = {
+            'missing': _("Missing message: %s"),
+            'corrupt': _("Corrupt message: %s"),
+            'extra': _("Message not in the catalog: %s"),
+            'not_stored': _("Message on the server not in the backup: %s"),
+        }
+        self.uprint(messages[kind] % (name, ))
+
+    def nVerifySummary(self, result):
+        self.uprint(_("Checked %d messages: %d missing, %d corrupt, %d not in the catalog, %d without checksum") \
+                    % (result.checked, len(result.missing), len(result.corrupt), len(result.extra), len(result.unchecked)))
+        if result.server is not None:
+            self.uprint(_("Server has %d messages: %d not in the backup, %d stored only in the backup") \
+                        % (result.server, len(result.not_stored), len(result.local_only)))
+
+    def nBackupPlan(self, count, size, examined, total):
+        # The plan grows while the messages are examined, the messages not
+        # examined yet are expected to be like the examined ones
+        self._planSize = size * float(total) / examined
+        if self._planStart is None:
+            self._planStart = time.time()
+            if examined < total:
+                self.uprint(_("Downloading about %d messages (%.2fMB)") % (count * total // examined, self._planSize/1024./1024.))
+            else:
+                self.uprint(_("Downloading %d messages (%.2fMB)") % (count, size/1024./1024.))
+
+    def nEmailBackup(self, from_address, subject, num, total, size=0):
+        # The progress is measured in bytes if the size of the download is
+        # known, one large message takes longer than many small ones
+        self._planDone += size
+        if self._planSize:
+            self._percentage = min(float(self._planDone)/self._planSize*100, 100.)
+        else:
+            self._percentage = float(num)/total*100
         self.uprint(_("Stored %4.1f%% (%d of %d): %s - %s") % (self._percentage, num, total, from_address, subject))
 
     def nEmailBackupSkip(self, num, total, skipped, total_to_skip):
@@ -448,11 +911,21 @@ class ConsoleNotifier(GBNotifier):
         self.nExceptionMsg(msg, e_type, e_value, e_tb)
 
 class MyIMAP4_SSL(imaplib.IMAP4_SSL):
-    '''Hack for bad implementation of sock._recv() under windows'''
+    '''Hack for bad implementation of sock._recv() under windows
+
+    The connection does its own buffering instead of the file object created
+    by imaplib. The literals are read directly into one preallocated
+    bytearray using recv_into(), the size of the reads grows while the
+    socket delivers full chunks. The data are sent through buffer() slices
+    without copying.
+    '''
     def open(self, *args, **kwargs):
         imaplib.IMAP4_SSL.open(self, *args, **kwargs)
         self.sock.settimeout(SOCKET_TIMEOUT)
         self._t1 = time.time()
+        self._rbuf = ''
+        self._chunk = READ_CHUNK_MIN
+        self._zeroCopy = hasattr(self.sslobj, 'recv_into') and sys.version_info[:2] >= (2, 7)
 
     def setNotifier(self, notifier):
         self.notifier = notifier
@@ -462,34 +935,444 @@ class MyIMAP4_SSL(imaplib.IMAP4_SSL):
             d = t2 - t1
             self.notifier.nSpeed(amount, d)
 
+    def _received(self, requested, amount):
+        t2 = time.time()
+        self._nSpeed(self._t1, t2, amount)
+        self._t1 = t2
+        if amount >= requested:
+            self._chunk = min(self._chunk * 2, READ_CHUNK_MAX)
+
+    def _recv(self):
+        requested = self._chunk
+        data = self.sslobj.read(requested)
+        if not data:
+            raise self.abort('socket error: EOF')
+        self._received(requested, len(data))
+        return data
+
+    def readline(self):
+        buf = self._rbuf
+        start = 0
+        while True:
+            idx = buf.find('\n', start)
+            if idx >= 0:
+                self._rbuf = buf[idx+1:]
+                return buf[:idx+1]
+            start = len(buf)
+            buf += self._recv()
+
     def read(self, size):
-        step = 1024 * 32
-        ret = []
+        if not self._zeroCopy:
+            return self._readCopy(size)
+        ret = bytearray(size)
+        view = memoryview(ret)
+        pos = min(len(self._rbuf), size)
+        ret[:pos] = self._rbuf[:pos]
+        self._rbuf = self._rbuf[pos:]
+        while pos < size:
+            requested = min(size - pos, self._chunk)
+            n = self.sslobj.recv_into(view[pos:], requested)
+            if not n:
+                raise self.abort('socket error: EOF')
+            self._received(requested, n)
+            pos += n
+        return str(ret)
+
+    def _readCopy(self, size):
+        ret = [self._rbuf[:size]]
+        self._rbuf = self._rbuf[size:]
+        size -= len(ret[0])
         while size > 0:
-            part = imaplib.IMAP4_SSL.read(self, min(size, step))
-            t2 = time.time()
-            ret.append(part)
-            self._nSpeed(self._t1, t2, len(part))
-            self._t1 = t2
-            size -= step
+            part = self._recv()
+            ret.append(part[:size])
+            self._rbuf = part[size:]
+            size -= len(part)
         return ''.join(ret)
 
     def send(self, data):
-        step = 1024 * 32
         idx = 0
         while idx < len(data):
-            part = data[idx:idx+step]
+            part = buffer(data, idx, SEND_CHUNK)
             imaplib.IMAP4_SSL.send(self, part)
             t2 = time.time()
             self._nSpeed(self._t1, t2, len(part))
             self._t1 = t2
-            idx += step
+            idx += SEND_CHUNK
+
+    def esearch(self, returns, *criteria):
+        '''Sends UID SEARCH RETURN (`returns`) (ESEARCH, RFC 4731), returns
+        the dictionary parsed by parseEsearch()'''
+        typ, dat = self.uid('SEARCH', 'RETURN', '(%s)' % ' '.join(returns), *criteria)
+        typ, dat = self._untagged_response(typ, dat, 'ESEARCH')
+        if typ != 'OK':
+            raise self.error('SEARCH command error: %s %s' % (typ, dat))
+        return typ, parseEsearch(dat)
+
+    def enable(self, capability):
+        '''Sends ENABLE command (RFC 5161), imaplib doesn't know it'''
+        imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+        return self._simple_command('ENABLE', capability)
+
+    _idleChange = re.compile(r'^\d+ (EXISTS|EXPUNGE|FETCH)\b')
+
+    def _idleLine(self, responses):
+        line = self.readline()
+        if line.startswith('* '):
+            line = line[2:].strip()
+            if line.startswith('BYE'):
+                raise self.abort(line)
+            responses.append(line)
+        return line
+
+    def idle(self, timeout):
+        '''Waits in IDLE state (RFC 2177) at most `timeout` seconds until the
+        server reports a change of the selected mailbox
+
+        Returns the list of untagged responses received during the IDLE.
+        '''
+        tag = self._new_tag()
+        del self.tagged_commands[tag]
+        self.send('%s IDLE\r\n' % tag)
+        responses = []
+        while True:
+            line = self._idleLine(responses)
+            if line.startswith('+'):
+                break
+            if line.startswith(tag + ' '):
+                raise self.error('IDLE command error: %s' % line.strip())
+        end = time.time() + timeout
+        while True:
+            pending = getattr(self.sslobj, 'pending', None)
+            if '\n' not in self._rbuf and not (pending is not None and pending()):
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                ready, foo, foo = select([self.sock], [], [], remaining)
+                if not ready:
+                    break
+            line = self._idleLine(responses)
+            if self._idleChange.match(line):
+                break
+        self.send('DONE\r\n')
+        while True:
+            line = self._idleLine(responses)
+            if line.startswith(tag + ' '):
+                items = line.split(' ', 2)
+                if len(items) < 2 or items[1] != 'OK':
+                    raise self.error('IDLE command error: %s' % line.strip())
+                return responses
+
+class IMAPCommand(object):
+    '''IMAP command sent through the IMAPPipeline
+
+    The untagged responses received for this command are stored in
+    `untagged` dictionary in the same form as `imaplib` stores them.
+    '''
+    def __init__(self, pipeline, tag, name):
+        self.pipeline = pipeline
+        self.tag = tag
+        self.name = name
+        # The responses of UID commands are named by the second word
+        self.response = name.split()[-1]
+        self.untagged = {}
+        self.typ = None
+        self.text = None
+
+    def isComplete(self):
+        return self.typ is not None
+
+    def result(self):
+        '''Returns pair (typ, data) like the methods of `imaplib.IMAP4`'''
+        if self.typ == 'BAD':
+            raise self.pipeline.con.error('%s command error: %s %s' % (self.name, self.typ, self.text))
+        if self.typ != 'OK':
+            return self.typ, [self.text]
+        return self.typ, self.untagged.get(self.response, [None])
+
+class IMAPPipeline(object):
+    '''Pipelined IMAP transport on top of logged in MyIMAP4_SSL connection
+
+    The commands are sent immediately with their own tags, without waiting
+    for the completion of the previous ones. The incoming responses are
+    demultiplexed according to the tags, untagged responses are assigned to
+    the oldest command in flight (the server responds in the order of
+    commands).
+
+    The pipeline takes over the reading from the connection, so no other
+    commands may be issued through `imaplib` until the pipeline is closed.
+    '''
+    Untagged_status = re.compile(r'(?P<num>\d+) (?P<type>[A-Z-]+)( (?P<data>.*))?$')
+    Untagged_response = re.compile(r'(?P<type>[A-Z-]+)( (?P<data>.*))?$')
+    Literal = re.compile(r'.*{(?P<size>\d+)}$')
+
+    def __init__(self, con):
+        self.con = con
+        self.sock = con.sock
+        self.sslobj = con.sslobj
+        self._commands = []
+        self._byTag = {}
+        self._buf = ''
+        self._pos = 0
+        self._parts = []
+        self._literal = None
+        self.unsolicited = []
+        # Take over the data already read by the connection
+        self._buf = con._rbuf
+        con._rbuf = ''
+
+    def close(self):
+        '''Returns the unprocessed data back to the connection'''
+        self.con._rbuf = self._buf[self._pos:] + self.con._rbuf
+        self._buf = ''
+        self._pos = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def command(self, name, *args):
+        tag = self.con._new_tag()
+        del self.con.tagged_commands[tag]
+        command = IMAPCommand(self, tag, name)
+        data = ' '.join((tag, name) + tuple(str(a) for a in args))
+        self.con.send('%s\r\n' % data)
+        self._commands.append(command)
+        self._byTag[tag] = command
+        return command
+
+    def hasPending(self):
+        return bool(self._commands)
+
+    def hasBuffered(self):
+        pending = getattr(self.sslobj, 'pending', None)
+        return pending is not None and pending() > 0
+
+    def process(self):
+        '''Reads the available data and dispatches the complete responses'''
+        data = self.sslobj.read(PIPELINE_RECV)
+        if not data:
+            raise self.con.abort('socket error: EOF')
+        self.con._received(PIPELINE_RECV, len(data))
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        self._buf += data
+        self._feed()
+
+    def _feed(self):
+        buf = self._buf
+        while True:
+            if self._literal is not None:
+                end = self._pos + self._literal
+                if len(buf) < end:
+                    return
+                self._parts[-1] = (self._parts[-1], buf[self._pos:end])
+                self._pos = end
+                self._literal = None
+                continue
+            idx = buf.find('\r\n', self._pos)
+            if idx < 0:
+                return
+            line = buf[self._pos:idx]
+            self._pos = idx + 2
+            self._parts.append(line)
+            match = self.Literal.match(line)
+            if match:
+                self._literal = int(match.group('size'))
+                continue
+            parts = self._parts
+            self._parts = []
+            self._dispatch(parts)
+
+    def _dispatch(self, parts):
+        first = parts[0]
+        if isinstance(first, tuple):
+            line = first[0]
+        else:
+            line = first
+
+        if line.startswith('* '):
+            line = line[2:]
+            match = self.Untagged_status.match(line)
+            if match:
+                typ = match.group('type')
+                dat = match.group('num')
+                if match.group('data'):
+                    dat = '%s %s' % (dat, match.group('data'))
+            else:
+                match = self.Untagged_response.match(line)
+                if not match:
+                    raise self.con.abort("unexpected response: '%s'" % line)
+                typ = match.group('type')
+                dat = match.group('data') or ''
+            if typ == 'BYE':
+                raise self.con.abort(dat)
+            if isinstance(first, tuple):
+                data = [(dat, first[1])] + parts[1:]
+            else:
+                data = [dat]
+            if self._commands:
+                self._commands[0].untagged.setdefault(typ, []).extend(data)
+            else:
+                self.unsolicited.append((typ, data))
+        elif line.startswith('+'):
+            raise self.con.error("unexpected continuation response: '%s'" % line)
+        else:
+            items = line.split(' ', 2)
+            command = self._byTag.pop(items[0], None)
+            if command is None or len(items) < 2:
+                raise self.con.abort("unexpected tagged response: '%s'" % line)
+            command.typ = items[1]
+            if len(items) > 2:
+                command.text = items[2]
+            else:
+                command.text = ''
+            self._commands.remove(command)
+
+class IMAPLoop(object):
+    '''Event loop driving one or more IMAPPipeline objects
+
+    Many connections may share the loop, the data are read only from the
+    connections which are readable according to select().
+    '''
+    def __init__(self, pipelines=[]):
+        self.pipelines = list(pipelines)
+
+    def add(self, pipeline):
+        self.pipelines.append(pipeline)
+
+    def remove(self, pipeline):
+        self.pipelines.remove(pipeline)
+
+    def poll(self, timeout=SOCKET_TIMEOUT):
+        '''Processes the data of the readable pipelines, returns False if
+        there is no command in flight'''
+        active = [p for p in self.pipelines if p.hasPending()]
+        if not active:
+            return False
+        ready = [p for p in active if p.hasBuffered()]
+        if not ready:
+            ready, foo, foo = select(active, [], [], timeout)
+            if not ready:
+                raise socket.timeout('timed out')
+        for p in ready:
+            p.process()
+        return True
+
+    def wait(self, command):
+        while not command.isComplete():
+            if not self.poll():
+                raise command.pipeline.con.abort('command %s lost' % command.tag)
+        return command
+
+    def waitAll(self):
+        while self.poll():
+            pass
+
+class AdaptiveLimit(object):
+    '''Limit adjusted according to the observed throughput and errors
+
+    The limit (number of commands in flight, number of connections) is
+    increased by one after every window of `value()` successful operations
+    as long as the throughput grows. If the throughput drops, the limit is
+    decreased by one. Throttling responses, aborts and timeouts halve the
+    limit (additive increase, multiplicative decrease).
+    '''
+    FAILURE_FACTOR = {'quota': 0., 'throttle': 0.5, 'timeout': 0.5, 'abort': 0.5, 'network': 0.75}
+
+    def __init__(self, initial, minimum=1, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._limit = initial
+        self._lock = threading.Lock()
+        self._resetWindow()
+        self._lastRate = None
+
+    def _resetWindow(self):
+        self._count = 0
+        self._amount = 0
+        self._duration = 0.
+
+    def _setLimit(self, limit):
+        limit = max(limit, self.minimum)
+        if self.maximum is not None:
+            limit = min(limit, self.maximum)
+        if limit != self._limit:
+            self._limit = limit
+            self._lastRate = None
+        self._resetWindow()
+
+    def value(self):
+        return self._limit
+
+    def success(self, amount=0, duration=0.):
+        self._lock.acquire()
+        try:
+            self._count += 1
+            self._amount += amount
+            self._duration += duration
+            if self._count < self._limit:
+                return
+            if self._duration > 0:
+                rate = self._amount / self._duration
+            else:
+                rate = None
+            if rate is None or self._lastRate is None or rate >= self._lastRate:
+                last_rate = rate
+                self._setLimit(self._limit + 1)
+            else:
+                last_rate = None
+                self._setLimit(self._limit - 1)
+            self._lastRate = last_rate
+        finally:
+            self._lock.release()
+
+    def failure(self, kind):
+        factor = self.FAILURE_FACTOR.get(kind)
+        if factor is None:
+            return
+        self._lock.acquire()
+        try:
+            self._setLimit(int(self._limit * factor))
+        finally:
+            self._lock.release()
+
+class MessageInfo(object):
+    '''Message-ID, size in bytes and the INTERNALDATE string of a message on
+    the server
+    '''
+    __slots__ = ['msg_id', 'size', 'internaldate']
+
+    def __init__(self, msg_id, size, internaldate):
+        self.msg_id = msg_id
+        self.size = size
+        self.internaldate = internaldate
+
+def _sizeBatches(items, size=FETCH_BATCH_SIZE, count=FETCH_BATCH_COUNT):
+    '''Groups the pairs (num, info) into batches downloaded by one FETCH
+
+    The small messages are grouped until the total size of the batch
+    reaches `size` or it has `count` messages, the messages larger than
+    `size` are downloaded alone.
+    '''
+    batch = []
+    batch_size = 0
+    for num, info in items:
+        if batch and (batch_size + info.size > size or len(batch) >= count):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append((num, info))
+        batch_size += info.size
+    if batch:
+        yield batch
 
 class GMailConnection(object):
     ALL_MAILS = None
     TRASH = None
     OK = 'OK'
 
+    SPECIAL_USE = {'\\all': 'all_mail', '\\allmail': 'all_mail', '\\trash': 'trash'}
+
     MAILBOX_NAMES = {
         'en_us': ('[Gmail]/All Mail', '[Gmail]/Trash'),
         'en_uk': ('[Gmail]/All Mail', '[Gmail]/Bin'),
@@ -590,10 +1473,18 @@ class GMailConnection(object):
         if lang is not None:
             self.setLanguage(lang)
         self._lastMailbox = None
-        self._lastSearch = None
         self._lastFetched = None
         self._lastFetchedMsg = None
         self._wasLogged = False
+        self._quotaPauses = 0
+        self.depth = AdaptiveLimit(PIPELINE_DEPTH, 1, MAX_PIPELINE_DEPTH)
+        self.onPause = None
+        self.onLayout = None
+        self._layoutCached = False
+        self.condstore = False
+        self.persistent = False
+        self._lastUsed = 0
+        self.capabilities = set()
 
     def recoverableError(self, e):
         if isinstance(e, (socket.error, imaplib.IMAP4_SSL.abort, socket.timeout)):
@@ -602,18 +1493,59 @@ class GMailConnection(object):
             str_e = str(e)
             if self._wasLogged and 'Invalid credentials' in str_e:
                 return True
+            if _classifyError(e) == 'throttle':
+                return True
         return False
 
-    def guessLanguage(self):
+    def _recover(self, e):
+        '''Handles the error `e` of IMAP command, returns if the command
+        could be repeated, otherwise it raises `e`
+        '''
+        kind = _classifyError(e)
+        self.depth.failure(kind)
+        if kind == 'quota':
+            self.pauseForQuota(e)
+        elif self.recoverableError(e):
+            self.notifier.nLog(_("Network error occured, disconnected"))
+            if not self.reconnect():
+                raise e
+        else:
+            raise e
+
+    def _checkLimits(self, typ, data):
+        '''Raises an error if the NO response signals the Gmail limits'''
+        if typ != 'NO':
+            return
+        e = self.con.error(' '.join(str(i) for i in data))
+        if _classifyError(e) in ('quota', 'throttle'):
+            raise e
+
+    def pauseForQuota(self, e):
+        '''Pauses the work after exceeding the Gmail quota and reconnects
+
+        Before the pause the `onPause` callback is called with the time of
+        the planned resume, so that the caller can persist its checkpoint.
+        '''
+        self._quotaPauses += 1
+        if self._quotaPauses > MAX_QUOTA_PAUSES:
+            raise e
+        resume_after = time.time() + QUOTA_PAUSE
+        if self.onPause is not None:
+            self.onPause(resume_after)
+        self.notifier.nLog(_("Gmail bandwidth limit exceeded, pausing until %s") % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(resume_after)))
+        time.sleep(QUOTA_PAUSE)
+        if not self.reconnect():
+            raise e
+
+    def guessLanguage(self, boxes=None):
         present = set()
 
-        status, ret = self.con.list()
-        for i in ret:
-            match = re.match(r'^\(.*\)\s".*"\s"(\[.*\].*)"\s*$', i)
-            if not match:
-                continue
-            box = match.group(1)
-            present.add(box)
+        if boxes is None:
+            status, ret = self.con.list()
+            boxes = parseList(ret)
+        for flags, delimiter, box in boxes:
+            if SYSTEM_MAILBOX.match(box):
+                present.add(box)
 
         for key, (all_mail, trash) in self.MAILBOX_NAMES.iteritems():
             if all_mail in present and trash in present:
@@ -640,27 +1572,170 @@ Possible causes are:
   Thank you''')
         raise ValueError("Cannot access IMAP folders")
 
+    def discoverLayout(self):
+        '''Returns the layout dictionary with the names of 'all_mail' and
+        'trash' mailboxes and the 'lang' (None if the names are not in
+        MAILBOX_NAMES)
+
+        The mailboxes are found by their SPECIAL-USE attributes \\All and
+        \\Trash (RFC 6154), the language is guessed from MAILBOX_NAMES only
+        if the server doesn't mark them.
+        '''
+        status, ret = self.con.list()
+        boxes = parseList(ret)
+        special = {}
+        for flags, delimiter, box in boxes:
+            for flag in flags:
+                key = self.SPECIAL_USE.get(flag.lower())
+                if key is not None:
+                    special.setdefault(key, box)
+        if 'all_mail' in special and 'trash' in special:
+            special['lang'] = None
+            for lang, names in self.MAILBOX_NAMES.iteritems():
+                if names == (special['all_mail'], special['trash']):
+                    special['lang'] = lang
+                    break
+            return special
+        lang = self.guessLanguage(boxes)
+        all_mail, trash = self.MAILBOX_NAMES[lang]
+        return {'all_mail': all_mail, 'trash': trash, 'lang': lang}
+
     def setLanguage(self, lang):
-        self.lang = lang
-        self.ALL_MAILS = self.MAILBOX_NAMES[lang][0]
-        self.TRASH = self.MAILBOX_NAMES[lang][1]
-    
+        all_mail, trash = self.MAILBOX_NAMES[lang]
+        self.setLayout({'all_mail': all_mail, 'trash': trash, 'lang': lang})
+
+    def setLayout(self, layout, cached=False):
+        '''Uses the mailboxes of the `layout` dictionary (see
+        discoverLayout()), the `cached` layout is revalidated when the
+        mailbox cannot be selected'''
+        self.lang = layout.get('lang')
+        self.ALL_MAILS = layout['all_mail']
+        self.TRASH = layout['trash']
+        self._layoutCached = cached
+
+    def layout(self):
+        return {'all_mail': self.ALL_MAILS, 'trash': self.TRASH, 'lang': self.lang}
+
+    def _updateLayout(self):
+        self.setLayout(self.discoverLayout())
+        if self.onLayout is not None:
+            self.onLayout(self.layout())
+
     def connect(self, noguess=False):
         self.con = MyIMAP4_SSL('imap.gmail.com', 993)
         self.con.setNotifier(self.notifier)
         self.con.login(self.username, self.password)
         self._wasLogged = True
-        if self.lang is None and not noguess:
-            lang = self.guessLanguage()
-            self.setLanguage(lang)
+        self.capabilities = self._readCapabilities()
+        if self.condstore:
+            self._enableCondstore()
+        if self.ALL_MAILS is None and not noguess:
+            self._updateLayout()
 
     def close(self):
         self.con.shutdown()
         del self.con
 
+    def isOpen(self):
+        return hasattr(self, 'con')
+
+    def open(self):
+        '''Connects unless the connection is already open and alive, the
+        connection idle for more than KEEPALIVE seconds is checked by NOOP
+        '''
+        if self.isOpen():
+            if time.time() - self._lastUsed < KEEPALIVE:
+                return
+            try:
+                self.con.noop()
+                self._lastUsed = time.time()
+                return
+            except:
+                if not self.recoverableError(sys.exc_info()[1]):
+                    raise
+                self.drop()
+        self.connect()
+        self._lastUsed = time.time()
+
+    def keepAlive(self):
+        '''Sends NOOP if the open connection is idle for more than KEEPALIVE
+        seconds, the broken connection is reestablished'''
+        if self.isOpen() and time.time() - self._lastUsed >= KEEPALIVE:
+            self._call(self.con.noop)
+
+    def release(self):
+        '''Closes the connection at the end of the work unless it is
+        `persistent` (kept for the next work)'''
+        if not self.persistent and self.isOpen():
+            self.close()
+
+    def drop(self):
+        '''Closes the connection ignoring errors, used if the connection may
+        be in the middle of a command'''
+        if self.isOpen():
+            try:
+                self.con.shutdown()
+            except:
+                pass
+            del self.con
+
+    def _readCapabilities(self):
+        '''Returns the set of the capabilities of the logged in connection'''
+        # The capabilities announced before the login are not complete, the
+        # server usually sends the new ones in the response to LOGIN
+        typ, data = self.con._untagged_response('OK', [None], 'CAPABILITY')
+        if data[-1] is None:
+            try:
+                typ, data = self.con.capability()
+            except imaplib.IMAP4.error:
+                return set(self.con.capabilities)
+        return set(str(data[-1]).upper().split())
+
+    def _enableCondstore(self):
+        '''Asks the server to report HIGHESTMODSEQ of the selected mailboxes
+        (CONDSTORE, RFC 4551)'''
+        if 'CONDSTORE' in self.capabilities and 'ENABLE' in self.capabilities:
+            try:
+                self.con.enable('CONDSTORE')
+            except imaplib.IMAP4.error:
+                pass
+
     def select(self, mailbox):
         self._lastMailbox = mailbox
-        self._call(self.con.select, mailbox)
+        typ, data = self._call(self.con.select, mailbox)
+        if typ != self.OK and self._layoutCached and mailbox in (self.ALL_MAILS, self.TRASH):
+            # The cached layout is out of date (e.g. the language of Gmail
+            # was changed), the mailboxes are discovered again
+            self.notifier.nLog(_("Mailbox %s not found, looking for the mailboxes again") % mailbox)
+            was_all_mail = mailbox == self.ALL_MAILS
+            self._updateLayout()
+            if was_all_mail:
+                mailbox = self.ALL_MAILS
+            else:
+                mailbox = self.TRASH
+            self._lastMailbox = mailbox
+            typ, data = self._call(self.con.select, mailbox)
+        return typ, data
+
+    def selectState(self, mailbox):
+        '''Selects `mailbox` and returns the dictionary with its 'uidvalidity',
+        'uidnext' and 'highestmodseq' (only the values reported by the server)
+        '''
+        self.select(mailbox)
+        ret = {}
+        for name in ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+            values = self.con.untagged_responses.get(name)
+            if values:
+                try:
+                    ret[name.lower()] = int(str(values[-1]).split()[0])
+                except (ValueError, IndexError):
+                    pass
+        return ret
+
+    def idle(self, timeout=IDLE_TIMEOUT):
+        '''Waits at most `timeout` seconds for a change of the selected
+        mailbox, returns the list of untagged responses'''
+        return self._call(self.con.idle, timeout)
 
     def reconnect(self):
         TRY = 1
@@ -668,18 +1743,21 @@ Possible causes are:
         while TRY <= MAX_TRY:
             self.notifier.nLog(_("Trying to reconnect (%d)") % TRY)
             try:
+                # The messages are addressed by UIDs, so the interrupted
+                # command continues after the last processed UID without
+                # repeating the SEARCH
                 self.connect()
                 if self._lastMailbox:
                     self.select(self._lastMailbox)
-                if self._lastSearch:
-                    self.search(self._lastSearch)
                 self.notifier.nLog(_("Reconnected!"))
                 return True
             except:
                 e = sys.exc_info()[1]
                 if self.recoverableError(e):
-                    self.notifier.nLog(_("Not connected, sleeping for %d seconds") % SLEEP_FOR)
-                    time.sleep(sleep)
+                    self.depth.failure(_classifyError(e))
+                    wait = _jittered(sleep)
+                    self.notifier.nLog(_("Not connected, sleeping for %d seconds") % wait)
+                    time.sleep(wait)
                     sleep *= 2
                     TRY += 1
                 else:
@@ -688,60 +1766,197 @@ Possible causes are:
         return False
 
     def fetchMessageId(self, num):
-        typ, data = self._call(self.con.fetch, num, '(BODY.PEEK[HEADER.FIELDS (Message-ID)])')
+        typ, data = self._call(self.con.uid, 'FETCH', num, '(BODY.PEEK[HEADER.FIELDS (Message-ID)])')
+        return self._parseMessageId(num, data)
+
+    def fetchMessageIds(self, nums):
+        '''Returns dictionary mapping message UIDs `nums` to Message-IDs,
+        the Message-IDs are fetched through the pipelined connection'''
+        return dict((num, info.msg_id) for (num, info) in self.fetchMessageInfo(nums).iteritems())
+
+    def fetchMessageInfo(self, nums):
+        '''Returns dictionary mapping message UIDs `nums` to MessageInfo
+
+        The Message-IDs, sizes and internal dates of INFO_CHUNK messages
+        are fetched by one FETCH command through the pipelined connection.
+        '''
+        def chunks():
+            for start in xrange(0, len(nums), INFO_CHUNK):
+                yield messageSet(nums[start:start+INFO_CHUNK])
+        ret = {}
+        missing = []
+        for message_set, command in self.fetchMany(chunks(), '(RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (Message-ID)])'):
+            try:
+                typ, data = command.result()
+                for num, items in parseFetch(data, uid=True):
+                    header = None
+                    for key, value in items.iteritems():
+                        if key.startswith('BODY['):
+                            header = value
+                    info = MessageInfo(self._matchMessageIdHeader(header), int(items.get('RFC822.SIZE') or 0), items.get('INTERNALDATE'))
+                    if info.msg_id is None:
+                        missing.append((num, info))
+                    else:
+                        ret[num] = info
+            except:
+                self.notifier.handleError(_("Error while getting MessageID"))
+        for num, info in missing:
+            try:
+                info.msg_id = self._parseMessageId(num, None)
+                ret[num] = info
+            except:
+                self.notifier.handleError(_("Error while getting MessageID"))
+        return ret
+
+    def _matchMessageId(self, data):
         if data is None or data[0] is None:
+            return None
+        return self._matchMessageIdHeader(data[0][1])
+
+    def _matchMessageIdHeader(self, header):
+        if header is None:
             match = None
         else:
-            match = re.match(r'^.*:\s*<(.*)>$', data[0][1].strip())
+            match = MESSAGE_ID_HEADER.match(header.strip())
         if match:
             # The message has Message-ID stored in it
             imsg_id = match.group(1)
             imsg_id = _onlyAscii(imsg_id)
             return imsg_id
         else:
+            return None
+
+    def _parseMessageId(self, num, data):
+        imsg_id = self._matchMessageId(data)
+        if imsg_id is None:
             # We compute our synthetic Message-ID from the whole message
             mail = self.fetchMessage(num)
             msg = email.message_from_string(mail)
             imsg_id = _parseMsgId(msg)
-            return imsg_id
+        return imsg_id
 
     def fetchMessage(self, num):
         if self._lastFetched == num:
             return self._lastFetchedMsg
         else:
-            typ, data = self._call(self.con.fetch, num, '(BODY.PEEK[])')
+            typ, data = self._call(self.con.uid, 'FETCH', num, '(BODY.PEEK[])')
             mail = data[0][1]
             self._lastFetched = num
             self._lastFetchedMsg = mail
             return mail
     
+    def fetchMany(self, nums, what):
+        '''Pipelined UID FETCH of `what` for all message UIDs `nums`
+
+        Yields pairs (num, command) in the order of `nums`, the result of the
+        FETCH is available through command.result(). The number of commands
+        in flight is adjusted by `self.depth` according to the throughput.
+        The `nums` are consumed lazily, only the commands in flight are kept.
+        After network error the connection is reestablished and only the
+        messages which were not yielded yet are fetched again.
+        '''
+        nums = iter(nums)
+        while True:
+            taken = []
+            fetched = self._fetchPipelined(nums, what, taken)
+            try:
+                for num, command in fetched:
+                    taken.pop(0)
+                    yield num, command
+                return
+            except GeneratorExit:
+                # The pending responses are drained now, not when the
+                # generator is collected, so the errors are not ignored
+                fetched.close()
+                raise
+            except:
+                self._recover(sys.exc_info()[1])
+                nums = itertools.chain(taken, nums)
+
+    def _fetchPipelined(self, nums, what, taken):
+        '''The numbers read from `nums` are appended to the list `taken`'''
+        pipeline = IMAPPipeline(self.con)
+        loop = IMAPLoop([pipeline])
+        queue = []
+        try:
+            t1 = time.time()
+            while True:
+                while len(queue) < self.depth.value():
+                    try:
+                        num = nums.next()
+                    except StopIteration:
+                        break
+                    taken.append(num)
+                    queue.append((num, pipeline.command('UID FETCH', num, what)))
+                if not queue:
+                    break
+                num, command = queue.pop(0)
+                loop.wait(command)
+                self._checkLimits(command.typ, [command.text])
+                t2 = self._lastUsed = time.time()
+                self.depth.success(_dataSize(command.untagged.get('FETCH', [])), t2-t1)
+                t1 = t2
+                yield num, command
+        finally:
+            if queue:
+                # The consumer didn't read all responses, we have to read
+                # them before the connection can be used again
+                try:
+                    loop.waitAll()
+                except (socket.error, imaplib.IMAP4.error):
+                    # The responses are not synchronized with the commands,
+                    # the connection is reestablished by the next open()
+                    self.drop()
+                except:
+                    self.drop()
+                    raise
+            pipeline.close()
+
     def search(self, where):
-        self._lastSearch = where
-        typ, numbers = self._call(self.con.search, None, *where)
-        numbers = numbers[0].split()
-        return numbers
+        '''Returns array('L') of UIDs of the messages in the selected mailbox
+        matching `where`
+
+        If the server supports ESEARCH, the UIDs are returned as the compact
+        sequence set (1:500,502) instead of the list of all numbers.
+        '''
+        if 'ESEARCH' in self.capabilities:
+            typ, result = self._call(self.con.esearch, ['ALL'], *where)
+            return result.get('ALL', array('L'))
+        typ, numbers = self._call(self.con.uid, 'SEARCH', *where)
+        return array('L', (int(match.group()) for match in _DIGITS.finditer(numbers[0] or '')))
+
+    def searchCount(self, where):
+        '''Returns the number of messages in the selected mailbox matching
+        `where`, the UIDs are not transferred if the server supports
+        ESEARCH'''
+        if 'ESEARCH' in self.capabilities:
+            typ, result = self._call(self.con.esearch, ['COUNT'], *where)
+            return result.get('COUNT', 0)
+        return len(self.search(where))
 
     def lsub(self):
+        '''Returns the list of (flags, delimiter, name) of subscribed mailboxes
+        '''
         status, ret = self._call(self.con.lsub)
-        ret = [imap_unescape(i) for i in ret]
-        return ret
+        return parseList(ret)
 
     def list(self):
+        '''Returns the list of (flags, delimiter, name) of all mailboxes
+        '''
         status, ret = self._call(self.con.list)
-        ret = [imap_unescape(i) for i in ret]
-        return ret
+        return parseList(ret)
 
     def create(self, label):
         self._call(self.con.create, label)
 
     def copy(self, message_set, label):
-        self._call(self.con.copy, message_set, label)
+        self._call(self.con.uid, 'COPY', message_set, label)
 
     def append(self, mailbox, flags, msg_date, msg):
         self._call(self.con.append, mailbox, flags, msg_date, msg)
 
     def store(self, nums, state, flags):
-        self._call(self.con.store, nums, state, flags)
+        self._call(self.con.uid, 'STORE', nums, state, flags)
 
     def expunge(self):
         self._call(self.con.expunge)
@@ -756,36 +1971,1410 @@ Possible causes are:
             try:
                 method = getattr(self.con, method_name)
                 ret = method(*args, **kwargs)
+                self._lastUsed = time.time()
+                if isinstance(ret, tuple) and len(ret) == 2:
+                    self._checkLimits(*ret)
                 return ret
             except:
-                e = sys.exc_info()[1]
-                if self.recoverableError(e):
-                    self.notifier.nLog(_("Network error occured, disconnected"))
-                    if not self.reconnect():
-                        raise e
-                else:
-                    raise e
+                self._recover(sys.exc_info()[1])
+
+class Codec(object):
+    '''Compression codec of the stored messages
+
+    The codec is specified as name[:level], the names are 'none', 'deflate',
+    'bz2', 'lzma' (if the lzma module is installed) and 'fast' (deflate at
+    level 1). The compressed messages are stored with the extension of the
+    codec ('.gz', '.bz2' or '.xz'), so the codec of every stored message is
+    known when it is read and backups with mixed codecs stay readable. The
+    zip files contain deflate natively as ZIP_DEFLATED members and the other
+    codecs as ZIP_STORED members with the extension.
+    '''
+    EXTENSIONS = {'none': '', 'deflate': '.gz', 'bz2': '.bz2', 'lzma': '.xz'}
+    LEVELS = {'none': (None, None, None), 'deflate': (6, 0, 9), 'bz2': (9, 1, 9), 'lzma': (6, 0, 9)}
+    ALIASES = {'fast': ('deflate', 1)}
+    _NAMES = {}
+
+    def __init__(self, spec='none'):
+        items = str(spec).strip().lower().split(':', 1)
+        name, level = items[0], None
+        if name in self.ALIASES:
+            name, level = self.ALIASES[name]
+        if name not in self.EXTENSIONS:
+            raise ValueError(_("Unknown compression codec: %s") % spec)
+        if (name == 'bz2' and not bz2) or (name == 'lzma' and not lzma):
+            raise ValueError(_("Compression codec %s is not available, the Python module is not installed") % name)
+        default, minimum, maximum = self.LEVELS[name]
+        if len(items) == 2:
+            try:
+                level = int(items[1])
+            except ValueError:
+                level = None
+            if default is None or level is None or not minimum <= level <= maximum:
+                raise ValueError(_("Bad level of the compression codec: %s") % spec)
+        if level is None:
+            level = default
+        self.name = name
+        self.level = level
+
+    def __str__(self):
+        if self.level is None:
+            return self.name
+        return '%s:%d' % (self.name, self.level)
+
+    def extension(self):
+        return self.EXTENSIONS[self.name]
+
+    def zipExtension(self):
+        if self.name == 'deflate':
+            return ''
+        return self.extension()
+
+    def compress(self, data):
+        '''Returns the content of the file with the compressed `data`'''
+        if self.name == 'deflate':
+            buf = StringIO()
+            try:
+                fw = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=self.level, mtime=0)
+            except TypeError:
+                # Python older than 2.7 does not know the mtime argument
+                fw = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=self.level)
+            fw.write(data)
+            fw.close()
+            return buf.getvalue()
+        elif self.name == 'bz2':
+            return bz2.compress(data, self.level)
+        elif self.name == 'lzma':
+            return lzma.compress(data, preset=self.level)
+        return data
+
+    def compressZip(self, data):
+        '''Returns (payload, compress_type, crc, size) of the zip member with
+        `data`, the CRC and the size are of the uncompressed member
+
+        The deflate members are compressed here at the level of the codec
+        (raw deflate stream, as zip stores it), the other codecs are
+        compressed and stored.
+        '''
+        if self.name == 'deflate':
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            payload = compressor.compress(data) + compressor.flush()
+            return payload, zipfile.ZIP_DEFLATED, zlib.crc32(data) & 0xffffffffL, len(data)
+        payload = self.compress(data)
+        return payload, zipfile.ZIP_STORED, zlib.crc32(payload) & 0xffffffffL, len(payload)
 
-class EmailStorage(object):
     @classmethod
-    def createStorage(cls, fn, notifier):
-        ext = os.path.splitext(fn.split('#')[0])[1]
-        if ext.lower() == '.zip':
-            return ZipStorage(fn, notifier)
-        else:
-            return DirectoryStorage(fn, notifier)
+    def _matchName(cls, fn, filters):
+        name = cls._NAMES.get(filters)
+        if name is None:
+            exts = '|'.join(re.escape(ext) for ext in cls.EXTENSIONS.itervalues() if ext)
+            # (?!) never matches, without filters the group 2 is always None
+            filter_exts = '|'.join(re.escape(ext) for ext in filters) or '(?!)'
+            name = cls._NAMES[filters] = re.compile(r'\.eml(%s)?(%s)?$' % (exts, filter_exts), re.IGNORECASE)
+        return name.search(fn)
 
-    def idsOfMessages(self):
-        '''Returns the set of stored msg_ids'''
+    @classmethod
+    def isMessage(cls, fn, filters=()):
+        '''Returns True for the stored messages, their names end with '.eml',
+        the extension of the codec and one of the extensions `filters` of the
+        external filters (see FilterChain)
+        '''
+        return cls._matchName(fn, filters) is not None
 
-    def iterBackups(self, since_time=None, before_time=None, logging=True):
-        '''Iterates over backups specified by parameters and yields pairs (storageid, message)'''
+    @classmethod
+    def isCompressed(cls, fn):
+        return not fn.lower().endswith('.eml')
 
-    def store(self, msg):
-        '''Stores message `msg`'''
+    @classmethod
+    def isFiltered(cls, fn, filters=()):
+        '''Returns True if the stored message `fn` was written by an external
+        filter with one of the extensions `filters`'''
+        match = cls._matchName(fn, filters)
+        return match is not None and match.group(2) is not None
 
-    def getLabelAssignment(self):
-        '''Returns label assignment'''
+    @classmethod
+    def unfilteredName(cls, fn, filters=()):
+        '''Returns the name `fn` without the extension of the external filter'''
+        match = cls._matchName(fn, filters)
+        if match is None or match.group(2) is None:
+            return fn
+        return fn[:match.start(2)]
+
+    @classmethod
+    def decode(cls, fn, data):
+        '''Returns the message stored in the file `fn` with the content `data`'''
+        fn = fn.lower()
+        if fn.endswith('.gz'):
+            return gzip.GzipFile(fileobj=StringIO(data), mode='rb').read()
+        elif fn.endswith('.bz2'):
+            if not bz2:
+                raise IOError(_("Cannot read %s, the bz2 module is not installed") % fn)
+            return bz2.decompress(data)
+        elif fn.endswith('.xz'):
+            if not lzma:
+                raise IOError(_("Cannot read %s, the lzma module is not installed") % fn)
+            return lzma.decompress(data)
+        return data
+
+class ThreadJob(object):
+    '''Call of `function` with `args` which is run by another thread'''
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._result = self.function(*self.args)
+        except:
+            self._error = sys.exc_info()
+        self._done.set()
+
+    def isDone(self):
+        return self._done.isSet()
+
+    def join(self, timeout=None):
+        '''Waits at most `timeout` seconds until the job is done'''
+        self._done.wait(timeout)
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class CompressionPool(object):
+    '''Pool of threads running the compression
+
+    zlib, bz2 and lzma release the GIL while compressing, so the messages
+    are compressed in parallel with the IMAP transfer.
+    '''
+    def __init__(self, threads=COMPRESS_THREADS):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(max(threads, 1)):
+            thread = threading.Thread(target=self._worker)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def submit(self, function, *args):
+        job = ThreadJob(function, args)
+        self._queue.put(job)
+        return job
+
+    def close(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+def _splitChain(spec):
+    '''Returns the argument lists of the commands of the filter chain `spec`
+
+    The commands are separated by '|' tokens, a quoted or escaped '|' is a
+    part of the argument. Raises ValueError for an empty command.
+    '''
+    lex = shlex.shlex(spec, posix=True)
+    lex.whitespace += '|'
+    lex.whitespace_split = True
+    lex.commenters = ''
+    commands = [[]]
+    end = 0
+    while True:
+        token = lex.get_token()
+        # The separators are among the whitespace skipped before the token
+        # (including the character which ended the previous token)
+        skipped = max(end-1, 0)
+        while end < len(spec) and spec[end] in lex.whitespace:
+            end += 1
+        for i in range(spec.count('|', skipped, end)):
+            commands.append([])
+        if token is None:
+            break
+        commands[-1].append(token)
+        end = lex.instream.tell()
+    for args in commands:
+        if not args:
+            raise ValueError(_("Empty command in the filter chain: %s") % spec)
+    return commands
+
+class FilterProcess(object):
+    '''Long-lived process of the external filter `method` (ExternalMethod)
+    communicating by frames
+
+    Every message is written to the stdin of the process as the frame
+    "<length>\n<data>" and the process answers on its stdout with the frame
+    of the filtered data in the same format after it has read the whole
+    frame. The process filters the messages until its stdin is closed.
+    '''
+    def __init__(self, method):
+        self.method = method
+        self.process = method.spawn()
+
+    def _error(self, message):
+        retcode = self.process.poll()
+        if retcode is not None:
+            message = '%s (exit status %d)' % (message, retcode)
+        return externals.ExternalError(_("External filter %s: %s") % (self.method.name, message))
+
+    def filter(self, data):
+        '''Returns the `data` filtered by the process'''
+        request = '%d\n%s' % (len(data), data)
+        header = ''
+        chunks = []
+        received = 0
+        length = None
+        output = self.method.pump(self.process, [request], close_stdin=False)
+        try:
+            for chunk in output:
+                if length is None:
+                    header += chunk
+                    if '\n' not in header:
+                        continue
+                    header, chunk = header.split('\n', 1)
+                    if not header.isdigit():
+                        raise self._error(_("bad frame header %r") % header[:20])
+                    length = int(header)
+                chunks.append(chunk)
+                received += len(chunk)
+                if received >= length:
+                    break
+            else:
+                self.process.wait()
+                raise self._error(_("the process ended"))
+        finally:
+            output.close()
+        if received > length:
+            raise self._error(_("unexpected data after the frame"))
+        return ''.join(chunks)
+
+    def close(self):
+        '''Closes the stdin of the process and waits until it ends'''
+        try:
+            # The pipes of the ended process are already closed by pump()
+            if not self.process.stdin.closed:
+                self.process.stdin.close()
+            if not self.process.stderr.closed:
+                for line in self.process.stderr:
+                    self.method._logStderr(line)
+        finally:
+            self.process.wait()
+
+class FilterChain(object):
+    '''Chain of external filters (e.g. encryption) applied to the stored
+    messages
+
+    The chain `spec` is the list of commands separated by '|', for example
+    "gpg --batch --encrypt -r me@example.com". The commands are run as
+    ExternalMethods, ordinary filters as the externals.Pipeline started once
+    per message. If `framed` is True, the commands speak the protocol of
+    FilterProcess and every worker of the pool of `processes` workers keeps
+    one long-lived process of each command, so the filters are not started
+    again for every message. The filters need select() on pipes, so they are
+    supported only on POSIX systems.
+    '''
+    def __init__(self, spec, framed=False, processes=FILTER_PROCESSES):
+        if sys.platform == 'win32':
+            raise ValueError(_("The external filters are not supported on Windows"))
+        self.spec = spec
+        self.framed = framed
+        self.processes = max(processes, 1)
+        self.methods = []
+        for args in _splitChain(spec):
+            self.methods.append(externals.ExternalMethod(args[0], args=args[1:], etype=externals.ExecChunks))
+        self.pipeline = externals.Pipeline(self.methods)
+        self._idle = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def apply(self, data):
+        '''Returns the `data` filtered by the chain, it may be called from
+        several threads'''
+        if not self.framed:
+            # The last method of the pipeline returns its output as a string
+            return self.pipeline.execute(stdin=[data])
+        worker = self._getWorker()
+        try:
+            for process in worker:
+                data = process.filter(data)
+        except:
+            # The state of the processes is unknown, they are not reused
+            self._discard(worker)
+            raise
+        self._idle.put(worker)
+        return data
+
+    def _getWorker(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self._lock.acquire()
+        try:
+            if len(self._workers) < self.processes:
+                worker = []
+                try:
+                    for method in self.methods:
+                        worker.append(FilterProcess(method))
+                except:
+                    self._closeWorker(worker)
+                    raise
+                self._workers.append(worker)
+                return worker
+        finally:
+            self._lock.release()
+        return self._idle.get()
+
+    def _closeWorker(self, worker):
+        for process in worker:
+            try:
+                process.close()
+            except (IOError, OSError):
+                pass
+
+    def _discard(self, worker):
+        self._lock.acquire()
+        try:
+            if worker in self._workers:
+                self._workers.remove(worker)
+        finally:
+            self._lock.release()
+        self._closeWorker(worker)
+
+    def close(self):
+        '''Stops the long-lived filter processes'''
+        self._lock.acquire()
+        try:
+            workers = self._workers
+            self._workers = []
+            self._idle = Queue.Queue()
+        finally:
+            self._lock.release()
+        for worker in workers:
+            self._closeWorker(worker)
+
+
+class _StageEnd(object):
+    '''End of the stream of items in the StagePipeline'''
+    pass
+
+class _StageFailure(object):
+    '''Exception raised by the source or a stage, re-raised by the consumer'''
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class StagePipeline(object):
+    '''Pipeline of the stages connected by bounded queues
+
+    The items of the `source` iterable are read by one thread, passed
+    through the `stages` functions, each running in its own thread, and
+    yielded by iterating over the pipeline in the original order. The
+    queues between the stages hold at most `size` items, so the slow
+    consumer throttles the source and the stages (backpressure).
+
+    Exceptions raised by the source or a stage are re-raised in the
+    consuming thread. If the consumer stops iterating, the pipeline is
+    stopped and the source is closed.
+    '''
+    def __init__(self, source, stages=[], size=STAGE_QUEUE):
+        self.source = source
+        self.stages = list(stages)
+        self.size = size
+        self._stopped = threading.Event()
+        self._threads = []
+        self._outputs = {}
+
+    def _put(self, queue, item):
+        while not self._stopped.isSet():
+            try:
+                queue.put(item, True, STAGE_POLL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _get(self, queue):
+        while True:
+            try:
+                return queue.get(True, STAGE_POLL)
+            except Queue.Empty:
+                if self._stopped.isSet():
+                    return _StageEnd()
+
+    def _runSource(self, output):
+        iterator = iter(self.source)
+        try:
+            try:
+                for item in iterator:
+                    if not self._put(output, item):
+                        break
+            except:
+                self._put(output, _StageFailure(sys.exc_info()))
+        finally:
+            if self._stopped.isSet() and hasattr(iterator, 'close'):
+                try:
+                    iterator.close()
+                except:
+                    pass
+            self._put(output, _StageEnd())
+
+    def _runStage(self, function, input, output):
+        while True:
+            item = self._get(input)
+            if isinstance(item, _StageEnd):
+                self._put(output, item)
+                break
+            if not isinstance(item, (_StageFailure, ThreadJob)):
+                try:
+                    item = function(item)
+                except:
+                    item = _StageFailure(sys.exc_info())
+            if not self._put(output, item):
+                break
+
+    def call(self, function, *args):
+        '''Calls function(*args) in the consuming thread after all items
+        passed before the call are consumed and returns its result
+
+        It is used by the source and the stages to synchronize with the
+        consumer, e.g. to flush the storage before a long pause. Outside of
+        the running pipeline the function is called directly.
+        '''
+        output = self._outputs.get(threading.currentThread())
+        if output is None:
+            return function(*args)
+        job = ThreadJob(function, args)
+        if not self._put(output, job):
+            raise RuntimeError(_("The pipeline was stopped"))
+        while not job.isDone():
+            if self._stopped.isSet():
+                raise RuntimeError(_("The pipeline was stopped"))
+            job.join(STAGE_POLL)
+        return job.wait()
+
+    def __iter__(self):
+        queues = [Queue.Queue(self.size) for i in range(len(self.stages)+1)]
+        thread = threading.Thread(target=self._runSource, args=(queues[0],))
+        self._threads.append(thread)
+        self._outputs[thread] = queues[0]
+        for function, input, output in zip(self.stages, queues, queues[1:]):
+            thread = threading.Thread(target=self._runStage, args=(function, input, output))
+            self._threads.append(thread)
+            self._outputs[thread] = output
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+        finished = False
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if isinstance(item, _StageEnd):
+                    finished = True
+                    break
+                elif isinstance(item, _StageFailure):
+                    raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+                elif isinstance(item, ThreadJob):
+                    item.run()
+                else:
+                    yield item
+        finally:
+            self._stopped.set()
+            if finished:
+                for thread in self._threads:
+                    thread.join()
+            self._threads = []
+            self._outputs = {}
+
+
+def _key64(string):
+    '''Returns the 64-bit key of `string` as the pair of 32-bit integers
+    (the prefix of its MD5 digest), the key (0, 0) is never returned'''
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    hi, lo = _KEY_STRUCT.unpack(md5(string).digest()[:8])
+    return hi, lo or 1
+
+_KEY_STRUCT = struct.Struct('<II')
+
+class _MappedFile(object):
+    '''Memory-mapped file kept next to the catalog file of MessageCatalog
+
+    The file is a cache of the catalog file, which serves as its journal.
+    The header of HEADER_SIZE bytes records the length of the journal
+    covered by the file and the flag cleared by the first change after
+    sync(). The file which was not synced is not valid, open() of the
+    subclasses returns None for it.
+    '''
+    HEADER_SIZE = 64
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.journal = 0
+        self._clean = False
+        self._file = None
+        self._map = None
+
+    def _readHeader(self):
+        '''Returns the header of the file or None if it is missing'''
+        self.close()
+        if not os.path.isfile(self.fn):
+            return None
+        fr = file(self.fn, 'rb')
+        try:
+            header = fr.read(self.HEADER_SIZE)
+        finally:
+            fr.close()
+        if len(header) != self.HEADER_SIZE:
+            return None
+        return header
+
+    def _createFile(self, size):
+        '''Creates the file of `size` bytes filled by zeros, the header
+        must be written by the subclass'''
+        self.close()
+        fw = file(self.fn, 'wb')
+        try:
+            fw.seek(size - 1)
+            fw.write('\0')
+        finally:
+            fw.close()
+        self.journal = 0
+        self._clean = False
+        self._mapFile()
+
+    def _mapFile(self):
+        self._file = file(self.fn, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _writeHeader(self):
+        raise TypeError("Abstract method _MappedFile._writeHeader()")
+
+    def _markDirty(self):
+        if self._clean:
+            self._clean = False
+            self._writeHeader()
+            self._map.flush()
+
+    def sync(self, journal):
+        '''Writes the file to the disk as covering `journal` bytes of the
+        journal'''
+        self._map.flush()
+        self.journal = journal
+        self._clean = True
+        self._writeHeader()
+        self._map.flush()
+
+class HashIndex(_MappedFile):
+    '''Memory-mapped open addressing hash index of the MessageCatalog
+
+    The file starts with the header (HEADER) followed by two tables of
+    `capacity` slots. The slots of the id table hold the 64-bit keys (see
+    _key64()) of the message id and of its filename as the quadruples
+    (id_hi, id_lo, fn_hi, fn_lo), the slots of the filename table hold the
+    same keys in the order (fn_hi, fn_lo, id_hi, id_lo). The free slots
+    have the key (0, 0), the removed ones (DELETED, 0). The linear probing
+    starts at the slot lo & (capacity-1).
+
+    The optional array `values` holds one integer per slot of the id table,
+    it is kept only in memory (the catalog stores the labels there).
+    '''
+    MAGIC = 'GMBIDX01'
+    HEADER = struct.Struct('<8sIIIIIQ')
+    ID_SLOT = struct.Struct('<IIII')
+    FILE_SLOT = struct.Struct('<IIII')
+    DELETED = 1
+    MIN_CAPACITY = 1024
+    MAX_LOAD = 0.75
+
+    def __init__(self, fn):
+        super(HashIndex, self).__init__(fn)
+        self.values = None
+        self.capacity = 0
+        self.count = 0
+        self._idUsed = 0
+        self._fileUsed = 0
+
+    @classmethod
+    def capacityFor(cls, count):
+        '''Returns the capacity of the index for `count` keys'''
+        capacity = cls.MIN_CAPACITY
+        while capacity * cls.MAX_LOAD <= count:
+            capacity *= 2
+        return capacity
+
+    @classmethod
+    def _fileSize(cls, capacity):
+        return cls.HEADER_SIZE + capacity * (cls.ID_SLOT.size + cls.FILE_SLOT.size)
+
+    def open(self):
+        '''Maps the index file, returns the length of the journal covered
+        by the index or None if the index is missing or it is not valid'''
+        header = self._readHeader()
+        if header is None:
+            return None
+        magic, clean, capacity, count, id_used, file_used, journal = self.HEADER.unpack_from(header)
+        if magic != self.MAGIC or not clean or capacity < self.MIN_CAPACITY or capacity & (capacity - 1):
+            return None
+        if os.path.getsize(self.fn) != self._fileSize(capacity):
+            return None
+        self.capacity = capacity
+        self.count = count
+        self.journal = journal
+        self._idUsed = id_used
+        self._fileUsed = file_used
+        self._clean = True
+        self._mapFile()
+        return journal
+
+    def create(self, capacity=MIN_CAPACITY):
+        '''Creates the empty index with `capacity` slots'''
+        self._createFile(self._fileSize(capacity))
+        self.capacity = capacity
+        self.count = 0
+        self._idUsed = 0
+        self._fileUsed = 0
+        if self.values is not None:
+            self.values = array('i', [-1]) * capacity
+        self._writeHeader()
+
+    def _writeHeader(self):
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, int(self._clean), self.capacity,
+                              self.count, self._idUsed, self._fileUsed, self.journal)
+
+    def iterKeys(self):
+        '''Iterates over the id keys (hi, lo) of the index'''
+        unpack = self.ID_SLOT.unpack_from
+        for slot in xrange(self.capacity):
+            id_hi, id_lo = unpack(self._map, self._idOffset(slot))[:2]
+            if id_lo != 0:
+                yield id_hi, id_lo
+
+    def enableValues(self):
+        if self.values is None:
+            self.values = array('i', [-1]) * self.capacity
+
+    def _idOffset(self, slot):
+        return self.HEADER_SIZE + slot * self.ID_SLOT.size
+
+    def _fileOffset(self, slot):
+        return self.HEADER_SIZE + self.capacity * self.ID_SLOT.size + slot * self.FILE_SLOT.size
+
+    def findId(self, hi, lo):
+        '''Returns the slot of the id key or -1'''
+        unpack = self.ID_SLOT.unpack_from
+        data = self._map
+        mask = self.capacity - 1
+        slot = lo & mask
+        while True:
+            id_hi, id_lo, fn_hi, fn_lo = unpack(data, self._idOffset(slot))
+            if id_lo == lo and id_hi == hi:
+                return slot
+            if id_lo == 0 and id_hi == 0:
+                return -1
+            slot = (slot + 1) & mask
+
+    def findFile(self, hi, lo):
+        '''Returns the slot of the filename key or -1'''
+        unpack = self.FILE_SLOT.unpack_from
+        data = self._map
+        mask = self.capacity - 1
+        slot = lo & mask
+        while True:
+            fn_hi, fn_lo = unpack(data, self._fileOffset(slot))[:2]
+            if fn_lo == lo and fn_hi == hi:
+                return slot
+            if fn_lo == 0 and fn_hi == 0:
+                return -1
+            slot = (slot + 1) & mask
+
+    def fileKey(self, slot):
+        '''Returns the key of the filename stored in the slot of the id
+        table'''
+        return self.ID_SLOT.unpack_from(self._map, self._idOffset(slot))[2:]
+
+    def idKey(self, slot):
+        '''Returns the key of the id stored in the slot of the filename
+        table'''
+        return self.FILE_SLOT.unpack_from(self._map, self._fileOffset(slot))[2:]
+
+    def setFileKey(self, slot, fn_hi, fn_lo):
+        self._markDirty()
+        id_hi, id_lo = self.ID_SLOT.unpack_from(self._map, self._idOffset(slot))[:2]
+        self.ID_SLOT.pack_into(self._map, self._idOffset(slot), id_hi, id_lo, fn_hi, fn_lo)
+
+    def insertId(self, hi, lo, fn_hi, fn_lo):
+        '''Inserts the id key, which must not be present, returns its slot'''
+        if self._idUsed + 1 >= self.capacity * self.MAX_LOAD:
+            self._grow()
+        self._markDirty()
+        unpack = self.ID_SLOT.unpack_from
+        mask = self.capacity - 1
+        slot = lo & mask
+        while True:
+            id_hi, id_lo = unpack(self._map, self._idOffset(slot))[:2]
+            if id_lo == 0:
+                break
+            slot = (slot + 1) & mask
+        if id_hi == 0:
+            self._idUsed += 1
+        self.ID_SLOT.pack_into(self._map, self._idOffset(slot), hi, lo, fn_hi, fn_lo)
+        if self.values is not None:
+            self.values[slot] = -1
+        self.count += 1
+        return slot
+
+    def insertFile(self, hi, lo, id_hi, id_lo):
+        '''Inserts the filename key, which must not be present, together
+        with the key of its id'''
+        if self._fileUsed + 1 >= self.capacity * self.MAX_LOAD:
+            self._grow()
+        self._markDirty()
+        unpack = self.FILE_SLOT.unpack_from
+        mask = self.capacity - 1
+        slot = lo & mask
+        while True:
+            fn_hi, fn_lo = unpack(self._map, self._fileOffset(slot))[:2]
+            if fn_lo == 0:
+                break
+            slot = (slot + 1) & mask
+        if fn_hi == 0:
+            self._fileUsed += 1
+        self.FILE_SLOT.pack_into(self._map, self._fileOffset(slot), hi, lo, id_hi, id_lo)
+
+    def removeId(self, slot):
+        self._markDirty()
+        self.ID_SLOT.pack_into(self._map, self._idOffset(slot), self.DELETED, 0, 0, 0)
+        self.count -= 1
+
+    def removeFile(self, hi, lo):
+        slot = self.findFile(hi, lo)
+        if slot >= 0:
+            self._markDirty()
+            self.FILE_SLOT.pack_into(self._map, self._fileOffset(slot), self.DELETED, 0, 0, 0)
+
+    def _grow(self):
+        '''Rebuilds the index with the double capacity, the removed slots
+        are dropped'''
+        new = HashIndex(self.fn + '.tmp')
+        if self.values is not None:
+            new.values = array('i')
+        new.create(self.capacity * 2)
+        unpack = self.ID_SLOT.unpack_from
+        for slot in xrange(self.capacity):
+            id_hi, id_lo, fn_hi, fn_lo = unpack(self._map, self._idOffset(slot))
+            if id_lo != 0:
+                new_slot = new.insertId(id_hi, id_lo, fn_hi, fn_lo)
+                if self.values is not None:
+                    new.values[new_slot] = self.values[slot]
+        unpack = self.FILE_SLOT.unpack_from
+        for slot in xrange(self.capacity):
+            fn_hi, fn_lo, id_hi, id_lo = unpack(self._map, self._fileOffset(slot))
+            if fn_lo != 0:
+                new.insertFile(fn_hi, fn_lo, id_hi, id_lo)
+        new.journal = self.journal
+        new._writeHeader()
+        new.close()
+        self.close()
+        os.remove(self.fn)
+        os.rename(new.fn, self.fn)
+        self.capacity = new.capacity
+        self.count = new.count
+        self._idUsed = new._idUsed
+        self._fileUsed = new._fileUsed
+        self.values = new.values
+        self._clean = False
+        self._mapFile()
+
+class BloomFilter(_MappedFile):
+    '''Memory-mapped Bloom filter of the ids of the MessageCatalog
+
+    The filter answers that the id is definitely not in the catalog without
+    probing the HashIndex, it is much smaller than the index, so it stays
+    in the memory even for huge catalogs. The filter has BITS bits per slot
+    of the index (the number of bits is a power of two). The filter is
+    blocked: the low bits of `lo` of the 64-bit key (see _key64()) select
+    one 64-bit word and the id sets 7 bits of the word given by 6-bit
+    slices of `hi` and of the high bits of `lo`, so the test reads one word.
+    The filter is rebuilt from the index when the index grows.
+    '''
+    MAGIC = 'GMBBLM02'
+    HEADER = struct.Struct('<8sIIQ')
+    WORD = struct.Struct('<Q')
+    BITS = 8
+
+    def __init__(self, fn):
+        super(BloomFilter, self).__init__(fn)
+        self.bits = 0
+
+    def open(self):
+        '''Maps the filter file, returns the length of the journal covered
+        by the filter or None if the filter is missing or it is not valid'''
+        header = self._readHeader()
+        if header is None:
+            return None
+        magic, clean, bits, journal = self.HEADER.unpack_from(header)
+        if magic != self.MAGIC or not clean or bits < 64 or bits & (bits - 1):
+            return None
+        if os.path.getsize(self.fn) != self.HEADER_SIZE + bits // 8:
+            return None
+        self.bits = bits
+        self.journal = journal
+        self._clean = True
+        self._mapFile()
+        return journal
+
+    def create(self, index):
+        '''Creates the filter of the ids of the HashIndex `index`'''
+        bits = index.capacity * self.BITS
+        self._createFile(self.HEADER_SIZE + bits // 8)
+        self.bits = bits
+        self._writeHeader()
+        for hi, lo in index.iterKeys():
+            self.add(hi, lo)
+
+    def _writeHeader(self):
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, int(self._clean), self.bits, self.journal)
+
+    def _word(self, hi, lo):
+        '''Returns the offset of the word of the key and the mask of its
+        bits'''
+        offset = self.HEADER_SIZE + ((lo & ((self.bits >> 6) - 1)) << 3)
+        mask = (1 << (hi & 63) | 1 << (hi >> 6 & 63) | 1 << (hi >> 12 & 63) | 1 << (hi >> 18 & 63) |
+                1 << (hi >> 24 & 63) | 1 << (lo >> 20 & 63) | 1 << (lo >> 26))
+        return offset, mask
+
+    def add(self, hi, lo):
+        self._markDirty()
+        offset, mask = self._word(hi, lo)
+        word, = self.WORD.unpack_from(self._map, offset)
+        self.WORD.pack_into(self._map, offset, word | mask)
+
+    def mayContain(self, hi, lo):
+        '''Returns False if the key is definitely not in the filter'''
+        # The same as _word(), it is inlined because it is called for every
+        # examined message
+        offset = self.HEADER_SIZE + ((lo & ((self.bits >> 6) - 1)) << 3)
+        mask = (1 << (hi & 63) | 1 << (hi >> 6 & 63) | 1 << (hi >> 12 & 63) | 1 << (hi >> 18 & 63) |
+                1 << (hi >> 24 & 63) | 1 << (lo >> 20 & 63) | 1 << (lo >> 26))
+        word, = self.WORD.unpack_from(self._map, offset)
+        return word & mask == mask
+
+class _CatalogLabels(object):
+    '''Read-only dictionary-like view of the labels of the messages in the
+    MessageCatalog, keyed by the internal ids of the messages'''
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __contains__(self, msg_iid):
+        return self.catalog.labels(msg_iid) is not None
+
+    def __getitem__(self, msg_iid):
+        labels = self.catalog.labels(msg_iid)
+        if labels is None:
+            raise KeyError(msg_iid)
+        return labels
+
+    def get(self, msg_iid, default=None):
+        labels = self.catalog.labels(msg_iid)
+        if labels is None:
+            return default
+        return labels
+
+class MessageCatalog(object):
+    '''Catalog of the stored messages, maps the internal ids of the
+    messages to their filenames and labels
+
+    The catalog file `fn` has lines "filename<TAB>id", new entries are
+    appended by flush() and the later line of the same id replaces the
+    former one. The ids and the filenames are looked up in the memory-mapped
+    HashIndex stored next to the catalog file, which is opened in O(1)
+    time. The catalog file serves as the journal of the index, only the
+    lines appended after the last sync of the index are read by read() and
+    the index is rebuilt from the whole file if it is missing or broken.
+    The added messages are kept in memory until flush() appends them to the
+    catalog file, the index is changed only by replaying the appended lines,
+    so it stays valid if the program is terminated between the flushes.
+
+    If `bloom` is True or the BloomFilter was created before, the ids
+    are tested by the filter first and only the possible hits are looked up
+    in the index.
+
+    The labels are kept only in memory, interned as tuples shared by the
+    messages.
+    '''
+    NO_LABELS = -1
+
+    def __init__(self, fn, bloom=False):
+        self.fn = fn
+        self.index = HashIndex(os.path.splitext(fn)[0] + '.idx')
+        self.bloom = None
+        self._bloomFn = os.path.splitext(fn)[0] + '.bloom'
+        self._useBloom = bloom or os.path.isfile(self._bloomFn)
+        self._labelSets = []
+        self._labelIndex = {}
+        self._pending = []
+        self._pendingIds = {}
+        self._pendingFiles = {}
+        self._pendingNew = 0
+        self._lock = threading.RLock()
+
+    def read(self, notifier):
+        '''Opens the catalog, returns False if the catalog file doesn't
+        exist (the catalog is empty then)'''
+        if not os.path.isfile(self.fn):
+            self.index.create()
+            self._openBloom()
+            return False
+        size = os.path.getsize(self.fn)
+        journal = self.index.open()
+        if journal is None or journal > size:
+            notifier.nLog(_("Rebuilding index of the stored messages"))
+            # The lines of the catalog file have about 64 bytes
+            self.index.create(HashIndex.capacityFor(size // 64))
+            journal = 0
+        if journal < size:
+            self._replay(journal, notifier)
+        self._openBloom()
+        return True
+
+    def _openBloom(self):
+        '''Opens the BloomFilter, it is rebuilt from the index if it doesn't
+        cover the same journal'''
+        if not self._useBloom:
+            return
+        self.bloom = BloomFilter(self._bloomFn)
+        if self.bloom.open() != self.index.journal or self.bloom.bits != self.index.capacity * BloomFilter.BITS:
+            self.bloom.create(self.index)
+            self.bloom.sync(self.index.journal)
+
+    def _replay(self, journal, notifier):
+        '''Adds the complete lines of the catalog file starting at the
+        offset `journal` to the index and syncs it'''
+        fr = file(self.fn, 'rb')
+        try:
+            fr.seek(journal)
+            while True:
+                line = fr.readline()
+                if not line.endswith('\n'):
+                    # The end of the file or the line which was not written
+                    # completely, it is overwritten by the next flush()
+                    break
+                journal += len(line)
+                try:
+                    items = line.strip().split(None, 1)
+                    if len(items) == 2:
+                        self._add(items[1], items[0])
+                except:
+                    notifier.handleError(_("Bad line in file with cached MessageIDs"))
+        finally:
+            fr.close()
+        self.index.sync(journal)
+
+    def __len__(self):
+        return self.index.count + self._pendingNew
+
+    def __contains__(self, msg_iid):
+        self._lock.acquire()
+        try:
+            if msg_iid in self._pendingIds:
+                return True
+            key = _key64(msg_iid)
+            if self.bloom is not None and not self.bloom.mayContain(*key):
+                return False
+            return self.index.findId(*key) >= 0
+        finally:
+            self._lock.release()
+
+    def __iter__(self):
+        for msg_fn, msg_iid, labels in self.iterItems():
+            yield msg_iid
+
+    def hasFile(self, msg_fn):
+        self._lock.acquire()
+        try:
+            return msg_fn in self._pendingFiles or self.index.findFile(*_key64(msg_fn)) >= 0
+        finally:
+            self._lock.release()
+
+    def add(self, msg_iid, msg_fn):
+        '''Adds the message stored in `msg_fn`, the message with the same
+        id stored before is replaced (when the catalog is flushed)'''
+        self._lock.acquire()
+        try:
+            if msg_iid not in self._pendingIds and self.index.findId(*_key64(msg_iid)) < 0:
+                self._pendingNew += 1
+            self._pending.append((msg_fn, msg_iid))
+            self._pendingIds[msg_iid] = msg_fn
+            self._pendingFiles[msg_fn] = msg_iid
+        finally:
+            self._lock.release()
+
+    def _add(self, msg_iid, msg_fn):
+        id_hi, id_lo = _key64(msg_iid)
+        fn_hi, fn_lo = _key64(msg_fn)
+        slot = self.index.findId(id_hi, id_lo)
+        if slot >= 0:
+            # The id is stored in the new file, the labels are kept
+            self.index.removeFile(*self.index.fileKey(slot))
+            self.index.setFileKey(slot, fn_hi, fn_lo)
+        else:
+            self.index.insertId(id_hi, id_lo, fn_hi, fn_lo)
+            if self.bloom is None:
+                pass
+            elif self.bloom.bits != self.index.capacity * BloomFilter.BITS:
+                # The index has grown, the filter is resized
+                self.bloom.create(self.index)
+            else:
+                self.bloom.add(id_hi, id_lo)
+        self.index.insertFile(fn_hi, fn_lo, id_hi, id_lo)
+
+    def removeFile(self, msg_fn):
+        '''Removes the message stored in `msg_fn` which wasn't flushed'''
+        self._lock.acquire()
+        try:
+            for idx, (pending_fn, msg_iid) in enumerate(self._pending):
+                if pending_fn == msg_fn:
+                    break
+            else:
+                return
+            del self._pending[idx]
+            del self._pendingFiles[msg_fn]
+            if self._pendingIds.get(msg_iid) == msg_fn:
+                # The id may be pending in an earlier file
+                del self._pendingIds[msg_iid]
+                for pending_fn, pending_iid in self._pending:
+                    if pending_iid == msg_iid:
+                        self._pendingIds[msg_iid] = pending_fn
+                if msg_iid not in self._pendingIds and self.index.findId(*_key64(msg_iid)) < 0:
+                    self._pendingNew -= 1
+        finally:
+            self._lock.release()
+
+    def _slot(self, msg_fn, msg_iid):
+        '''Returns the slot of the message if it is stored in `msg_fn`
+        (the line of the catalog file is not replaced by a later one),
+        otherwise -1'''
+        slot = self.index.findId(*_key64(msg_iid))
+        if slot >= 0 and self.index.fileKey(slot) == _key64(msg_fn):
+            return slot
+        return -1
+
+    def _slotLabels(self, slot):
+        values = self.index.values
+        if slot < 0 or values is None or values[slot] == self.NO_LABELS:
+            return None
+        return self._labelSets[values[slot]]
+
+    def labels(self, msg_iid):
+        '''Returns the tuple of labels of the message or None'''
+        return self._slotLabels(self.index.findId(*_key64(msg_iid)))
+
+    def _setSlotLabels(self, slot, labels):
+        labels = tuple(labels)
+        idx = self._labelIndex.get(labels)
+        if idx is None:
+            idx = self._labelIndex[labels] = len(self._labelSets)
+            self._labelSets.append(labels)
+        self.index.enableValues()
+        self.index.values[slot] = idx
+
+    def setLabels(self, msg_iid, labels):
+        '''Sets the labels of the message, returns False if the message is
+        not in the catalog'''
+        slot = self.index.findId(*_key64(msg_iid))
+        if slot < 0:
+            return False
+        self._setSlotLabels(slot, labels)
+        return True
+
+    def _fileSlot(self, msg_fn):
+        '''Returns the slot of the id table of the message stored in
+        `msg_fn` or -1'''
+        fn_key = _key64(msg_fn)
+        file_slot = self.index.findFile(*fn_key)
+        if file_slot < 0:
+            return -1
+        slot = self.index.findId(*self.index.idKey(file_slot))
+        if slot >= 0 and self.index.fileKey(slot) == fn_key:
+            return slot
+        return -1
+
+    def fileLabels(self, msg_fn):
+        '''Returns the tuple of labels of the message stored in `msg_fn` or
+        None'''
+        return self._slotLabels(self._fileSlot(msg_fn))
+
+    def setFileLabels(self, msg_fn, labels):
+        slot = self._fileSlot(msg_fn)
+        if slot < 0:
+            return False
+        self._setSlotLabels(slot, labels)
+        return True
+
+    def labelAssignment(self):
+        return _CatalogLabels(self)
+
+    def iterItems(self):
+        '''Iterates over the triples (msg_fn, msg_iid, labels) of all
+        messages in the order of storing'''
+        if os.path.isfile(self.fn):
+            fr = file(self.fn, 'rb')
+            try:
+                journal = self.index.journal
+                for line in fr:
+                    journal -= len(line)
+                    if journal < 0:
+                        break
+                    items = line.strip().split(None, 1)
+                    if len(items) != 2:
+                        continue
+                    msg_fn, msg_iid = items
+                    if self._pendingIds.get(msg_iid, msg_fn) != msg_fn:
+                        # Replaced by the message which wasn't flushed
+                        continue
+                    slot = self._slot(msg_fn, msg_iid)
+                    if slot >= 0:
+                        yield msg_fn, msg_iid, self._slotLabels(slot)
+            finally:
+                fr.close()
+        for msg_fn, msg_iid in list(self._pending):
+            if self._pendingIds.get(msg_iid) == msg_fn:
+                yield msg_fn, msg_iid, self.labels(msg_iid)
+
+    def files(self):
+        for msg_fn, msg_iid, labels in self.iterItems():
+            yield msg_fn
+
+    def flush(self, notifier):
+        '''Appends the new entries to the catalog file (the journal) and
+        replays them into the index'''
+        self._lock.acquire()
+        try:
+            if not self._pending:
+                return
+            journal = self.index.journal
+            if os.path.isfile(self.fn) and os.path.getsize(self.fn) > journal:
+                # Drops the incomplete line of the interrupted flush()
+                fw = file(self.fn, 'r+b')
+                try:
+                    fw.truncate(journal)
+                finally:
+                    fw.close()
+            fw = file(self.fn, 'ab')
+            try:
+                for msg_fn, msg_iid in self._pending:
+                    if self._pendingIds.get(msg_iid) != msg_fn:
+                        continue
+                    try:
+                        fw.write('%s\t%s\n' % (msg_fn, msg_iid))
+                    except:
+                        notifier.nError(_("Errorneous message in file: %s, please report it to <honza.svec@gmail.com>") % msg_fn)
+                fw.flush()
+                os.fsync(fw.fileno())
+            finally:
+                fw.close()
+            self._pending = []
+            self._pendingIds = {}
+            self._pendingFiles = {}
+            self._pendingNew = 0
+            self._replay(journal, notifier)
+            if self.bloom is not None:
+                self.bloom.sync(self.index.journal)
+        finally:
+            self._lock.release()
+
+class SearchIndex(object):
+    '''Full-text index of the stored messages in the sqlite database `fn`
+
+    The table `messages` maps the storage names of the messages to the rowids
+    of the full-text table `fts`, which contains the decoded subject,
+    senders, recipients, date, labels and text bodies. The best available
+    sqlite full-text module from INDEX_MODULES is used. Changes are
+    committed by commit().
+    '''
+    COLUMNS = ['subject', 'sender', 'recipients', 'date', 'labels', 'body']
+
+    _tags = re.compile(r'<[^>]*>')
+    _entities = re.compile(r'&(#?\w+);')
+    _spaces = re.compile(r'\s+', re.UNICODE)
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.db = sqlite3.connect(fn)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, path TEXT UNIQUE, date INTEGER)')
+        cur = self.db.execute("SELECT name FROM sqlite_master WHERE name = 'fts'")
+        if cur.fetchone() is None:
+            self._createFts()
+        self.db.commit()
+
+    @classmethod
+    def available(cls):
+        return bool(sqlite3)
+
+    def _createFts(self):
+        for module in INDEX_MODULES:
+            try:
+                self.db.execute('CREATE VIRTUAL TABLE fts USING %s(%s)' % (module, ', '.join(self.COLUMNS)))
+                self.module = module
+                return
+            except sqlite3.OperationalError:
+                continue
+        raise sqlite3.OperationalError('sqlite has no full-text search module')
+
+    def _text(self, part):
+        payload = part.get_payload(decode=True)
+        if not payload:
+            return u''
+        charset = part.get_content_charset() or 'ascii'
+        try:
+            text = payload.decode(charset, 'replace')
+        except LookupError:
+            text = payload.decode('ascii', 'replace')
+        if part.get_content_subtype() == 'html':
+            text = self._entities.sub(' ', self._tags.sub(' ', text))
+        return text
+
+    def _body(self, msg):
+        texts = []
+        size = 0
+        for part in msg.walk():
+            if part.get_content_maintype() != 'text':
+                continue
+            if part.get('Content-Disposition', '').lower().startswith('attachment'):
+                continue
+            text = self._spaces.sub(' ', self._text(part))
+            texts.append(text)
+            size += len(text)
+            if size >= INDEX_BODY_LIMIT:
+                break
+        return u' '.join(texts)[:INDEX_BODY_LIMIT]
+
+    def add(self, path, mail, labels=[]):
+        '''Adds (or replaces) message `mail` stored under the name `path`
+        '''
+        msg = email.message_from_string(mail)
+        d = _parseMsgDate(msg)
+        recipients = u' '.join(_unicodeHeader(msg[h]) for h in ('To', 'Cc', 'Bcc') if msg[h])
+        values = [_unicodeHeader(msg['Subject']), _unicodeHeader(msg['From']), recipients,
+                  unicode(time.strftime('%Y-%m-%d', d)), self._labelText(labels), self._body(msg)]
+        self.remove(path)
+        cur = self.db.execute('INSERT INTO messages (path, date) VALUES (?, ?)', (path, int(time.mktime(d))))
+        self.db.execute('INSERT INTO fts (rowid, %s) VALUES (?, ?, ?, ?, ?, ?, ?)' % ', '.join(self.COLUMNS), [cur.lastrowid] + values)
+
+    def remove(self, path):
+        cur = self.db.execute('SELECT id FROM messages WHERE path = ?', (path, ))
+        row = cur.fetchone()
+        if row is not None:
+            self.db.execute('DELETE FROM fts WHERE rowid = ?', row)
+            self.db.execute('DELETE FROM messages WHERE id = ?', row)
+
+    def _labelText(self, labels):
+        ret = []
+        for label in labels:
+            try:
+                ret.append(imap_decode(label))
+            except UnicodeError:
+                ret.append(label.decode('ascii', 'replace'))
+        return u' '.join(ret)
+
+    def setLabels(self, path, labels):
+        cur = self.db.execute('SELECT id FROM messages WHERE path = ?', (path, ))
+        row = cur.fetchone()
+        if row is not None:
+            self.db.execute('UPDATE fts SET labels = ? WHERE rowid = ?', (self._labelText(labels), row[0]))
+
+    def paths(self):
+        '''Returns the set of indexed storage names'''
+        return set(row[0] for row in self.db.execute('SELECT path FROM messages'))
+
+    def search(self, query, limit=None):
+        '''Returns the list of storage names of messages matching the
+        full-text `query`, the newest messages first
+        '''
+        sql = 'SELECT messages.path FROM fts JOIN messages ON messages.id = fts.rowid WHERE fts MATCH ? ORDER BY messages.date DESC'
+        args = [query]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        return [row[0] for row in self.db.execute(sql, args)]
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class EmailStorage(object):
+    @classmethod
+    def createStorage(cls, fn, notifier, options=None):
+        '''Creates the storage for `fn`, the `options` dictionary may contain
+        'volumes' - the volume specification of ZipStorage, 'codec' - the
+        compression codec specification (see Codec), 'filter',
+        'filter_ext', 'unfilter' and 'filter_framed' - the external filters
+        of DirectoryStorage (see FilterChain) and 'bloom' - create the
+        BloomFilter of the catalog
+        '''
+        if options is None:
+            options = {}
+        ext = os.path.splitext(fn.split('#')[0])[1]
+        if ext.lower() == '.zip':
+            if options.get('filter') or options.get('unfilter'):
+                raise ValueError(_("External filters are supported only by the backups into a directory"))
+            return ZipStorage(fn, notifier, volumes=options.get('volumes'), codec=options.get('codec'),
+                              bloom=options.get('bloom', False))
+        else:
+            return DirectoryStorage(fn, notifier, codec=options.get('codec'),
+                                    filter=options.get('filter'), filter_ext=options.get('filter_ext'),
+                                    unfilter=options.get('unfilter'), filter_framed=options.get('filter_framed', False),
+                                    bloom=options.get('bloom', False))
+
+    @classmethod
+    def storageExists(cls, fn):
+        path = os.path.expanduser(fn.split('#')[0])
+        if os.path.splitext(path)[1].lower() == '.zip':
+            return os.path.exists(path) or os.path.exists(ZipStorage.manifestPath(path))
+        return os.path.exists(path)
+
+    def idsOfMessages(self):
+        '''Returns the MessageCatalog of the stored messages, it supports
+        `in` and the iteration over the stored msg_ids'''
+
+    def iterBackups(self, since_time=None, before_time=None, logging=True):
+        '''Iterates over backups specified by parameters and yields pairs (storageid, message)'''
+
+    def store(self, msg, internaldate=None):
+        '''Stores message `msg`, `internaldate` is the INTERNALDATE string
+        of the message on the server (without quotes)'''
+
+    def internalDate(self, msg_fn):
+        '''Returns the INTERNALDATE string of the stored message or None if
+        it is not known'''
+
+    def getLabelAssignment(self):
+        '''Returns label assignment (read-only mapping of msg_ids to the
+        labels)'''
 
     def updateLabelAssignment(self, assignment):
         '''Updates label assignment with `assignment`'''
@@ -796,6 +3385,54 @@ class EmailStorage(object):
     def updateStamp(self, last_time):
         '''Updates the stamp of the last backup to last_time'''
 
+    def readCheckpoint(self):
+        '''Returns the checkpoint dictionary of the interrupted backup or None'''
+
+    def writeCheckpoint(self, checkpoint):
+        '''Stores the checkpoint dictionary of the paused backup'''
+
+    def removeCheckpoint(self):
+        '''Removes the checkpoint after the backup is completed'''
+
+    def readDaemonState(self):
+        '''Returns the state dictionary saved by the daemon (empty if there
+        is no state)'''
+
+    def writeDaemonState(self, state):
+        '''Stores the state dictionary of the daemon'''
+
+    def readLayout(self):
+        '''Returns the layout dictionary of the mailboxes (see
+        GMailConnection.discoverLayout()) stored with the backup or None'''
+
+    def writeLayout(self, layout):
+        '''Stores the layout dictionary of the mailboxes'''
+
+    def catalogFiles(self):
+        '''Returns the set of messages listed in the catalog'''
+
+    def storedFiles(self):
+        '''Returns the sorted list of stored messages'''
+
+    def labelledFiles(self):
+        '''Returns the set of messages referenced by the label assignment'''
+
+    def storedChecksums(self):
+        '''Returns the dictionary of SHA-256 digests recorded at store time'''
+
+    def computeChecksums(self, names, jobs=1):
+        '''Iterates over pairs (name, digest) of the stored messages `names`
+        using `jobs` processes, the digest is None for unreadable messages'''
+
+    def iterMessages(self, names):
+        '''Iterates over pairs (name, message) of the stored messages `names`'''
+
+    def updateIndex(self):
+        '''Adds the stored messages missing in the full-text index'''
+
+    def search(self, query, limit=None):
+        '''Returns the paths of messages matching the full-text `query`'''
+
     def _templateDict(self, msg):
         '''Creates dictionary used in the template expansion
         '''
@@ -814,12 +3451,83 @@ class EmailStorage(object):
 
 
 class DirectoryStorage(EmailStorage):
-    def __init__(self, fn, notifier):
+    DEFAULT_CODEC = 'none'
+    filterExtensions = ()
+
+    def __init__(self, fn, notifier, codec=None, filter=None, filter_ext=None, unfilter=None, filter_framed=False,
+                 bloom=False):
         self.setFnAndFragment(fn)
         self.notifier = notifier
+        self.setCodec(codec)
+        self.setFilter(filter, filter_ext, unfilter, filter_framed)
         self._makeMaildir()
-        self._readDownloadedIds()
-        self._readLabelAssignment()
+        self._readFilters()
+        self._readDownloadedIds(bloom)
+        self._labelsRead = False
+        self._newSums = []
+        self._newDates = []
+        self._dates = None
+
+    def setCodec(self, codec):
+        '''Sets the compression codec of the newly stored messages
+        '''
+        if codec is None:
+            codec = self.DEFAULT_CODEC
+        self.codec = Codec(codec)
+        self._pending = []
+        self._pool = None
+
+    def setFilter(self, filter=None, extension=None, unfilter=None, framed=False):
+        '''Sets the chain of external filters `filter` applied to the newly
+        stored messages after the compression and the chain `unfilter`
+        reverting it, see FilterChain
+
+        The filtered messages are stored with the `extension` appended. Their
+        checksums are computed from the stored files, so the backup can be
+        verified without the unfilter chain (e.g. without the private key).
+        '''
+        if extension is None:
+            extension = FILTER_EXTENSION
+        if not re.match(r'^\.[A-Za-z0-9_-]+$', extension) or extension.lower() in Codec.EXTENSIONS.values():
+            raise ValueError(_("Bad extension of the filtered messages: %s") % extension)
+        self.filter = self.unfilter = None
+        self.filterExtension = ''
+        if filter:
+            self.filter = FilterChain(filter, framed)
+            self.filterExtension = extension
+        if unfilter:
+            self.unfilter = FilterChain(unfilter, framed)
+
+    def _readFilters(self):
+        '''Reads the extensions of the filtered messages recorded with the
+        backup and records the extension of the current filter
+
+        Only the files with the recorded extensions are the filtered
+        messages, other files (e.g. "*.eml.bak") are not the part of the
+        backup.
+        '''
+        fn = self.filtersFilename()
+        filters = _readKeyValues(fn) or {}
+        if self.filter is not None and self.filterExtension not in filters:
+            filters[self.filterExtension] = self.filter.spec
+            _writeKeyValues(fn, filters)
+        self.filterExtensions = tuple(sorted(filters))
+
+    def _encode(self, msg):
+        data = self.codec.compress(msg)
+        if self.filter is not None:
+            data = self.filter.apply(data)
+        return data
+
+    def _decode(self, msg_fn, data):
+        '''Returns the message stored in the file `msg_fn` with the content
+        `data`'''
+        if Codec.isFiltered(msg_fn, self.filterExtensions):
+            if self.unfilter is None:
+                raise IOError(_("Cannot read %s, the unfilter command is not set") % msg_fn)
+            data = self.unfilter.apply(data)
+            msg_fn = Codec.unfilteredName(msg_fn, self.filterExtensions)
+        return Codec.decode(msg_fn, data)
 
     def setFnAndFragment(self, fn):
         '''Sets the filename and the pattern for naming the files in the
@@ -836,23 +3544,13 @@ class DirectoryStorage(EmailStorage):
         self.fragment = string.Template(self.fragment)
 
     def iterBackups(self, since_time=None, before_time=None, logging=True):
-        def walkBackups(top):
-            '''Walks trough the dn and returns path originating in dn and ending with '.eml'
-            '''
-            for dn, sub_dns, fns in os.walk(top):
-                rel_dn = dn[len(top):].lstrip(os.path.sep)
-                for fn in fns:
-                    if os.path.splitext(fn)[1].lower() != '.eml':
-                        continue
-                    yield os.path.join(rel_dn, fn)
-
-        listing = sorted(walkBackups(self.fn))
+        listing = self.storedFiles()
         for idx, msg_fn in enumerate(listing):
             try:
                 full_msg_fn = os.path.join(self.fn, msg_fn)
                 fr = file(full_msg_fn, 'rb')
                 try:
-                    msg = fr.read()
+                    msg = self._decode(msg_fn, fr.read())
                 finally:
                     fr.close()
 
@@ -890,74 +3588,210 @@ class DirectoryStorage(EmailStorage):
     def stampFile(self):
         return os.path.join(self.fn, 'stamp')
 
-    def _readDownloadedIds(self):
-        cache = self.idsFilename()
-        self.message_iid2fn = {}
-        if not os.path.isfile(cache):
+    def checkpointFile(self):
+        return os.path.join(self.fn, 'checkpoint.txt')
+
+    def daemonStateFile(self):
+        return os.path.join(self.fn, 'daemon.txt')
+
+    def layoutFile(self):
+        return os.path.join(self.fn, 'layout.txt')
+
+    def filtersFilename(self):
+        return os.path.join(self.fn, 'filters.txt')
+
+    def sumsFilename(self):
+        return os.path.join(self.fn, 'sums.txt')
+
+    def datesFilename(self):
+        return os.path.join(self.fn, 'dates.txt')
+
+    def indexFilename(self):
+        return os.path.join(self.fn, 'index.sqlite')
+
+    def _readDownloadedIds(self, bloom=False):
+        self.catalog = MessageCatalog(self.idsFilename(), bloom)
+        if not self.catalog.read(self.notifier):
             for msg_fn, msg in self.iterBackups(logging=False):
                 try:
                     msg_iid = _getMailInternalId(msg)
-                    self.message_iid2fn[msg_iid] = msg_fn
+                    self.catalog.add(msg_iid, msg_fn)
                 except:
                     self.notifier.handleError(_("Error while reading MessageID from stored message"))
-        else:
-            fr = file(cache, 'r')
+
+    def _writeDownloadedIds(self):
+        self.catalog.flush(self.notifier)
+
+    def _readChecksums(self):
+        '''Returns the dictionary of the checksums of the stored messages
+
+        The checksums are needed only by the verification, so they are not
+        kept in the memory. The file is only appended by storeComplete(),
+        the later lines win.
+        '''
+        fn = self.sumsFilename()
+        ret = {}
+        if os.path.isfile(fn):
+            fr = file(fn, 'r')
             for line in fr:
-                try:
-                    items = line.strip().split(None, 1)
-                    try:
-                        msg_fn = items[0]
-                        msg_iid = items[1]
-                        self.message_iid2fn[msg_iid] = msg_fn
-                    except IndexError:
-                        pass
-                except:
-                    self.notifier.handleError(_("Bad line in file with cached MessageIDs"))
+                # The format of sha256sum utility
+                items = line.rstrip('\r\n').split('  ', 1)
+                if len(items) == 2:
+                    ret[items[1]] = items[0]
             fr.close()
-        self.message_fn2iid = _revertDict(self.message_iid2fn)
+        ret.update(self._newSums)
+        return ret
 
-    def _writeDownloadedIds(self):
-        fn = self.idsFilename()
-        if os.path.exists(fn):
-            os.remove(fn)
-        fw = file(fn, 'w')
-        for msg_iid, msg_fn in sorted(self.message_iid2fn.items(), key=lambda item: item[1]):
+    def _writeChecksums(self):
+        '''Appends the checksums of the newly stored messages'''
+        if sha256 is not None and self._newSums:
+            fw = file(self.sumsFilename(), 'a')
             try:
-                line = '%s\t%s' % (msg_fn, msg_iid)
-                print >> fw, line
-            except:
-                self.notifier.nError(_("Errorneous message in file: %s, please report it to <honza.svec@gmail.com>") % msg_fn)
-        fw.close()
+                for msg_fn, digest in self._newSums:
+                    print >> fw, '%s  %s' % (digest, msg_fn)
+            finally:
+                fw.close()
+        self._newSums = []
+
+    def _readDates(self):
+        '''Returns the dictionary of the INTERNALDATE strings of the stored
+        messages, the file is only appended by storeComplete()'''
+        fn = self.datesFilename()
+        ret = {}
+        if os.path.isfile(fn):
+            fr = file(fn, 'r')
+            for line in fr:
+                items = line.rstrip('\r\n').split('\t', 1)
+                if len(items) == 2:
+                    ret[items[0]] = items[1]
+            fr.close()
+        ret.update(self._newDates)
+        return ret
+
+    def _writeDates(self):
+        '''Appends the dates of the newly stored messages'''
+        if self._newDates:
+            fw = file(self.datesFilename(), 'a')
+            try:
+                for msg_fn, internaldate in self._newDates:
+                    print >> fw, '%s\t%s' % (msg_fn, internaldate)
+            finally:
+                fw.close()
+        self._newDates = []
+
+    def internalDate(self, msg_fn):
+        if self._dates is None:
+            # The dates are needed only by the restore, they are read on
+            # the first use
+            self._dates = self._readDates()
+        return self._dates.get(msg_fn)
 
     def idsOfMessages(self):
-        return set(self.message_iid2fn)
+        return self.catalog
+
+    def catalogFiles(self):
+        return set(self.catalog.files())
+
+    def storedFiles(self):
+        return sorted(_walkBackups(self.fn, self.filterExtensions))
+
+    def labelledFiles(self):
+        fn = self.labelFilename()
+        ret = set()
+        if os.path.isfile(fn):
+            fr = codecs.open(fn, 'r', 'utf-8')
+            for line in fr:
+                items = line.split(None, 1)
+                if items:
+                    ret.add(items[0])
+            fr.close()
+        return ret
+
+    def storedChecksums(self):
+        return self._readChecksums()
+
+    def computeChecksums(self, names, jobs=1):
+        return _mapChunks(_hashFiles, [((self.fn, self.filterExtensions), names)], jobs)
+
+    def iterMessages(self, names):
+        for name in names:
+            fr = file(os.path.join(self.fn, name), 'rb')
+            try:
+                msg = self._decode(name, fr.read())
+            finally:
+                fr.close()
+            yield name, msg
+
+    def _getIndex(self):
+        '''Returns the full-text index, it is opened on the first use. Returns
+        None if the index is not available.
+        '''
+        if not hasattr(self, '_index'):
+            self._index = None
+            if SearchIndex.available():
+                try:
+                    self._index = SearchIndex(self.indexFilename())
+                except sqlite3.Error:
+                    self.notifier.handleError(_("Cannot open the full-text index"))
+        return self._index
+
+    def _indexMessage(self, msg_fn, msg):
+        index = self._getIndex()
+        if index is None:
+            return
+        try:
+            index.add(msg_fn, msg)
+        except:
+            self.notifier.handleError(_("Error while indexing e-mail"))
+
+    def updateIndex(self):
+        index = self._getIndex()
+        if index is None:
+            return
+        missing = sorted(self.catalogFiles() - index.paths())
+        if not missing:
+            return
+        self.notifier.nLog(_("Indexing %d messages") % len(missing))
+        self._readLabelAssignment()
+        try:
+            for msg_fn, msg in self.iterMessages(missing):
+                try:
+                    index.add(msg_fn, msg, self.catalog.fileLabels(msg_fn) or [])
+                except:
+                    self.notifier.handleError(_("Error while indexing e-mail"))
+        finally:
+            index.commit()
+
+    def search(self, query, limit=None):
+        index = self._getIndex()
+        if index is None:
+            return None
+        self.updateIndex()
+        return [os.path.join(self.fn, name) for name in index.search(query, limit)]
 
     def getLabelAssignment(self):
-        return self.message_iid2labels.copy()
+        self._readLabelAssignment()
+        return self.catalog.labelAssignment()
 
     def updateLabelAssignment(self, assignment):
-        self.message_iid2labels.update(assignment)
+        self._readLabelAssignment()
+        for msg_iid, labels in assignment.iteritems():
+            self.catalog.setLabels(msg_iid, labels)
         self._writeLabelAssignment()
+        index = self._getIndex()
+        if index is not None:
+            try:
+                for msg_fn, msg_iid, labels in self.catalog.iterItems():
+                    if msg_iid in assignment:
+                        index.setLabels(msg_fn, labels)
+                index.commit()
+            except:
+                self.notifier.handleError(_("Error while indexing labels"))
 
     def _cleanFilename(self, fn):
         '''Cleans the filename - removes diacritics and other filesystem special characters
         '''
-        fn = _removeDiacritics(fn)
-        fn = fn.encode('utf-8', 'replace')
-        if os.name == 'posix':
-            good_chars = set('!"#\'()+-0123456789:;<=>@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]_abcdefghijklmnopqrstuvwxyz{}/\\')
-        elif os.name == 'nt':
-            good_chars = set("!#'()+-0123456789;=@ABCDEFGHIJKLMNOPQRSTUVWXYZ[]_abcdefghijklmnopqrstuvwxyz{}/\\")
-        else:
-            good_chars = set("+-0123456789=@ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz/\\")
-        ret = ''
-        for c in fn:
-            if c not in good_chars:
-                c = '_'
-            ret += c
-        ret = re.sub('_+', '_', ret)
-        ret = ret[:240]
-        return ret
+        return _SANITIZER(fn)
 
     def getMailFilename(self, mail):
         msg = email.message_from_string(mail)
@@ -966,7 +3800,7 @@ class DirectoryStorage(EmailStorage):
         fn = self._cleanFilename(fn)
         return fn
 
-    def store(self, msg):
+    def store(self, msg, internaldate=None):
         msg_fn = self.getMailFilename(msg)
         msg_dn = os.path.dirname(msg_fn)
         full_dn = os.path.join(self.fn, msg_dn)
@@ -975,21 +3809,78 @@ class DirectoryStorage(EmailStorage):
         msg_iid = _getMailInternalId(msg)
         idx = 1
         while True:
-            msg_fn_num = '%s-%01d.eml'%(msg_fn, idx)
+            msg_fn_num = '%s-%01d.eml%s%s'%(msg_fn, idx, self.codec.extension(), self.filterExtension)
             idx += 1
             full_fn_num = os.path.join(self.fn, msg_fn_num)
-            if not os.path.exists(full_fn_num):
+            if not os.path.exists(full_fn_num) and not self.catalog.hasFile(msg_fn_num):
                 break
-        self.message_iid2fn[msg_iid] = msg_fn_num
-        self.message_fn2iid[msg_fn_num] = msg_iid
-        fw = file(full_fn_num, 'wb')
+        self.catalog.add(msg_iid, msg_fn_num)
+        self._storeEncoded(msg_fn_num, msg, internaldate, self._encode, self._writeFile)
+
+    def _writeFile(self, msg_fn, data):
+        fw = file(os.path.join(self.fn, msg_fn), 'wb')
         try:
-            fw.write(msg)
+            fw.write(data)
         finally:
             fw.close()
 
+    def _storeEncoded(self, msg_fn, msg, internaldate, encode, write):
+        '''Encodes the message `msg` by `encode` and writes the result by
+        write(msg_fn, result), the `internaldate` is recorded when it is
+        written
+
+        The compression and the external filters run on the CompressionPool,
+        the results are written in the order of storing as soon as they are
+        ready. At most COMPRESS_QUEUE messages wait for the compression.
+        '''
+        if self.codec.name == 'none' and self.filter is None:
+            # Nothing to compress, the job is run immediately
+            job = ThreadJob(encode, (msg,))
+            job.run()
+        else:
+            if self._pool is None:
+                self._pool = CompressionPool()
+            job = self._pool.submit(encode, msg)
+        self._pending.append((msg_fn, msg, job, write, internaldate))
+        self._writePending(COMPRESS_QUEUE)
+
+    def _writePending(self, limit=0):
+        while self._pending and (len(self._pending) > limit or self._pending[0][2].isDone()):
+            msg_fn, msg, job, write, internaldate = self._pending.pop(0)
+            try:
+                data = job.wait()
+                write(msg_fn, data)
+            except:
+                # The message is not stored, remove it from the catalog. The
+                # error is reported here, the job may have been submitted by
+                # an earlier store().
+                self.catalog.removeFile(msg_fn)
+                self.notifier.handleError(_("Error while saving e-mail %s") % msg_fn)
+                continue
+            if Codec.isFiltered(msg_fn, self.filterExtensions):
+                self._newSums.append((msg_fn, _checksum(data)))
+            else:
+                self._newSums.append((msg_fn, _checksum(msg)))
+            if internaldate:
+                self._newDates.append((msg_fn, str(internaldate)))
+                if self._dates is not None:
+                    self._dates[msg_fn] = str(internaldate)
+            self._indexMessage(msg_fn, msg)
+
     def storeComplete(self):
+        try:
+            self._writePending()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+            if self.filter is not None:
+                self.filter.close()
         self._writeDownloadedIds()
+        self._writeChecksums()
+        self._writeDates()
+        if getattr(self, '_index', None) is not None:
+            self._index.commit()
 
     def _backupLabelAssignment(self):
         assign_fn = self.labelFilename()
@@ -1015,16 +3906,16 @@ class DirectoryStorage(EmailStorage):
         return ret
 
     def _readLabelAssignment(self):
+        '''Reads the labels into the catalog when they are needed first'''
+        if self._labelsRead:
+            return
+        self._labelsRead = True
         fn = self.labelFilename()
-        self.message_iid2labels = {}
         if os.path.isfile(fn):
             fr = codecs.open(fn, 'r', 'utf-8')
             for line in fr:
                 items = line.split(None, 1)
-                msg_fn = items[0]
-                msg_iid = self.message_fn2iid.get(msg_fn, None)
-                if msg_iid is not None:
-                    self.message_iid2labels[msg_iid] = self._unescapeLabels(items[1])
+                self.catalog.setFileLabels(items[0], self._unescapeLabels(items[1]))
             fr.close()
 
     def _writeLabelAssignment(self):
@@ -1033,12 +3924,9 @@ class DirectoryStorage(EmailStorage):
         if os.path.exists(fn):
             os.remove(fn)
         fw = codecs.open(fn, 'w', 'utf-8')
-        for msg_iid, labels in sorted(self.message_iid2labels.items()):
-            msg_fn = self.message_iid2fn.get(msg_iid)
-            if msg_fn is None:
-                # We are unable do determine the filename for msg_iid
-                continue
-            print >> fw, '%s\t%s' % (msg_fn, self._escapeLabels(labels))
+        for msg_fn, msg_iid, labels in self.catalog.iterItems():
+            if labels is not None:
+                print >> fw, '%s\t%s' % (msg_fn, self._escapeLabels(labels))
         fw.close()
 
     def lastStamp(self):
@@ -1069,13 +3957,276 @@ class DirectoryStorage(EmailStorage):
         print >> fw, last_time
         fw.close()
 
+    def readCheckpoint(self):
+        checkpoint = _readKeyValues(self.checkpointFile())
+        if checkpoint is None:
+            return None
+        try:
+            checkpoint['resume_after'] = float(checkpoint.get('resume_after', 0))
+        except ValueError:
+            checkpoint['resume_after'] = 0.
+        return checkpoint
+
+    def writeCheckpoint(self, checkpoint):
+        _writeKeyValues(self.checkpointFile(), checkpoint)
+
+    def removeCheckpoint(self):
+        fn = self.checkpointFile()
+        if os.path.exists(fn):
+            os.remove(fn)
+
+    def readDaemonState(self):
+        state = _readKeyValues(self.daemonStateFile()) or {}
+        for key in ('uidvalidity', 'uidnext', 'highestmodseq', 'reconciled'):
+            try:
+                if key in state:
+                    state[key] = int(state[key])
+            except ValueError:
+                del state[key]
+        return state
+
+    def writeDaemonState(self, state):
+        _writeKeyValues(self.daemonStateFile(), state)
+
+    def readLayout(self):
+        layout = _readKeyValues(self.layoutFile())
+        if layout is None or 'all_mail' not in layout or 'trash' not in layout:
+            return None
+        return layout
+
+    def writeLayout(self, layout):
+        _writeKeyValues(self.layoutFile(), layout)
+
+class ZipEntry(object):
+    '''Entry of the side index of ZipStorage, contains the position of the
+    member in the zip file together with the date (as the number of seconds
+    since epoch) and the internal id of the message
+    '''
+    __slots__ = ['name', 'offset', 'compress_size', 'size', 'compress_type', 'crc', 'date', 'msg_iid']
+
+    def __init__(self, name, offset, compress_size, size, compress_type, crc, date, msg_iid):
+        self.name = name
+        self.offset = offset
+        self.compress_size = compress_size
+        self.size = size
+        self.compress_type = compress_type
+        self.crc = crc
+        self.date = date
+        self.msg_iid = msg_iid
+
+    @classmethod
+    def fromInfo(cls, info, msg):
+        '''Creates the entry from ZipInfo `info` of the stored message `msg`'''
+        parsed = email.message_from_string(msg)
+        date = time.mktime(_parseMsgDate(parsed))
+        return cls(info.filename, info.header_offset, info.compress_size, info.file_size,
+                   info.compress_type, info.CRC, date, _parseMsgId(parsed))
+
+    @classmethod
+    def fromLine(cls, line):
+        items = line.rstrip('\r\n').split('\t', 7)
+        offset, compress_size, size, compress_type, crc, date = [int(i) for i in items[:6]]
+        return cls(items[6], offset, compress_size, size, compress_type, crc, date, items[7].decode('string_escape'))
+
+    def toLine(self):
+        return '%d\t%d\t%d\t%d\t%d\t%d\t%s\t%s' % (self.offset, self.compress_size, self.size,
+            self.compress_type, self.crc, self.date, self.name, self.msg_iid.encode('string_escape'))
+
+    def matches(self, info):
+        return self.offset == info.header_offset and self.crc == info.CRC \
+           and self.compress_size == info.compress_size
+
+    def readMessage(self, fr):
+        '''Reads the member from the zip file object `fr` and decodes the message'''
+        return Codec.decode(self.name, self.read(fr))
+
+    def read(self, fr):
+        '''Reads the member from the zip file object `fr`, only the local
+        header and the data of the member are read
+        '''
+        fr.seek(self.offset)
+        header = fr.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile("Bad magic number for file header of %s" % self.name)
+        header = struct.unpack(zipfile.structFileHeader, header)
+        fr.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        data = fr.read(self.compress_size)
+        if self.compress_type == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+            data = decompressor.decompress(data) + decompressor.flush()
+        elif self.compress_type != zipfile.ZIP_STORED:
+            raise zipfile.BadZipfile("Unsupported compression method %d for file %s" % (self.compress_type, self.name))
+        if zlib.crc32(data) & 0xffffffffL != self.crc:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %s" % self.name)
+        return data
+
+
+def _writeZipMember(zip, info, payload, crc, size):
+    '''Writes the member `info` with the already compressed `payload` into
+    the zip file `zip` opened for writing
+
+    ZipFile.writestr() would compress the payload again (at the default
+    level), so the local header and the data are written here as writestr()
+    writes them. The central directory is written by zip.close().
+    '''
+    info.CRC = crc
+    info.file_size = size
+    info.compress_size = len(payload)
+    info.header_offset = zip.fp.tell()
+    zip._writecheck(info)
+    zip._didModify = True
+    zip.fp.write(info.FileHeader())
+    zip.fp.write(payload)
+    zip.fp.flush()
+    zip.filelist.append(info)
+    zip.NameToInfo[info.filename] = info
+
+
+class ZipVolume(object):
+    '''One zip file of ZipStorage together with its side index
+
+    The side index <volume>.entries.txt maps the names of the members to
+    ZipEntry objects. It is read on the first access to `entries` and
+    synchronized with the central directory, only the members missing in
+    the side index (or changed) are decompressed.
+    '''
+    def __init__(self, zip_fn, notifier):
+        self.zip_fn = zip_fn
+        self.notifier = notifier
+        self._entries = None
+
+    def entriesFilename(self):
+        fn = os.path.splitext(self.zip_fn)[0] + '.entries.txt'
+        return fn
+
+    def exists(self):
+        return os.path.exists(self.zip_fn)
+
+    def size(self):
+        if not self.exists():
+            return 0
+        return os.path.getsize(self.zip_fn)
+
+    def isLoaded(self):
+        return self._entries is not None
+
+    def getEntries(self):
+        if self._entries is None:
+            self._readEntries()
+        return self._entries
+
+    entries = property(getEntries)
+
+    def _readEntries(self):
+        fn = self.entriesFilename()
+        cached = {}
+        if os.path.isfile(fn):
+            fr = file(fn, 'r')
+            for line in fr:
+                try:
+                    entry = ZipEntry.fromLine(line)
+                    cached[entry.name] = entry
+                except (ValueError, IndexError):
+                    pass
+            fr.close()
+
+        self._entries = {}
+        if not self.exists():
+            return
+        changed = False
+        zip = zipfile.ZipFile(self.zip_fn, 'r')
+        try:
+            for info in zip.infolist():
+                entry = cached.pop(info.filename, None)
+                if entry is None or not entry.matches(info):
+                    changed = True
+                    try:
+                        entry = ZipEntry.fromInfo(info, Codec.decode(info.filename, zip.read(info.filename)))
+                    except:
+                        self.notifier.handleError(_("Error occured while reading e-mail from disc"))
+                        continue
+                self._entries[info.filename] = entry
+        finally:
+            zip.close()
+        if changed or cached:
+            self._writeEntries()
+
+    def _writeEntries(self):
+        fn = self.entriesFilename()
+        if os.path.exists(fn):
+            os.remove(fn)
+        fw = file(fn, 'w')
+        for entry in self.sortedEntries():
+            print >> fw, entry.toLine()
+        fw.close()
+
+    def sortedEntries(self):
+        return sorted(self.entries.itervalues(), key=lambda entry: entry.offset)
+
+    def summary(self):
+        '''Returns (count, min_date, max_date, size) of the volume'''
+        dates = [entry.date for entry in self.entries.itervalues()]
+        if not dates:
+            return 0, 0, 0, self.size()
+        return len(dates), min(dates), max(dates), self.size()
+
+    def append(self, name, msg, encoded):
+        '''Appends the message `msg` as the member `name`, `encoded` is the
+        tuple (payload, compress_type, crc, size) returned by
+        Codec.compressZip(). Returns the ZipEntry of the member.
+        '''
+        entries = self.entries
+        payload, compress_type, crc, size = encoded
+        if not self.exists():
+            zip = zipfile.ZipFile(self.zip_fn, 'w', zipfile.ZIP_DEFLATED, True)
+        else:
+            zip = zipfile.ZipFile(self.zip_fn, 'a', zipfile.ZIP_DEFLATED, True)
+        try:
+            info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+            info.external_attr = 0600 << 16
+            info.compress_type = compress_type
+            _writeZipMember(zip, info, payload, crc, size)
+            entry = ZipEntry.fromInfo(info, msg)
+        finally:
+            zip.close()
+        entries[name] = entry
+        fw = file(self.entriesFilename(), 'a')
+        try:
+            print >> fw, entry.toLine()
+        finally:
+            fw.close()
+        return entry
+
+
 class ZipStorage(DirectoryStorage):
-    def __init__(self, fn, notifier):
+    '''Storage of the messages in zip files
+
+    Without volumes all messages are stored in one zip file. With volumes
+    the messages are stored in <name>-YYYY-MM.zip according to the date of
+    the message ('month') or in <name>-NNNN.zip, a new volume is started
+    when the current one reaches the given size. The volumes are listed in
+    the manifest <name>.volumes.txt together with their number of messages,
+    date range and size, so only the volumes actually needed are opened.
+    '''
+    _volumeKey = re.compile(r'^(\d{4}-\d{2}|\d+)$')
+    DEFAULT_CODEC = 'deflate'
+
+    def __init__(self, fn, notifier, volumes=None, codec=None, bloom=False):
         self.setFnAndFragment(fn)
         self.notifier = notifier
+        self.setCodec(codec)
+        self.setFilter()
         self._openZipFile()
-        self._readDownloadedIds()
-        self._readLabelAssignment()
+        self._readManifest(volumes)
+        self._readDownloadedIds(bloom)
+        self._labelsRead = False
+        self._newSums = []
+        self._newDates = []
+        self._dates = None
+
+    @classmethod
+    def manifestPath(cls, zip_fn):
+        return os.path.splitext(zip_fn)[0] + '.volumes.txt'
 
     def setFnAndFragment(self, fn):
         super(ZipStorage, self).setFnAndFragment(fn)
@@ -1100,53 +4251,243 @@ class ZipStorage(DirectoryStorage):
         fn = os.path.splitext(self.zip_fn)[0] + '.stamp.txt'
         return fn
 
+    def checkpointFile(self):
+        fn = os.path.splitext(self.zip_fn)[0] + '.checkpoint.txt'
+        return fn
+
+    def daemonStateFile(self):
+        fn = os.path.splitext(self.zip_fn)[0] + '.daemon.txt'
+        return fn
 
-    def iterBackups(self, since_time=None, before_time=None, logging=True):
-        if os.path.exists(self.zip_fn):
-            zip = zipfile.ZipFile(self.zip_fn, 'r')
-            listing = [i.filename for i in zip.infolist()]
-            # skip labels.txt and labels.txt.bak files
-            for idx, msg_fn in enumerate(listing):
+    def layoutFile(self):
+        fn = os.path.splitext(self.zip_fn)[0] + '.layout.txt'
+        return fn
+
+    def sumsFilename(self):
+        fn = os.path.splitext(self.zip_fn)[0] + '.sums.txt'
+        return fn
+
+    def datesFilename(self):
+        fn = os.path.splitext(self.zip_fn)[0] + '.dates.txt'
+        return fn
+
+    def indexFilename(self):
+        fn = os.path.splitext(self.zip_fn)[0] + '.index.sqlite'
+        return fn
+
+    def manifestFilename(self):
+        return self.manifestPath(self.zip_fn)
+
+    def _volumeFilename(self, key):
+        return '%s-%s.zip' % (os.path.splitext(self.zip_fn)[0], key)
+
+    def _volumeNumber(self, vol_fn):
+        '''Returns the number of the volume rolled over by size or None'''
+        key = vol_fn[len(os.path.splitext(self.zip_fn)[0])+1:-4]
+        if key.isdigit():
+            return int(key)
+        return None
+
+    def _readManifest(self, volumes):
+        fn = self.manifestFilename()
+        scheme = None
+        self.volume_info = {}
+        if os.path.isfile(fn):
+            fr = file(fn, 'r')
+            for line in fr:
+                items = line.rstrip('\r\n').split('\t')
                 try:
-                    msg = zip.read(msg_fn)
+                    if items[0] == 'scheme':
+                        scheme = items[1]
+                    elif items[0] == 'volume':
+                        info = (int(items[2]), float(items[3]), float(items[4]), int(items[5]))
+                        self.volume_info[os.path.join(self.fn, items[1])] = info
+                except (ValueError, IndexError):
+                    pass
+            fr.close()
+        if volumes is not None:
+            scheme = volumes
+        self.scheme = _parseVolumes(scheme)
+        self._manifestDirty = self.scheme is not None and not os.path.isfile(fn)
+
+        self.volumes = {}
+        if os.path.exists(self.zip_fn):
+            self._volume(self.zip_fn)
+        # The volumes missing in the manifest are found in the directory
+        prefix = os.path.basename(os.path.splitext(self.zip_fn)[0]) + '-'
+        for name in os.listdir(self.fn or os.curdir):
+            if name.startswith(prefix) and name.lower().endswith('.zip') \
+            and self._volumeKey.match(name[len(prefix):-4]):
+                self._volume(os.path.join(self.fn, name))
+
+    def _writeManifest(self):
+        fn = self.manifestFilename()
+        if os.path.exists(fn):
+            os.remove(fn)
+        fw = file(fn, 'w')
+        if self.scheme is not None:
+            print >> fw, 'scheme\t%s' % (self.scheme, )
+        for volume in self._sortedVolumes():
+            count, min_date, max_date, size = self._volumeSummary(volume)
+            print >> fw, 'volume\t%s\t%d\t%d\t%d\t%d' % (os.path.basename(volume.zip_fn), count, min_date, max_date, size)
+        fw.close()
+        self._manifestDirty = False
+
+    def _volume(self, vol_fn):
+        if vol_fn not in self.volumes:
+            self.volumes[vol_fn] = ZipVolume(vol_fn, self.notifier)
+        return self.volumes[vol_fn]
+
+    def _sortedVolumes(self):
+        return [self.volumes[i] for i in sorted(self.volumes)]
+
+    def _volumeSummary(self, volume):
+        '''Returns (count, min_date, max_date, size) of the volume, the
+        volume is read only if it is not described by the manifest
+        '''
+        info = self.volume_info.get(volume.zip_fn)
+        if volume.isLoaded() or info is None or info[3] != volume.size():
+            new_info = volume.summary()
+            if new_info != info:
+                self.volume_info[volume.zip_fn] = info = new_info
+                self._manifestDirty = True
+        return info
+
+    def _volumeFor(self, msg):
+        '''Returns the volume for storing the message `msg`'''
+        if self.scheme is None:
+            return self._volume(self.zip_fn)
+        if self.scheme == 'month':
+            vol_fn = self._volumeFilename(time.strftime('%Y-%m', _getMailDate(msg)))
+        else:
+            numbered = [i for i in sorted(self.volumes) if self._volumeNumber(i) is not None]
+            if numbered and self.volumes[numbered[-1]].size() < self.scheme:
+                vol_fn = numbered[-1]
+            else:
+                number = 1
+                if numbered:
+                    number = self._volumeNumber(numbered[-1]) + 1
+                vol_fn = self._volumeFilename('%04d' % number)
+        if vol_fn not in self.volumes:
+            self.notifier.nLog(_("Starting new volume %s") % vol_fn)
+        return self._volume(vol_fn)
+
+    def _allEntries(self):
+        for volume in self._sortedVolumes():
+            for entry in volume.sortedEntries():
+                yield volume, entry
+
+    def _readDownloadedIds(self, bloom=False):
+        self.catalog = MessageCatalog(self.idsFilename(), bloom)
+        if not self.catalog.read(self.notifier):
+            for volume, entry in self._allEntries():
+                self.catalog.add(entry.msg_iid, entry.name)
+
+    def storedFiles(self):
+        return sorted(entry.name for (volume, entry) in self._allEntries())
+
+    def computeChecksums(self, names, jobs=1):
+        names = set(names)
+        groups = []
+        for volume in self._sortedVolumes():
+            groups.append((volume.zip_fn, sorted(names.intersection(volume.entries))))
+        return _mapChunks(_hashZipMembers, groups, jobs)
+
+    def iterMessages(self, names):
+        located = dict((entry.name, (volume, entry)) for (volume, entry) in self._allEntries())
+        files = {}
+        try:
+            for name in names:
+                volume, entry = located[name]
+                if volume.zip_fn not in files:
+                    files[volume.zip_fn] = file(volume.zip_fn, 'rb')
+                yield name, entry.readMessage(files[volume.zip_fn])
+        finally:
+            for fr in files.itervalues():
+                fr.close()
+
+    def search(self, query, limit=None):
+        index = self._getIndex()
+        if index is None:
+            return None
+        self.updateIndex()
+        return index.search(query, limit)
 
-                    msg_date2 = _getMailDate(msg)
-                    msg_date2_num = time.mktime(msg_date2)
-                    if (since_time is None or since_time < msg_date2_num) \
-                    and (before_time is None or msg_date2_num < before_time):
-                        yield msg_fn, msg
+    def _overlaps(self, volume, since_time, before_time):
+        count, min_date, max_date, size = self._volumeSummary(volume)
+        return count > 0 and (since_time is None or since_time < max_date) \
+           and (before_time is None or min_date < before_time)
+
+    def iterBackups(self, since_time=None, before_time=None, logging=True):
+        # Only the volumes overlapping the requested interval are opened
+        # and the dates of their members are taken from the side index, so
+        # the members outside the interval are not read at all
+        volumes = [v for v in self._sortedVolumes() if self._overlaps(v, since_time, before_time)]
+        listing = [(volume, entry) for volume in volumes for entry in volume.sortedEntries()]
+        files = {}
+        try:
+            for idx, (volume, entry) in enumerate(listing):
+                try:
+                    if (since_time is None or since_time < entry.date) \
+                    and (before_time is None or entry.date < before_time):
+                        if volume.zip_fn not in files:
+                            files[volume.zip_fn] = file(volume.zip_fn, 'rb')
+                        msg = entry.readMessage(files[volume.zip_fn])
+                        yield entry.name, msg
                         if logging:
                             from_address, subject = _getMailInitials(msg)
                             self.notifier.nEmailRestore(from_address, subject, idx+1, len(listing))
                     else:
                         if logging:
-                            from_address, subject = _getMailInitials(msg)
-                            self.notifier.nEmailRestoreSkip(from_address, subject, idx+1, len(listing))
+                            self.notifier.nEmailRestoreSkip(entry.name, u'', idx+1, len(listing))
                 except:
                     if isinstance(sys.exc_info()[1], GeneratorExit):
                         break
                     self.notifier.handleError(_("Error occured while reading e-mail from disc"))
+        finally:
+            for fr in files.itervalues():
+                fr.close()
 
-    def store(self, msg):
-        if not os.path.exists(self.zip_fn):
-            zip = zipfile.ZipFile(self.zip_fn, 'w', zipfile.ZIP_DEFLATED)
-        else:
-            zip = zipfile.ZipFile(self.zip_fn, 'a', zipfile.ZIP_DEFLATED)
-
-        listing = zip.namelist()
-
+    def store(self, msg, internaldate=None):
         msg_fn = self.getMailFilename(msg)
         msg_iid = _getMailInternalId(msg)
+        volume = self._volumeFor(msg)
         idx = 1
         while True:
-            msg_fn_num = '%s-%01d.eml'%(msg_fn, idx)
+            msg_fn_num = '%s-%01d.eml%s'%(msg_fn, idx, self.codec.zipExtension())
             idx += 1
-            if not msg_fn_num in listing:
+            if not msg_fn_num in volume.entries and not self.catalog.hasFile(msg_fn_num):
                 break
-        self.message_iid2fn[msg_iid] = msg_fn_num
-        self.message_fn2iid[msg_fn_num] = msg_iid
-        zip.writestr(msg_fn_num, msg)
-        zip.close()
+        self.catalog.add(msg_iid, msg_fn_num)
+        def write(msg_fn, encoded):
+            volume.append(msg_fn, msg, encoded)
+        self._storeEncoded(msg_fn_num, msg, internaldate, self.codec.compressZip, write)
+        if self.scheme is not None:
+            self._manifestDirty = True
+
+    def storeComplete(self):
+        super(ZipStorage, self).storeComplete()
+        if self._manifestDirty:
+            self._writeManifest()
+
+
+class VerifyResult(object):
+    '''Result of the verification of one backup, the lists contain the names
+    of the stored messages or Message-IDs for the server cross-check
+    '''
+    def __init__(self):
+        self.checked = 0
+        self.missing = []
+        self.corrupt = []
+        self.extra = []
+        self.unchecked = []
+        self.server = None
+        self.not_stored = []
+        self.local_only = []
+
+    @property
+    def ok(self):
+        return not (self.missing or self.corrupt or self.extra or self.not_stored)
 
 
 class GMailBackup(object):
@@ -1156,41 +4497,97 @@ class GMailBackup(object):
         self.password = password
         self.connection = GMailConnection(username, password, notifier, lang)
 
-    def iterMails(self, where, skip=[]):
+    def _useLayout(self, storage):
+        '''The mailboxes are not discovered on connect if their layout is
+        stored with the backup, the discovered layout is stored'''
+        layout = storage.readLayout()
+        if layout is not None and self.connection.ALL_MAILS is None:
+            self.connection.setLayout(layout, cached=True)
+        self.connection.onLayout = storage.writeLayout
+
+    def iterMails(self, where, skip=[], close=True):
         self.connection.select(self.connection.ALL_MAILS)
 
         numbers = self.connection.search(where)
 
+        # The Message-IDs, sizes and dates are fetched by INFO_CHUNK messages
+        # and the new messages of the chunk are downloaded before the next
+        # one, only the running totals of the plan are kept
+        planned = 0
+        planned_size = 0
+        done = 0
         skipped = 0
-        for idx, num in enumerate(numbers):
-            try:
-                imsg_id = self.connection.fetchMessageId(num)
-                if imsg_id in skip:
-                    skipped += 1
-                    self.notifier.nEmailBackupSkip(idx+1, len(numbers), skipped, len(skip))
+        try:
+            for start in xrange(0, len(numbers), INFO_CHUNK):
+                chunk = numbers[start:start+INFO_CHUNK]
+                try:
+                    infos = self.connection.fetchMessageInfo(chunk)
+                except:
+                    self.notifier.handleError(_("Error occured while downloading e-mail"))
                     continue
 
-                msg = self.connection.fetchMessage(num)
-                yield msg
-                from_address, subject = _getMailInitials(msg)
-                self.notifier.nEmailBackup(from_address, subject, idx+1, len(numbers))
-            except:
-                if isinstance(sys.exc_info()[1], GeneratorExit):
-                    break
+                new = []
+                for idx, num in enumerate(chunk):
+                    if num not in infos:
+                        continue
+                    if infos[num].msg_id in skip:
+                        skipped += 1
+                        self.notifier.nEmailBackupSkip(start+idx+1, len(numbers), skipped, len(skip))
+                    else:
+                        new.append((num, infos[num]))
+                del infos
+                planned += len(new)
+                planned_size += sum(info.size for (num, info) in new)
+                self.notifier.nBackupPlan(planned, planned_size, start+len(chunk), len(numbers))
+
+                # Small messages are downloaded in batches by one FETCH, the
+                # large ones alone. The batches are formed lazily, while the
+                # commands are sent.
+                by_set = {}
+                def sets():
+                    for batch in _sizeBatches(new):
+                        message_set = messageSet(num for (num, info) in batch)
+                        by_set[message_set] = batch
+                        yield message_set
+                for message_set, command in self.connection.fetchMany(sets(), '(BODY.PEEK[])'):
+                    batch = by_set.pop(message_set)
+                    try:
+                        typ, data = command.result()
+                        bodies = {}
+                        for num, items in parseFetch(data, uid=True):
+                            bodies.setdefault(num, {}).update(items)
+                    except:
+                        if isinstance(sys.exc_info()[1], GeneratorExit):
+                            raise
+                        self.notifier.handleError(_("Error occured while downloading e-mail"))
+                        continue
+                    for num, info in batch:
+                        try:
+                            if 'BODY[]' not in bodies.get(num, {}):
+                                self.notifier.nError(_("Message %s disappeared from the server") % num)
+                                continue
+                            msg = str(bodies[num]['BODY[]'])
+                            done += 1
+                            yield msg, info.internaldate
+                            from_address, subject = _getMailInitials(msg)
+                            self.notifier.nEmailBackup(from_address, subject, done, planned, info.size)
+                        except:
+                            if isinstance(sys.exc_info()[1], GeneratorExit):
+                                raise
+                            self.notifier.handleError(_("Error occured while downloading e-mail"))
+        except:
+            if not isinstance(sys.exc_info()[1], GeneratorExit):
                 self.notifier.handleError(_("Error occured while downloading e-mail"))
 
-        self.connection.close()
+        if close:
+            self.connection.release()
 
     def getLabels(self):
-        ret = self.connection.list()
         labels = []
-        for i in ret:
-            match = re.match(r'^(\(.*\))\s".*?"\s"(.*)"\s*$', i)
-            flags = match.group(1)
+        for flags, delimiter, label in self.connection.list():
             if '\\HasNoChildren' not in flags:
                 continue
-            label = match.group(2)
-            if not re.match(r'^\[.*\].*$', label) and label != 'INBOX':
+            if not SYSTEM_MAILBOX.match(label) and label != 'INBOX':
                 labels.append(label)
         labels.append('INBOX')
         return labels
@@ -1213,10 +4610,11 @@ class GMailBackup(object):
         for num in numbers:
             yield self.connection.fetchMessageId(num)
 
-    def labelAssignment(self, where=['ALL']):
+    def labelAssignment(self, where=['ALL'], connect=True):
         assignment = {}
 
-        self.connection.connect()
+        if connect:
+            self.connection.open()
         for i in self.getLabels():
             try:
                 for msg in self.msgsWithLabel(i, where):
@@ -1227,8 +4625,8 @@ class GMailBackup(object):
                 self.notifier.handleError(_("Error while doing backup of label %r") % i)
         return assignment
 
-    def backup(self, fn, where=['ALL'], stamp=False):
-        storage = EmailStorage.createStorage(fn, self.notifier)
+    def backup(self, fn, where=['ALL'], stamp=False, options=None):
+        storage = EmailStorage.createStorage(fn, self.notifier, options)
 
         last_time = storage.lastStamp()
         if last_time is not None:
@@ -1244,33 +4642,146 @@ class GMailBackup(object):
         self.notifier.nVersion()
         self.notifier.nBackup(False, self.username, fn)
 
-        self.connection.connect()
+        checkpoint = storage.readCheckpoint()
+        if checkpoint is not None:
+            self.notifier.nLog(_("Resuming the interrupted backup"))
+            wait = checkpoint['resume_after'] - time.time()
+            if wait > 0:
+                self.notifier.nLog(_("Gmail bandwidth limit exceeded, pausing until %s") % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(checkpoint['resume_after'])))
+                time.sleep(wait)
+
+        self._useLayout(storage)
+        self.connection.open()
+
+        # The download and the backup of labels share one connection
+        last_time = self._storeMails(storage, where, last_time, close=False)
+        self.connection.keepAlive()
+
+        self.notifier.nLabelsBackup(False)
+
+        assignment = self.labelAssignment(where, connect=False)
+        storage.updateLabelAssignment(assignment)
+
+        self.notifier.nLabelsBackup(True)
+        self.connection.release()
+
+        storage.updateStamp(last_time)
+        storage.removeCheckpoint()
+
+        self.notifier.nBackup(True, self.username, fn)
+    
+    def _storeMails(self, storage, where, last_time, close=True):
+        '''Downloads the messages matching `where` which are not stored in
+        the `storage` yet and stores them, returns the date of the newest
+        message (the stamp) updated from `last_time`
+        '''
+        def checkpoint(resume_after):
+            # Flush the catalog, so the backup can be resumed even if the
+            # program is terminated during the pause
+            storage.storeComplete()
+            storage.writeCheckpoint({'resume_after': resume_after})
+
+        def parse(item):
+            # The stamp uses the INTERNALDATE, the server searches by it,
+            # the Date header is parsed only if the INTERNALDATE is missing
+            msg, internaldate = item
+            msg_date = _parseInternalDate(internaldate)
+            if msg_date is None:
+                try:
+                    msg_date = _getMailDate(msg)
+                except:
+                    pass
+            return msg, internaldate, msg_date
 
         downloaded = storage.idsOfMessages()
 
+        # The messages are downloaded, parsed and stored by the stages of
+        # the pipeline, so the network transfer overlaps with the disk
+        # writes. The messages are stored in the order of downloading.
+        pipeline = StagePipeline(self.iterMails(where, downloaded, close), [parse])
+        def pause(resume_after):
+            pipeline.call(checkpoint, resume_after)
+        self.connection.onPause = pause
+
         try:
-            for msg in self.iterMails(where, downloaded):
+            for msg, internaldate, msg_date in pipeline:
                 try:
-                    storage.store(msg)
-                    msg_date = _getMailDate(msg)
+                    if msg_date is None:
+                        msg_date = _getMailDate(msg)
+                    storage.store(msg, internaldate)
                     if msg_date > last_time or last_time is None:
                         last_time = msg_date
                 except:
                     self.notifier.handleError(_("Error while saving e-mail"))
         finally:
+            self.connection.onPause = None
             storage.storeComplete()
+        return last_time
 
-        self.notifier.nLabelsBackup(False)
-
-        assignment = self.labelAssignment(where)
-        storage.updateLabelAssignment(assignment)
+    def daemon(self, fn, options=None, reconcile=DAEMON_RECONCILE):
+        '''Keeps the backup `fn` up to date until it is interrupted
+
+        The connection and the catalog of the storage stay open. The daemon
+        waits by IMAP IDLE for the new messages in All Mail and downloads
+        the messages with UIDs from the last UIDNEXT, so every new message
+        is stored within seconds. The labels are reconciled every
+        `reconcile` seconds, but only if HIGHESTMODSEQ of All Mail
+        (CONDSTORE) changed since the last reconciliation. The state
+        (UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ) is saved after every
+        change, so the restarted daemon resumes where it stopped.
+        '''
+        storage = EmailStorage.createStorage(fn, self.notifier, options)
+        state = storage.readDaemonState()
+        self._useLayout(storage)
+        self.connection.condstore = True
 
-        self.notifier.nLabelsBackup(True)
+        self.notifier.nVersion()
+        self.notifier.nDaemon(False, self.username, fn)
 
-        storage.updateStamp(last_time)
+        last_time = storage.lastStamp()
+        self.connection.connect()
+        try:
+            while True:
+                mailbox = self.connection.selectState(self.connection.ALL_MAILS)
+                if 'uidnext' in state and mailbox.get('uidvalidity') == state.get('uidvalidity'):
+                    where = ['UID', '%d:*' % state['uidnext']]
+                else:
+                    # The first run or the UIDs were invalidated, the
+                    # messages since the last stamp are checked
+                    where = ['ALL']
+                    if last_time is not None:
+                        where += ['SINCE', _convertTime(time.strftime('%Y%m%d', last_time))]
+                if mailbox.get('uidnext') != state.get('uidnext') or where[0] == 'ALL':
+                    last_time = self._storeMails(storage, where, last_time, close=False)
+                    storage.updateStamp(last_time)
+                    storage.removeCheckpoint()
+                    for key in ('uidvalidity', 'uidnext'):
+                        if key in mailbox:
+                            state[key] = mailbox[key]
+                    storage.writeDaemonState(state)
+
+                if time.time() - state.get('reconciled', 0) >= reconcile:
+                    modseq = mailbox.get('highestmodseq')
+                    if modseq is None or modseq != state.get('highestmodseq'):
+                        self.notifier.nLabelsBackup(False)
+                        storage.updateLabelAssignment(self.labelAssignment(['ALL'], connect=False))
+                        self.notifier.nLabelsBackup(True)
+                        if modseq is not None:
+                            state['highestmodseq'] = modseq
+                    state['reconciled'] = int(time.time())
+                    storage.writeDaemonState(state)
+                    self.connection.select(self.connection.ALL_MAILS)
+
+                timeout = min(IDLE_TIMEOUT, max(state['reconciled'] + reconcile - time.time(), 1))
+                self.connection.idle(timeout)
+        except KeyboardInterrupt:
+            # The daemon is stopped by the user
+            pass
+        finally:
+            storage.storeComplete()
+            self.connection.drop()
+        self.notifier.nDaemon(True, self.username, fn)
 
-        self.notifier.nBackup(True, self.username, fn)
-    
     def restoreLabels(self, assignment, min_date, max_date):
         self.connection.select(self.connection.ALL_MAILS)
 
@@ -1291,7 +4802,7 @@ class GMailBackup(object):
                 if imsg_id in assignment:
                     for label in assignment[imsg_id]:
                         if label not in message_by_labels:
-                            message_by_labels[label] = []
+                            message_by_labels[label] = array('L')
                         message_by_labels[label].append(num)
                         labels.add(label)
                 self.notifier.nLabelsRestore(idx+1, len(numbers))
@@ -1300,53 +4811,148 @@ class GMailBackup(object):
 
         for label in labels:
             try:
-                message_set = message_by_labels[label]
-                message_set = ','.join(message_set)
+                message_set = messageSet(message_by_labels[label])
                 self.connection.create(label)
                 self.connection.copy(message_set, label)
             except:
                 self.notifier.handleError(_("Error while restoring label %r") % label)
 
-    def restore(self, fn, since_time=None, before_time=None):
+    def restore(self, fn, since_time=None, before_time=None, options=None):
         if since_time:
             since_time = _convertTimeToNum(since_time)
         if before_time:
             before_time = _convertTimeToNum(before_time)
         self.notifier.nVersion()
         self.notifier.nRestore(False, self.username, fn)
-        self.connection.connect()
 
-        storage = EmailStorage.createStorage(fn, self.notifier)
+        storage = EmailStorage.createStorage(fn, self.notifier, options)
+        self._useLayout(storage)
+        self.connection.open()
 
+        days = set()
         dates = set()
         for msg_fn, msg in storage.iterBackups(since_time, before_time):
             try:
-                msg_date = _getMailIMAPDate(msg)
-                msg_date2 = _getMailDate(msg)
-                msg_iid = _getMailInternalId(msg)
-                self.connection.append(self.connection.ALL_MAILS, "(\Seen)", msg_date, msg)
-
-                dates.add(msg_date2)
+                # The messages are appended with their INTERNALDATE stored
+                # in the catalog, the older backups without it fall back to
+                # the Date header
+                internaldate = storage.internalDate(msg_fn)
+                day = _internalDay(internaldate)
+                if day is not None:
+                    self.connection.append(self.connection.ALL_MAILS, "(\Seen)", '"%s"' % internaldate, msg)
+                    days.add(day)
+                else:
+                    msg_date = _getMailDate(msg)
+                    self.connection.append(self.connection.ALL_MAILS, "(\Seen)", imaplib.Time2Internaldate(msg_date), msg)
+                    dates.add(msg_date)
             except:
                 self.notifier.handleError(_("Error while restoring e-mail"))
 
         if dates:
+            # The Date headers are unreliable, the window is padded by a day
             min_date, max_date = _shiftDates(min(dates), max(dates))
-            min_date = imaplib.Time2Internaldate(min_date)
-            max_date = imaplib.Time2Internaldate(max_date)
+            days.add(tuple(min_date[:3]))
+            days.add(tuple(max_date[:3]))
+        if days:
+            # SEARCH compares only the days of the INTERNALDATE
+            min_date = _imapDate(min(days))
+            max_date = _imapDate(max(days), 1)
             assignment = storage.getLabelAssignment()
+            self.connection.keepAlive()
             self.restoreLabels(assignment, min_date, max_date)
+        self.connection.release()
         self.notifier.nRestore(True, self.username, fn)
 
+    def verify(self, fn, jobs=VERIFY_JOBS, server=False):
+        '''Verifies the backup `fn` against its catalog and the checksums
+        recorded at store time
+
+        The stored messages are hashed by `jobs` processes. If `server` is
+        True, the Message-IDs of the catalog are compared with the messages
+        in the Gmail account. Returns VerifyResult.
+        '''
+        self.notifier.nVersion()
+        if not EmailStorage.storageExists(fn):
+            self.notifier.nError(_("Backup %s doesn't exist") % fn)
+            return None
+        self.notifier.nVerify(False, self.username, fn)
+        result = VerifyResult()
+
+        storage = EmailStorage.createStorage(fn, self.notifier)
+        catalog = storage.catalogFiles()
+        stored = storage.storedFiles()
+        stored_set = set(stored)
+        sums = storage.storedChecksums()
+
+        for name in sorted((catalog | storage.labelledFiles()) - stored_set):
+            result.missing.append(name)
+            self.notifier.nVerifyProblem('missing', name)
+        for name in stored:
+            if name not in catalog:
+                result.extra.append(name)
+                self.notifier.nVerifyProblem('extra', name)
+
+        if sha256 is None:
+            self.notifier.nError(_("Checksums are not supported by this version of Python"))
+            result.unchecked = stored
+        else:
+            for name, digest in storage.computeChecksums(stored, jobs):
+                result.checked += 1
+                expected = sums.get(name)
+                if digest is None or (expected is not None and expected != digest):
+                    result.corrupt.append(name)
+                    self.notifier.nVerifyProblem('corrupt', name)
+                elif expected is None:
+                    result.unchecked.append(name)
+                self.notifier.nVerifyProgress(result.checked, len(stored))
+        result.corrupt.sort()
+        result.unchecked.sort()
+
+        if server:
+            self._useLayout(storage)
+            self.connection.open()
+            self.connection.select(self.connection.ALL_MAILS)
+            numbers = self.connection.search(['ALL'])
+            on_server = set(self.connection.fetchMessageIds(numbers).itervalues())
+            self.connection.release()
+            backed_up = storage.idsOfMessages()
+            result.server = len(on_server)
+            result.not_stored = sorted(msg_iid for msg_iid in on_server if msg_iid not in backed_up)
+            result.local_only = sorted(msg_iid for msg_iid in backed_up if msg_iid not in on_server)
+            for msg_iid in result.not_stored:
+                self.notifier.nVerifyProblem('not_stored', msg_iid)
+
+        self.notifier.nVerifySummary(result)
+        self.notifier.nVerify(True, self.username, fn)
+        return result
+
+    def search(self, fn, query, limit=None, options=None):
+        '''Returns the paths of messages in the backup `fn` matching the
+        full-text `query`, the messages not yet indexed are indexed first
+        (the `options` of the storage give the unfilter chain to read them)
+        '''
+        if not EmailStorage.storageExists(fn):
+            self.notifier.nError(_("Backup %s doesn't exist") % fn)
+            return None
+        storage = EmailStorage.createStorage(fn, self.notifier, options)
+        try:
+            ret = storage.search(query, limit)
+        except sqlite3.OperationalError, e:
+            self.notifier.nError(_("Bad search query: %s") % e)
+            return None
+        if ret is None:
+            self.notifier.nError(_("Full-text search is not supported by this version of Python"))
+        return ret
+
     def clear(self):
         self.notifier.nVersion()
         self.notifier.nClear(False, self.username)
-        self.connection.connect()
+        self.connection.open()
 
         self.connection.select(self.connection.ALL_MAILS)
 
         data = self.connection.search(['ALL'])
-        nums = ','.join(data)
+        nums = messageSet(data)
         if nums:
             self.connection.copy(nums, self.connection.TRASH)
             self.connection.store(nums, 'FLAGS.SILENT', '\\Deleted')
@@ -1355,29 +4961,23 @@ class GMailBackup(object):
         self.connection.select(self.connection.TRASH)
         data = self.connection.search(['ALL'])
         if nums:
-            nums = ','.join(data)
+            nums = messageSet(data)
             self.connection.store(nums, 'FLAGS.SILENT', '\\Deleted')
             self.connection.expunge()
 
         for label in self.getLabels():
             self.connection.delete(label)
 
-        self.connection.close()
+        self.connection.release()
         self.notifier.nClear(True, self.username)
 
     def list(self):
         self.connection.connect(noguess=True)
 
-        ret = self.connection.list()
-
-        for i in ret:
-            match = re.match(r'^\(.*\)\s".*"\s"(.*)"\s*$', i)
-            box = match.groups(1)[0]
-
+        for flags, delimiter, box in self.connection.list():
             self.connection.select(box)
             try:
-                data = self.connection.search(['ALL'])
-                num = len(data)
+                num = self.connection.searchCount(['ALL'])
             except imaplib.IMAP4.error:
                 num = -1
             yield box, num
@@ -1410,3 +5010,241 @@ class GMailBackup(object):
             msg = _("You are using the latest version of GMail Backup.")
         self.notifier.nLog(msg)
         return version
+
+class BatchTimeout(Exception):
+    pass
+
+class BatchResult(object):
+    def __init__(self, username, dirname):
+        self.username = username
+        self.dirname = dirname
+        self.ok = False
+        self.attempts = 0
+        self.elapsed = 0.
+        self.stored = 0
+        self.skipped = 0
+        self.errors = 0
+        self.error = None
+        self.received = 0
+
+class BatchNotifier(ConsoleNotifier):
+    '''Notifier used for one account of the batch
+
+    The messages are prefixed with the account name and passed to the batch
+    runner. The notifier also enforces the per-account timeout, it raises
+    BatchTimeout from the worker thread once the deadline expires.
+    '''
+    FATAL_ERRORS = ConsoleNotifier.FATAL_ERRORS + [BatchTimeout]
+
+    def __init__(self, batch, result, deadline=None):
+        super(BatchNotifier, self).__init__()
+        self.batch = batch
+        self.result = result
+        self.deadline = deadline
+
+    def checkDeadline(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            self.deadline = None
+            raise BatchTimeout(_("Timeout expired for account %s") % self.result.username)
+
+    def uprint(self, msg):
+        self.batch.uprint(u'[%s] %s' % (self.result.username, msg))
+
+    def uprint2(self, msg):
+        pass
+
+    def nVersion(self):
+        pass
+
+    def nSpeed(self, amount, d):
+        self.result.received += amount
+        super(BatchNotifier, self).nSpeed(amount, d)
+        self.checkDeadline()
+
+    def nEmailBackup(self, from_address, subject, num, total, size=0):
+        self.result.stored += 1
+        super(BatchNotifier, self).nEmailBackup(from_address, subject, num, total, size)
+        self.checkDeadline()
+
+    def nEmailBackupSkip(self, num, total, skipped, total_to_skip):
+        self.result.skipped += 1
+        self.checkDeadline()
+
+    def nError(self, msg):
+        self.result.errors += 1
+        super(BatchNotifier, self).nError(msg)
+
+    def nLog(self, msg):
+        super(BatchNotifier, self).nLog(msg)
+        self.checkDeadline()
+
+    def nException(self, type, error, tb):
+        if isinstance(error, BatchTimeout):
+            self.nError(unicode(error))
+        else:
+            super(BatchNotifier, self).nException(type, error, tb)
+
+class BatchBackup(object):
+    '''Backup of many accounts listed in the manifest file
+
+    The accounts are processed by a pool of `jobs` worker threads, so at most
+    `jobs` accounts are backed up at once. Every account has its own
+    `GMailBackup` instance and `BatchNotifier`, the failed accounts are
+    retried up to `retries` times.
+    '''
+    def __init__(self, notifier, jobs=BATCH_JOBS, timeout=None, retries=0):
+        self.notifier = notifier
+        self.jobs = max(jobs, 1)
+        self.timeout = timeout
+        self.retries = max(retries, 0)
+        self.connections = AdaptiveLimit(self.jobs, 1, self.jobs)
+        self._printLock = threading.Lock()
+        self._active = 0
+        self._activeCond = threading.Condition()
+
+    @classmethod
+    def readManifest(cls, fn):
+        '''Reads the manifest file and returns the list of accounts
+
+        Each line of the manifest describes one account with whitespace
+        separated fields: dirname, username, password and optional since and
+        before dates in the format YYYYMMDD. Empty lines and lines starting
+        with # are ignored.
+        '''
+        accounts = []
+        fr = file(fn, 'r')
+        try:
+            for lineno, line in enumerate(fr):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                items = line.split()
+                if not 3 <= len(items) <= 5:
+                    raise ValueError(_("Bad line %d in manifest %s") % (lineno+1, fn))
+                items += [None] * (5-len(items))
+                dirname, username, password, since, before = items
+                accounts.append({'dirname': dirname, 'username': username,
+                    'password': password, 'since': since, 'before': before})
+        finally:
+            fr.close()
+        return accounts
+
+    def uprint(self, msg):
+        self._printLock.acquire()
+        try:
+            self.notifier.uprint(msg)
+        finally:
+            self._printLock.release()
+
+    def _where(self, since, before):
+        where = ['ALL']
+        if since:
+            where.append('SINCE')
+            where.append(_convertTime(since))
+        if before:
+            where.append('BEFORE')
+            where.append(_convertTime(before))
+        return where
+
+    def backupAccount(self, account, stamp=False):
+        result = BatchResult(account['username'], account['dirname'])
+        t1 = time.time()
+        if self.timeout:
+            deadline = t1 + self.timeout
+        else:
+            deadline = None
+        while True:
+            result.attempts += 1
+            notifier = BatchNotifier(self, result, deadline)
+            b = GMailBackup(account['username'], account['password'], notifier)
+            try:
+                try:
+                    where = self._where(account['since'], account['before'])
+                    b.backup(account['dirname'], where, stamp=stamp)
+                    result.ok = True
+                    result.error = None
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    type, error, tb = sys.exc_info()
+                    notifier.nException(type, error, tb)
+                    result.error = unicode(error) or type.__name__
+                    if _isConnectionLimit(error):
+                        self.connections.failure('throttle')
+            finally:
+                b.connection.drop()
+            if result.ok or result.attempts > self.retries:
+                break
+            if deadline is not None and time.time() + BATCH_RETRY_SLEEP > deadline:
+                break
+            notifier.nLog(_("Retrying in %d seconds") % BATCH_RETRY_SLEEP)
+            time.sleep(BATCH_RETRY_SLEEP)
+        result.elapsed = time.time() - t1
+        return result
+
+    def _worker(self, queue, results, stamp):
+        while True:
+            # The number of concurrently processed accounts is limited by
+            # self.connections, which shrinks if Gmail starts to throttle us
+            self._activeCond.acquire()
+            try:
+                while self._active >= self.connections.value():
+                    self._activeCond.wait(1)
+                try:
+                    idx, account = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                self._active += 1
+            finally:
+                self._activeCond.release()
+            try:
+                t1 = time.time()
+                results[idx] = self.backupAccount(account, stamp)
+                if results[idx].ok and results[idx].received:
+                    # The limit follows the bytes per second of the accounts,
+                    # an account which transferred nothing says nothing
+                    self.connections.success(results[idx].received, time.time()-t1)
+            finally:
+                self._activeCond.acquire()
+                try:
+                    self._active -= 1
+                    self._activeCond.notifyAll()
+                finally:
+                    self._activeCond.release()
+
+    def run(self, accounts, stamp=False):
+        '''Backs up all `accounts` and returns the list of BatchResult'''
+        self.notifier.nVersion()
+        queue = Queue.Queue()
+        for idx, account in enumerate(accounts):
+            queue.put((idx, account))
+        results = [None] * len(accounts)
+
+        threads = []
+        for i in range(min(self.jobs, len(accounts))):
+            t = threading.Thread(target=self._worker, args=(queue, results, stamp))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            # Join with timeout, otherwise KeyboardInterrupt is not delivered
+            while t.isAlive():
+                t.join(1)
+
+        self.nSummary(results)
+        return results
+
+    def nSummary(self, results):
+        n_ok = 0
+        self.uprint(_("Summary of the batch backup:"))
+        for r in results:
+            if r.ok:
+                n_ok += 1
+                state = _("OK")
+            else:
+                state = _("FAILED")
+            self.uprint(_("%-6s %s (%s): %d stored, %d skipped, %d errors, %d attempts, %s") % \
+                    (state, r.username, r.dirname, r.stored, r.skipped, r.errors, r.attempts, _formatElapsed(r.elapsed)))
+            if r.error:
+                self.uprint(_("       %s") % r.error)
+        self.uprint(_("%d of %d accounts backed up successfully") % (n_ok, len(results)))
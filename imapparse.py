@@ -0,0 +1,315 @@
+#!/usr/bin/env python2.5
+# -*-  coding: utf-8 -*-
+#
+#   Gmail Backup IMAP response parsing
+#
+#   Copyright © 2008, 2009, 2010 Jan Svec <honza.svec@gmail.com> and Filip Jurcicek <filip.jurcicek@gmail.com>
+#
+#   This file is part of Gmail Backup.
+#
+#   Gmail Backup is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Gmail Backup is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Gmail Backup.  If not, see <http://www.gnu.org/licenses/
+#
+#   See LICENSE file for license details
+
+'''Parsing of the IMAP responses returned by imaplib
+
+The responses are tokenized by a single compiled regular expression. The
+tokenizer understands quoted strings, literals (the (prefix, literal) tuples
+of imaplib), parenthesized lists and atoms containing section specifiers
+like BODY[HEADER.FIELDS (MESSAGE-ID)]. The modified UTF-7 codec used for
+mailbox names memoizes its results, because the same label names are
+converted over and over again.
+'''
+
+import re
+from array import array
+
+MEMO_SIZE = 10000
+
+_TOKEN = re.compile(r'''
+    [ \t\r\n]*
+    (?:
+        (?P<open>\()
+      | (?P<close>\))
+      | "(?P<quoted>(?:[^"\\]|\\.)*)"
+      | \{(?P<literal>\d+)\}[ \t\r\n]*$
+      | (?P<atom>(?:[^ \t\r\n()"\[\]{}]|\[[^\]]*\])+)
+    )''', re.VERBOSE | re.DOTALL)
+_SPACE = re.compile(r'[ \t\r\n]*$')
+_LIST = re.compile(r'^\(([^()"{}]*)\) (?:"((?:[^"\\]|\\.)*)"|(NIL)) "((?:[^"\\]|\\.)*)"\s*$')
+_UNESCAPE = re.compile(r'\\([\\"])')
+_ESCAPE = re.compile(r'([\\"])')
+_DECODE = re.compile('&(.*?)-')
+_ENCODE = re.compile('([^\x20-\x25\x27-\x7e]+|&)')
+
+SYSTEM_MAILBOX = re.compile(r'^\[.*\].*$')
+MESSAGE_ID_HEADER = re.compile(r'^.*:\s*<(.*)>$')
+EMAIL_ADDRESS = re.compile(r"^.*<(.*@.*\..*)>.*$")
+
+class ParseError(ValueError):
+    pass
+
+class Quoted(str):
+    '''Quoted string or literal, it is never interpreted as NIL
+    '''
+    pass
+
+class _Memo(dict):
+    '''Cache of the results of `function`, it is cleared when it grows over
+    `size` items
+    '''
+    def __init__(self, function, size=MEMO_SIZE):
+        super(_Memo, self).__init__()
+        self.function = function
+        self.size = size
+
+    def __missing__(self, key):
+        if len(self) >= self.size:
+            self.clear()
+        value = self[key] = self.function(key)
+        return value
+
+def _decodeSub(m):
+    ss = m.group(1)
+    if not ss:
+        return '&'
+    else:
+        ss = ('+'+ss+'-').replace(',', '/')
+        return ss.decode('utf-7')
+
+def _encodeSub(m):
+    ss = m.group(1)
+    if ss == '&':
+        return '&-'
+    else:
+        return ss.encode('utf-7').replace('+', '&').replace('/', ',')
+
+def _decode(s):
+    return _DECODE.sub(_decodeSub, s)
+
+def _encode(s):
+    return _ENCODE.sub(_encodeSub, s).encode('ascii', 'replace')
+
+_decoded = _Memo(_decode)
+_encoded = _Memo(_encode)
+
+def imap_decode(s):
+    '''Decodes the mailbox name `s` from modified UTF-7
+    '''
+    if type(s) is str:
+        return _decoded[s]
+    return _decode(s)
+
+def imap_encode(s):
+    '''Encodes the mailbox name `s` into modified UTF-7
+    '''
+    if type(s) is unicode:
+        return _encoded[s]
+    return _encode(s)
+
+def imap_unescape(s):
+    if '\\' not in s:
+        return s
+    return _UNESCAPE.sub(r'\1', s)
+
+def imap_escape(s):
+    if '\\' not in s and '"' not in s:
+        return s
+    return _ESCAPE.sub(r'\\\1', s)
+
+def messageSet(nums):
+    '''Returns the IMAP message set of the message numbers `nums`, the runs
+    of consecutive numbers are joined into ranges (1:5,7,9:12)
+    '''
+    ret = []
+    start = prev = None
+    for num in nums:
+        num = int(num)
+        if prev is not None and num == prev + 1:
+            prev = num
+            continue
+        if start is not None:
+            ret.append(start == prev and str(start) or '%d:%d' % (start, prev))
+        start = prev = num
+    if start is not None:
+        ret.append(start == prev and str(start) or '%d:%d' % (start, prev))
+    return ','.join(ret)
+
+def parseSequenceSet(s):
+    '''Returns array('L') of the numbers of the IMAP sequence set `s` (e.g.
+    1:5,7,9:12), the ranges are expanded in the given order
+    '''
+    ret = array('L')
+    if not s:
+        return ret
+    for part in s.split(','):
+        if ':' in part:
+            start, end = part.split(':', 1)
+            start, end = int(start), int(end)
+            if start <= end:
+                ret.extend(xrange(start, end+1))
+            else:
+                ret.extend(xrange(start, end-1, -1))
+        else:
+            ret.append(int(part))
+    return ret
+
+def parseEsearch(data):
+    '''Parses the ESEARCH response `data` (RFC 4731)
+
+    Returns the dictionary mapping the upper-cased return options to their
+    values, MIN, MAX and COUNT are integers, ALL is array('L') of the
+    numbers. The flag UID is mapped to True.
+    '''
+    ret = {}
+    for response in iterResponses(data):
+        tokens = tokenize(response)
+        if tokens and isinstance(tokens[0], list):
+            # The correlator (TAG "A282")
+            tokens = tokens[1:]
+        idx = 0
+        while idx < len(tokens):
+            name = str(tokens[idx]).upper()
+            if name == 'UID':
+                ret[name] = True
+                idx += 1
+                continue
+            if idx + 1 >= len(tokens):
+                raise ParseError('Unexpected ESEARCH response: %r' % response)
+            value = tokens[idx+1]
+            if name == 'ALL':
+                value = parseSequenceSet(value)
+            elif name in ('MIN', 'MAX', 'COUNT'):
+                value = int(value)
+            ret[name] = value
+            idx += 2
+    return ret
+
+def iterResponses(data):
+    '''Groups the items of imaplib response `data` by responses
+
+    imaplib returns the text following a literal as a separate item, so the
+    response continues with the next item after each (prefix, literal)
+    tuple. The None items of empty responses are skipped.
+    '''
+    response = []
+    for item in data:
+        if item is None:
+            continue
+        if response and not isinstance(response[-1], tuple):
+            yield response
+            response = []
+        response.append(item)
+    if response:
+        yield response
+
+def tokenize(response):
+    '''Parses one response (list of imaplib items) into a nested list
+
+    Atoms are returned as str, NIL as None, quoted strings and literals as
+    Quoted and parenthesized lists as lists.
+    '''
+    stack = [[]]
+    for item in response:
+        if isinstance(item, tuple):
+            text, literal = item
+        else:
+            text, literal = item, None
+        pos = 0
+        end = len(text)
+        while pos < end:
+            match = _TOKEN.match(text, pos)
+            if match is None:
+                if _SPACE.match(text, pos):
+                    break
+                raise ParseError('Unparseable IMAP response: %r' % text[pos:])
+            pos = match.end()
+            kind = match.lastgroup
+            if kind == 'atom':
+                atom = match.group('atom')
+                if atom == 'NIL':
+                    atom = None
+                stack[-1].append(atom)
+            elif kind == 'quoted':
+                stack[-1].append(Quoted(imap_unescape(match.group('quoted'))))
+            elif kind == 'open':
+                lst = []
+                stack[-1].append(lst)
+                stack.append(lst)
+            elif kind == 'close':
+                if len(stack) == 1:
+                    raise ParseError('Unbalanced parenthesis in IMAP response: %r' % text)
+                stack.pop()
+            else:
+                if literal is None:
+                    raise ParseError('Missing literal in IMAP response: %r' % text)
+                stack[-1].append(Quoted(literal))
+                literal = None
+    if len(stack) != 1:
+        raise ParseError('Unbalanced parenthesis in IMAP response: %r' % response)
+    return stack[0]
+
+def parseList(data):
+    '''Parses the response `data` of LIST or LSUB command
+
+    Returns the list of triples (flags, delimiter, name), where the flags is
+    a tuple of strings, the delimiter is None for NIL and the name is the
+    unescaped mailbox name in modified UTF-7.
+    '''
+    ret = []
+    for response in iterResponses(data):
+        if len(response) == 1 and not isinstance(response[0], tuple):
+            # Fast path for the usual response with quoted name
+            match = _LIST.match(response[0])
+            if match:
+                flags, delimiter, nil, name = match.groups()
+                if delimiter is not None:
+                    delimiter = imap_unescape(delimiter)
+                ret.append((tuple(flags.split()), delimiter, imap_unescape(name)))
+                continue
+        tokens = tokenize(response)
+        if len(tokens) != 3 or not isinstance(tokens[0], list):
+            raise ParseError('Unexpected LIST response: %r' % response)
+        flags, delimiter, name = tokens
+        if delimiter is not None:
+            delimiter = str(delimiter)
+        if name is None:
+            name = 'NIL'
+        ret.append((tuple(flags), delimiter, str(name)))
+    return ret
+
+def parseFetch(data, uid=False):
+    '''Parses the response `data` of FETCH command
+
+    Returns the list of pairs (num, items), where the num is the message
+    number (the integer UID if `uid` is true) and the items is a dictionary mapping
+    upper-cased data item names to their values. With `uid` the responses
+    without UID (unsolicited flag updates) are skipped.
+    '''
+    ret = []
+    for response in iterResponses(data):
+        tokens = tokenize(response)
+        if len(tokens) != 2 or not isinstance(tokens[1], list) or len(tokens[1]) % 2:
+            raise ParseError('Unexpected FETCH response: %r' % response)
+        num, lst = tokens
+        items = {}
+        for i in xrange(0, len(lst), 2):
+            items[lst[i].upper()] = lst[i+1]
+        if uid:
+            num = items.get('UID')
+            if num is None:
+                continue
+            num = int(num)
+        ret.append((num, items))
+    return ret
@@ -39,6 +39,10 @@ setup(
     options = {'py2exe':
                     {'optimize': 2,
                      "dll_excludes": ["msvcp90.dll"],
+                     # gmb.py imports these modules lazily (_LazyModule),
+                     # modulefinder doesn't see them
+                     'includes': ['zipfile', 'gzip', 'shutil', 'urllib', 'sqlite3', 'bz2', 'shlex',
+                                  'svc.scripting.externals', 'multiprocessing'],
                     }
               },
     data_files = [
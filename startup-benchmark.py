@@ -0,0 +1,109 @@
+#!/usr/bin/env python2.5
+# -*-  coding: utf-8 -*-
+#
+#   Gmail Backup startup benchmark
+#
+#   Copyright © 2008, 2009, 2010 Jan Svec <honza.svec@gmail.com> and Filip Jurcicek <filip.jurcicek@gmail.com>
+#
+#   This file is part of Gmail Backup.
+#
+#   Gmail Backup is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   Gmail Backup is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with Gmail Backup.  If not, see <http://www.gnu.org/licenses/
+#
+#   See LICENSE file for license details
+
+'''Measures the startup time of gmail-backup.py and guards the budget
+
+Usage: startup-benchmark.py [budget_ms] [runs]
+
+The command `gmail-backup.py --help` is run `runs` times and the median of
+the wall clock times minus the median startup time of the bare interpreter
+is compared with the budget. The script also checks that importing gmb does
+not import the modules which are loaded lazily. The exit status is non-zero
+if the budget is exceeded or a lazy module is imported at the startup.
+
+The modules are compiled by compileall before the measurement, so the budget
+is checked against the startup of the installed program. Without the .pyc
+files (e.g. with PYTHONDONTWRITEBYTECODE set) every run compiles gmb.py and
+the startup takes more than twice as long.
+
+The budget comes from the measurement with Python 2.7.18 on Linux (x86-64,
+median of the runs): about 50 ms before the lazy imports, 30-37 ms after.
+'''
+
+import os
+import sys
+import time
+import subprocess
+import compileall
+
+STARTUP_BUDGET = 60     # Milliseconds over the bare interpreter startup
+STARTUP_RUNS = 15
+
+LAZY_MODULES = ['zipfile', 'gzip', 'shutil', 'urllib', 'multiprocessing',
+                'sqlite3', 'bz2', 'lzma', 'logging', 'inspect',
+                'email.utils', 'email.header']
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def _timeCommand(cmdline, runs):
+    times = []
+    devnull = file(os.devnull, 'w')
+    try:
+        for i in xrange(runs):
+            start = time.time()
+            ret = subprocess.call(cmdline, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+            if ret != 0:
+                raise RuntimeError('Command %r failed with exit status %d' % (cmdline, ret))
+    finally:
+        devnull.close()
+    return _median(times) * 1000.
+
+def _eagerModules(directory):
+    code = 'import sys; sys.path.insert(0, %r); import gmb, svc.scripting; print " ".join(sys.modules)' % directory
+    proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    loaded = set(out.split())
+    return [m for m in LAZY_MODULES if m in loaded]
+
+def main(budget=STARTUP_BUDGET, runs=STARTUP_RUNS):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(directory, 'gmail-backup.py')
+
+    # The .pyc files are written even if the interpreter is told not to
+    # write them, the first run only warms up the disk cache
+    compileall.compile_dir(directory, quiet=1)
+    _timeCommand([sys.executable, script, '--help'], 1)
+
+    bare = _timeCommand([sys.executable, '-c', 'pass'], runs)
+    total = _timeCommand([sys.executable, script, '--help'], runs)
+    startup = total - bare
+    print 'Interpreter startup: %.1f ms' % bare
+    print 'gmail-backup.py startup: %.1f ms (budget %d ms)' % (startup, budget)
+
+    failed = False
+    eager = _eagerModules(directory)
+    if eager:
+        print 'Modules imported at the startup: %s' % ', '.join(eager)
+        failed = True
+    if startup > budget:
+        print 'Startup time exceeds the budget'
+        failed = True
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    sys.exit(main(*args))
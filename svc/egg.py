@@ -20,7 +20,7 @@
 
 """PythonEgg class module
 """
-import inspect
+import types
 
 from svc.utils import sym
 
@@ -60,7 +60,7 @@ class MetaEgg(type):
     @classmethod
     def getPropertyDesc(cls, name, object):
         NO_PROPERTY = None, None
-        if not inspect.isfunction(object):
+        if not isinstance(object, types.FunctionType):
             return NO_PROPERTY
 
         protected = False
@@ -146,7 +146,7 @@ class PythonEgg(object):
     def _isMetaAttribute(self, name, attr_value):
         if isinstance(attr_value, MetaAttribute):
             return True
-        if  inspect.isclass(attr_value) \
+        if  isinstance(attr_value, (type, types.ClassType)) \
         and issubclass(attr_value, AttributeClass):
             return True
 
@@ -248,8 +248,6 @@ příkazového řádku)::
 """
 import sys
 import os
-import logging
-import inspect
 
 from svc.egg import PythonEgg
 from svc.utils import sym, issequence, isstr, seqIntoDict
@@ -494,6 +492,22 @@ class OptionManager(PythonEgg):
             if option not in self._optionAliases:
                 self._optionAliases[option] = set([ref_param])
             self._optionAliases[option].add(param)
+        self._compile()
+
+    def _compile(self):
+        """Předpočítá rozdělená jména parametrů a index specifikátorů
+
+        Dotazy `paramsWithSpecifier`, `paramsChildren` atd. jsou volány
+        opakovaně při každém spuštění skriptu, proto nesmí procházet celou
+        specifikaci znovu.
+        """
+        self._paramParts = {}
+        self._specifierIndex = {}
+        self._childrenCache = {}
+        for param, (specifiers, conversion, args) in self._rawspec.iteritems():
+            self._paramParts[param] = tuple(self._splitParam(param))
+            for specifier in specifiers:
+                self._specifierIndex.setdefault(specifier, set()).add(param)
 
     def delAliases(self):
         # FIXME: Remove
@@ -502,6 +516,7 @@ class OptionManager(PythonEgg):
             del self._rawspec[param]
         self._aliases.clear()
         self._optionAliases.clear()
+        self._compile()
 
     def getHelpForOptions(self):
         return self._helpForOptions
@@ -535,31 +550,34 @@ class OptionManager(PythonEgg):
     def paramsWithSpecifier(self, specifier):
         """Vrátí seznam jmen všech parametrů SE specifikátorem `specifier`
         """
-        return set(key for (key, (s, c, a)) in self._rawspec.iteritems()
-                      if specifier in s)
+        return set(self._specifierIndex.get(specifier, ()))
 
     def paramsWithoutSpecifier(self, specifier):
         """Vrátí seznam jmen všech parametrů BEZ specifikátoru `specifier`
         """
-        return set(key for (key, (s, c, a)) in self._rawspec.iteritems()
-                      if specifier not in s)
+        return self.params() - self._specifierIndex.get(specifier, set())
 
     def paramsAbove(self, level):
         """Vrátí množinu jmen parametrů na úrovni nejvýše `level`
         """
-        return set(p for p in self.params() if len(self._splitParam(p)) <= level)
+        return set(p for (p, t) in self._paramParts.iteritems() if len(t) <= level)
 
     def paramsBelow(self, level):
         """Vrátí množinu jmen parametrů na úrovni pod `level`
         """
-        return set(p for p in self.params() if len(self._splitParam(p)) > level)
+        return set(p for (p, t) in self._paramParts.iteritems() if len(t) > level)
 
     def paramsChildren(self, param):
         """Vrátí množinu parametrů, jež jsou dětmi parametru `param`
         """
-        param_t = self._splitParam(param)
-        m = len(param_t)
-        return set(p for p in self.params() if self._splitParam(p)[:m] == param_t)
+        try:
+            children = self._childrenCache[param]
+        except KeyError:
+            param_t = tuple(self._splitParam(param))
+            m = len(param_t)
+            children = self._childrenCache[param] = frozenset(
+                p for (p, t) in self._paramParts.iteritems() if t[:m] == param_t)
+        return set(children)
 
     def specifiers(self, paramName):
         """Vrátí všechny specifkátory parametru `paramName`
@@ -1246,14 +1264,33 @@ class Script(SimpleScript):
 
         return super(Script, self).premain(**kwargs)
 
-    def createLogger(self):
-        self.logger = logging.getLogger(self.__class__.__name__)
-        self.logger.addHandler(logging.StreamHandler(sys.stderr))
+    _WARNING = 30
 
-    def setupLogger(self, verbose_level=logging.WARNING, verbose=[]):
+    def createLogger(self):
+        # The logging module is imported on the first use of self.logger,
+        # it is not needed by most of the scripts
+        self._logger = None
+        self._verboseLevel = self._WARNING
+
+    def getLogger(self):
+        if self._logger is None:
+            import logging
+            logger = logging.getLogger(self.__class__.__name__)
+            logger.addHandler(logging.StreamHandler(sys.stderr))
+            logger.setLevel(self._verboseLevel)
+            self._logger = logger
+        return self._logger
+
+    def setLogger(self, logger):
+        self._logger = logger
+
+    def setupLogger(self, verbose_level=None, verbose=[]):
+        if verbose_level is None:
+            verbose_level = self._WARNING
         try:
             verbose_level = int(verbose_level)
         except ValueError:
+            import logging
             verbose_level = verbose_level.upper()
             try:
                 verbose_level = logging._levelNames[verbose_level]
@@ -1262,7 +1299,9 @@ class Script(SimpleScript):
         for i in verbose:
             if i: verbose_level -= 10
         verbose_level = max(verbose_level, 1)
-        self.logger.setLevel(verbose_level)
+        self._verboseLevel = verbose_level
+        if self._logger is not None:
+            self._logger.setLevel(verbose_level)
 
     def _getMainOptions(self):
         script_params = self.manager.params()
@@ -21,6 +21,7 @@ import sys
 import os
 import re
 import time
+import errno
 import getpass
 from copy import copy
 from threading import Thread
@@ -42,9 +43,13 @@ AsyncMethod = sym('AsyncMethod')
 ExecGenerator = sym('ExecGenerator')
 ExecList = sym('ExecList')
 ExecStr = sym('ExecStr')
+ExecChunks = sym('ExecChunks')
 ExecNoStdout = sym('ExecNoStdout')
 ExecAsync = sym('ExecAsync')
 
+PIPE_READ = 64 * 1024 # Size of one read from the pipe in the chunked mode
+PIPE_WRITE = 4096 # Size of one write into the pipe in the chunked mode, at most PIPE_BUF
+
 class ExternalError(OSError):
     pass
 
@@ -108,13 +113,17 @@ class ExternalMethod(PythonEgg):
         exit status. Environment of new process is initialized using
         `self.getEnv` method and updated with `env`.
 
+        If `chunked` is True, the pipes are read and written in chunks
+        instead of lines (see `pump`), so the binary data don't block.
+
         :Returns:
-            Generator yielding lines of stdout of `fn`
+            Generator yielding lines (or chunks) of stdout of `fn`
         """
         stdin = kwargs.pop('stdin', None)
         stdin_file = kwargs.pop('stdin_file', None)
         stdout_file = kwargs.pop('stdout_file', None)
         env = kwargs.pop('env', {})
+        chunked = kwargs.pop('chunked', False)
 
         if kwargs:
             raise TypeError("Bad keyword arguments: %s" % kwargs.keys())
@@ -167,6 +176,12 @@ class ExternalMethod(PythonEgg):
         else:
             poll_w = []
 
+        if chunked:
+            for chunk in self.pump(process, stdin_func):
+                yield chunk
+            # The pipes are closed by pump(), the loop below is skipped
+            poll_r, poll_w = [], []
+
         while poll_r or poll_w:
             readable, writeable, errorable = select(poll_r, poll_w, [])
 
@@ -206,6 +221,92 @@ class ExternalMethod(PythonEgg):
         elif retcode > 0:
             raise ExternalError("External method %s (%r) returned with nonzero exit status (%d)" % (self.name, ' '.join(exec_list), retcode))
 
+    def pump(self, process, stdin=None, close_stdin=True):
+        """Writes the strings from the iterable `stdin` into the stdin of
+        the running `process` and yields the chunks of its stdout
+
+        The pipes are read by os.read() and written by at most PIPE_WRITE
+        bytes when select() allows it, so the process never waits for us
+        and the binary data without newlines are passed immediately. The
+        stdin is closed after the last string unless `close_stdin` is False
+        (long-lived process, the caller closes the generator once it has
+        the whole answer). If the process stops reading its stdin, the rest
+        of the input is dropped, its exit status tells why. The generator
+        ends at the end of stdout, the caller waits for the process.
+        """
+        poll_r = [process.stderr]
+        if process.stdout is not None:
+            poll_r.append(process.stdout)
+        if stdin is not None:
+            stdin = iter(stdin)
+            poll_w = [process.stdin]
+        else:
+            poll_w = []
+        pending = ''
+
+        while poll_r or poll_w:
+            readable, writeable, errorable = select(poll_r, poll_w, [])
+
+            if process.stderr in readable:
+                data = os.read(process.stderr.fileno(), PIPE_READ)
+                if not data:
+                    process.stderr.close()
+                    poll_r.remove(process.stderr)
+                else:
+                    self._logStderr(data)
+
+            if process.stdin in writeable:
+                if not pending:
+                    try:
+                        pending = stdin.next()
+                    except StopIteration:
+                        poll_w.remove(process.stdin)
+                        if close_stdin:
+                            process.stdin.close()
+                if pending:
+                    try:
+                        written = os.write(process.stdin.fileno(), pending[:PIPE_WRITE])
+                        pending = pending[written:]
+                    except OSError, e:
+                        if e.errno != errno.EPIPE:
+                            raise
+                        poll_w.remove(process.stdin)
+                        process.stdin.close()
+
+            if process.stdout in readable:
+                data = os.read(process.stdout.fileno(), PIPE_READ)
+                if not data:
+                    process.stdout.close()
+                    poll_r.remove(process.stdout)
+                else:
+                    yield data
+
+    def spawn(self, *args, **kwargs):
+        """Starts program `fn` with cmdline `args` and in environment `env`
+        and returns the Popen object of the running process
+
+        Unlike `execute`, the stdin, stdout and stderr pipes are left to the
+        caller, which talks to the long-lived process and waits for it.
+        """
+        env = kwargs.pop('env', {})
+
+        if kwargs:
+            raise TypeError("Bad keyword arguments: %s" % kwargs.keys())
+
+        e = dict(self.getEnv())
+        e.update(env)
+        e = self._strEnv(e)
+        args = self._strArgs(self.args + list(args))
+
+        exec_list = [self.fileName] + args
+        if self.pre_func is not None:
+            self.pre_func(self, exec_list, env)
+        try:
+            return Popen(exec_list, shell=False, env=e,
+                    stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=0)
+        except OSError, e:
+            raise ExternalError("Couldn't execute external method %r: %s" % (self.name, e))
+
     def executeGenerator(self, *args, **kwargs):
         return self.execute(*args, **kwargs)
 
@@ -217,6 +318,10 @@ class ExternalMethod(PythonEgg):
     def executeStr(self, *args, **kwargs):
         return ''.join(self.execute(*args, **kwargs))
 
+    def executeChunks(self, *args, **kwargs):
+        kwargs['chunked'] = True
+        return ''.join(self.execute(*args, **kwargs))
+
     def executeNoStdout(self, *args, **kwargs):
         for foo in self.execute(*args, **kwargs):
             pass
@@ -355,6 +460,8 @@ class Pipeline(PythonEgg):
                 else:
                     method = item
                 kwargs = {}
+                if item.etype == ExecChunks:
+                    kwargs['chunked'] = True
                 if self.redir_stdin is not None and first:
                     kwargs['stdin_file'] = self.redir_stdin
                 else:
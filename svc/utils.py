@@ -20,7 +20,6 @@
 import sys
 import codecs
 from types import StringTypes
-from inspect import isroutine
 
 class sym(object):
     def __init__(self, s):